@@ -0,0 +1,309 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from . import EMAStandalone
+except ImportError:
+    #blender --python doesn't put the script's directory on the path
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import EMAStandalone
+
+#Converts a library of .ema files into .blend action libraries without an interactive session
+#The driver shards the files across several `blender -b` workers; each worker opens the reference .blend, imports
+#every file against the reference armature with the add-on's own operators, builds all its actions with the loader
+#and saves one .blend per file. Finished files are then appended into a single library.blend for linking, with
+#every action renamed <file>/<animation> so the same move from different characters can sit side by side
+#
+#Command line (outside Blender):
+#   python EMABatch.py chara_dir out_dir --reference rig.blend --armature RYU --blender /path/to/blender
+#   python EMABatch.py a.ema b.ema out_dir --reference rig.blend --armature RYU --emo RYU.emo --workers 6
+
+#Workers print one line per file with this prefix, followed by JSON, for the driver to pick up
+REPORT_PREFIX = "USF4BATCH "
+
+#Shards per worker, smaller shards spread the load better and make a retry redo less work
+SHARDS_PER_WORKER = 4
+
+def FindEMO(path, emo = None):
+#The .emo to take bind matrices from: the one given, else one next to the .ema with the same name
+    if emo is not None:
+        return emo
+    stem = os.path.splitext(path)[0]
+    for ext in (".emo", ".EMO"):
+        if os.path.isfile(stem + ext):
+            return stem + ext
+    return None
+
+def OutputPath(path, root, out_dir):
+    return os.path.join(out_dir, os.path.splitext(os.path.relpath(path, root))[0] + ".blend")
+
+def LibraryPrefix(path, root):
+    return os.path.splitext(os.path.relpath(path, root))[0].replace(os.sep, "/")
+
+#
+#Inside Blender
+#
+
+def EnableAddon():
+#Registers the add-on in this Blender session if it isn't already
+    import bpy
+    import importlib
+
+    if hasattr(bpy.types, "USF4_OT_import_ema"):
+        return
+    parent, name = os.path.split(EMAStandalone.ADDON_DIRECTORY)
+    if parent not in sys.path:
+        sys.path.insert(0, parent)
+    importlib.import_module(name).register()
+
+def ConvertFile(reference, armature_name, path, emo, out_path):
+#Opens the reference file fresh, imports path onto its armature, builds every action and saves to out_path
+#Returns the names of the actions built
+    import bpy
+
+    bpy.ops.wm.open_mainfile(filepath=reference)
+    armature = bpy.data.objects.get(armature_name)
+    if armature is None or armature.type != 'ARMATURE':
+        raise RuntimeError("No armature called " + armature_name + " in " + reference)
+
+    bpy.context.view_layer.objects.active = armature
+    armature.select_set(True)
+
+    if bpy.ops.usf4.import_ema(filepath=path) != {'FINISHED'}:
+        raise RuntimeError("Couldn't import " + path)
+    if emo is None:
+        raise RuntimeError("No .emo for " + path)
+    if bpy.ops.usf4.import_emo(filepath=emo) != {'FINISHED'}:
+        raise RuntimeError("Couldn't import " + emo)
+
+    addon = sys.modules[os.path.basename(EMAStandalone.ADDON_DIRECTORY)]
+    ad = addon.GetArmatureData(armature.name)
+
+    built = []
+    for a in ad.EMA.Animations:
+        action = bpy.data.actions.get(a.Name)
+        if action is None or a.Name in built:
+            continue
+        armature.animation_data.action = action
+        if bpy.ops.usf4.load_animation_data() != {'FINISHED'}:
+            raise RuntimeError("Couldn't build " + a.Name)
+        built.append(a.Name)
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    bpy.ops.wm.save_as_mainfile(filepath=out_path, check_existing=False)
+    return built
+
+def WorkerMain(args):
+    EnableAddon()
+
+    for path in args.files:
+        started = time.perf_counter()
+        report = {"file": path, "out": OutputPath(path, args.root, args.out_dir)}
+        try:
+            report["actions"] = ConvertFile(args.reference, args.armature, path, FindEMO(path, args.emo), report["out"])
+        except Exception as e:
+            report["error"] = str(e)
+        report["seconds"] = time.perf_counter() - started
+        print(REPORT_PREFIX + json.dumps(report), flush=True)
+
+def MergeMain(args):
+#Appends the actions listed in the manifest out of every per-file .blend into one library
+    import bpy
+
+    with open(args.manifest) as f:
+        entries = json.load(f)
+
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+    for entry in entries:
+        names = set(entry["actions"])
+        with bpy.data.libraries.load(entry["out"], link=False) as (data_from, data_to):
+            data_to.actions = [n for n in data_from.actions if n in names]
+
+        for action in data_to.actions:
+            if action is None:
+                continue
+            original = action.get("usf4_animation", action.name)
+            #Appending can suffix the name when it clashes, so set it outright
+            action.name = entry["prefix"] + "/" + original
+            action["usf4_animation"] = original
+            action["usf4_source"] = entry["file"]
+            action.use_fake_user = True
+
+    bpy.ops.wm.save_as_mainfile(filepath=args.library, check_existing=False)
+
+#
+#Driver
+#
+
+class BatchDriver:
+    def __init__(self, blender, reference, armature, out_dir, root, emo = None, workers = 4, retries = 2):
+        self.Blender = blender
+        self.Reference = os.path.abspath(reference)
+        self.Armature = armature
+        self.OutDir = os.path.abspath(out_dir)
+        self.Root = os.path.abspath(root)
+        self.EMO = os.path.abspath(emo) if emo is not None else None
+        self.Workers = max(1, workers)
+        self.Retries = retries
+        #file -> latest report
+        self.Results = {}
+        self.Lock = threading.Lock()
+        self.Total = 0
+        self.Started = time.perf_counter()
+
+    def Command(self, mode, *extra):
+        return [self.Blender, "-b", "--python-exit-code", "1", "--python", os.path.abspath(__file__), "--", mode] + list(extra)
+
+    def WorkerCommand(self, files):
+        cmd = self.Command("worker", "--reference", self.Reference, "--armature", self.Armature,
+            "--root", self.Root, "--out-dir", self.OutDir)
+        if self.EMO is not None:
+            cmd += ["--emo", self.EMO]
+        return cmd + files
+
+    def Record(self, report):
+        with self.Lock:
+            self.Results[report["file"]] = report
+            done = sum(1 for r in self.Results.values() if "error" not in r)
+            status = "failed: " + report["error"] if "error" in report else "%d actions" % len(report["actions"])
+            print("[%d/%d %.0fs] %s %.1fs, %s" % (done, self.Total, time.perf_counter() - self.Started,
+                os.path.relpath(report["file"], self.Root), report["seconds"], status), flush=True)
+
+    def RunShard(self, files):
+    #Runs one worker over files, returns the files it didn't convert
+        proc = subprocess.Popen(self.WorkerCommand(files), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True, errors="replace")
+        log = []
+        reported = set()
+        for line in proc.stdout:
+            if line.startswith(REPORT_PREFIX):
+                report = json.loads(line[len(REPORT_PREFIX):])
+                reported.add(report["file"])
+                self.Record(report)
+            else:
+                log.append(line)
+        proc.wait()
+
+        #A crash takes the rest of the shard with it
+        if proc.returncode != 0:
+            print("Worker exited with %d:\n%s" % (proc.returncode, "".join(log[-20:])), file=sys.stderr, flush=True)
+            for f in files:
+                if f not in reported:
+                    self.Record({"file": f, "error": "worker exited with %d" % proc.returncode, "seconds": 0.0})
+
+        return [f for f in files if "error" in self.Results.get(f, {"error": None})]
+
+    def Shards(self, files):
+        size = max(1, -(-len(files) // (self.Workers * SHARDS_PER_WORKER)))
+        return [files[i:i + size] for i in range(0, len(files), size)]
+
+    def Convert(self, files):
+    #Converts every file, retrying the ones that failed, returns the reports of those that never succeeded
+        self.Total = len(files)
+        pending = list(files)
+        with ThreadPoolExecutor(self.Workers) as pool:
+            for attempt in range(self.Retries + 1):
+                if len(pending) == 0:
+                    break
+                if attempt > 0:
+                    print("Retrying %d files (attempt %d)" % (len(pending), attempt + 1), flush=True)
+                failed = []
+                for remaining in pool.map(self.RunShard, self.Shards(pending)):
+                    failed.extend(remaining)
+                pending = failed
+        return [self.Results[f] for f in pending]
+
+    def Merge(self, library):
+    #Appends every converted file's actions into library, returns the number of actions
+        entries = []
+        for f, r in sorted(self.Results.items()):
+            if "error" not in r and len(r["actions"]) > 0:
+                entries.append({"file": os.path.relpath(f, self.Root), "out": r["out"], "actions": r["actions"],
+                    "prefix": LibraryPrefix(f, self.Root)})
+        if len(entries) == 0:
+            return 0
+
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump(entries, f)
+            manifest = f.name
+        try:
+            subprocess.run(self.Command("merge", "--manifest", manifest, "--library", os.path.abspath(library)),
+                stdout=subprocess.DEVNULL, check=True)
+        finally:
+            os.remove(manifest)
+        return sum(len(e["actions"]) for e in entries)
+
+    def WriteReport(self, path):
+        with open(path, "w") as f:
+            json.dump(sorted(self.Results.values(), key=lambda r: r["file"]), f, indent=1)
+
+def main(argv = None):
+    if argv is None and "--" in sys.argv:
+        argv = sys.argv[sys.argv.index("--") + 1:]
+
+    #Modes the driver starts Blender in
+    if argv and argv[0] == "worker":
+        parser = argparse.ArgumentParser(prog="EMABatch worker")
+        parser.add_argument("--reference", required=True)
+        parser.add_argument("--armature", required=True)
+        parser.add_argument("--root", required=True)
+        parser.add_argument("--out-dir", required=True)
+        parser.add_argument("--emo")
+        parser.add_argument("files", nargs="+")
+        return WorkerMain(parser.parse_args(argv[1:]))
+    if argv and argv[0] == "merge":
+        parser = argparse.ArgumentParser(prog="EMABatch merge")
+        parser.add_argument("--manifest", required=True)
+        parser.add_argument("--library", required=True)
+        return MergeMain(parser.parse_args(argv[1:]))
+
+    parser = argparse.ArgumentParser(description="Convert .ema files into .blend action libraries with headless Blender workers")
+    parser.add_argument("sources", nargs="+", help=".ema files or directories to search for them")
+    parser.add_argument("out_dir", help="Where the per-file .blend files and library.blend go")
+    parser.add_argument("--reference", required=True, help=".blend with the armature to import against")
+    parser.add_argument("--armature", required=True, help="Name of the armature object in the reference file")
+    parser.add_argument("--emo", help=".emo to use for every file, by default the one next to each .ema")
+    parser.add_argument("--blender", default=os.environ.get("BLENDER", "blender"), help="Blender executable")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--retries", type=int, default=2, help="Times to retry files that failed")
+    parser.add_argument("--library", help="Merged library path, default out_dir/library.blend")
+    parser.add_argument("--no-merge", action="store_true", help="Only write the per-file .blend files")
+    args = parser.parse_args(argv)
+
+    files = []
+    for s in args.sources:
+        files.extend(EMAStandalone.FindFiles(s) if os.path.isdir(s) else [os.path.abspath(s)])
+    files = sorted(set(os.path.abspath(f) for f in files))
+    if len(files) == 0:
+        print("No .ema files found", file=sys.stderr)
+        return 1
+
+    root = os.path.commonpath([os.path.dirname(f) for f in files])
+    driver = BatchDriver(args.blender, args.reference, args.armature, args.out_dir, root, args.emo, args.workers, args.retries)
+    failed = driver.Convert(files)
+
+    converted = len(files) - len(failed)
+    seconds = sum(r["seconds"] for r in driver.Results.values())
+    print("Converted %d/%d files in %.1fs (%.1fs of worker time)" % (converted, len(files), time.perf_counter() - driver.Started, seconds))
+    for r in failed:
+        print("Failed: " + r["file"] + ": " + r["error"], file=sys.stderr)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    driver.WriteReport(os.path.join(args.out_dir, "report.json"))
+
+    if not args.no_merge:
+        library = args.library or os.path.join(args.out_dir, "library.blend")
+        count = driver.Merge(library)
+        print("Merged %d actions into %s" % (count, library))
+
+    return 1 if len(failed) > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
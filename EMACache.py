@@ -0,0 +1,256 @@
+import os
+import sys
+import mmap
+import json
+import array
+import struct
+import hashlib
+import tempfile
+
+#On-disk cache of parsed EMA/EMO files, keyed by a hash of the file content and the reader version
+#Entries are a JSON tree describing the objects plus flat float/int sections, read straight out of a read-only memory map
+#Nothing in an entry can run code: only classes the caller allows are rebuilt, and only by filling in their attributes
+
+CACHE_FORMAT = 4
+CACHE_EXTENSION = ".usf4cache"
+CACHE_MAGIC = b"USF4PRS\0"
+
+#Magic, format, byte order, then the lengths of the JSON tree, float section and int section
+HEADER = struct.Struct("<8sII3Q")
+
+class EntryWriter:
+#Flattens a parsed object into the JSON tree, moving every run of numbers into the typed sections
+    def __init__(self, classes):
+        self.Classes = classes
+        self.Floats = array.array('d')
+        self.Ints = array.array('q')
+        self.Objects = {}
+
+    def Numbers(self, values):
+        if len(values) == 0:
+            return []
+        if all(type(v) is float for v in values):
+            self.Floats.extend(values)
+            return {"F": [len(self.Floats) - len(values), len(values)]}
+        if all(type(v) is int and -2**63 <= v < 2**63 for v in values):
+            self.Ints.extend(values)
+            return {"I": [len(self.Ints) - len(values), len(values)]}
+        return None
+
+    def Encode(self, obj):
+        import mathutils
+
+        if obj is None or type(obj) in (bool, int, float, str):
+            return obj
+        if type(obj) is list:
+            flat = self.Numbers(obj)
+            return flat if flat is not None else [self.Encode(v) for v in obj]
+        if type(obj) is tuple:
+            return {"T": [self.Encode(v) for v in obj]}
+        if type(obj) is dict:
+            return {"D": [[self.Encode(k), self.Encode(v)] for k, v in obj.items()]}
+        if type(obj) is bytes:
+            return {"B": obj.hex()}
+
+        if isinstance(obj, mathutils.Matrix):
+            self.Floats.extend([v for row in obj for v in row])
+            return {"M": [len(self.Floats) - len(obj) * len(obj.col), len(obj), len(obj.col)]}
+        if isinstance(obj, mathutils.Quaternion):
+            self.Floats.extend((obj.w, obj.x, obj.y, obj.z))
+            return {"Q": len(self.Floats) - 4}
+        if isinstance(obj, mathutils.Euler):
+            self.Floats.extend(obj)
+            return {"E": [len(self.Floats) - 3, obj.order]}
+        if isinstance(obj, mathutils.Vector):
+            self.Floats.extend(obj)
+            return {"V": [len(self.Floats) - len(obj), len(obj)]}
+
+        name = type(obj).__name__
+        if self.Classes.get(name) is not type(obj) or not hasattr(obj, "__dict__"):
+            raise TypeError("can't cache " + type(obj).__module__ + "." + name)
+        ref = self.Objects.get(id(obj))
+        if ref is not None:
+            return {"R": ref}
+        ref = len(self.Objects)
+        self.Objects[id(obj)] = ref
+        return {"O": name, "id": ref, "a": {k: self.Encode(v) for k, v in obj.__dict__.items()}}
+
+    def Write(self, f, path, obj):
+        tree = json.dumps({"path": path, "root": self.Encode(obj)}, separators=(',', ':')).encode('utf-8')
+        floats = self.Floats.tobytes()
+        ints = self.Ints.tobytes()
+        f.write(HEADER.pack(CACHE_MAGIC, CACHE_FORMAT, sys.byteorder == "little", len(tree), len(floats), len(ints)))
+        f.write(tree)
+        f.write(floats)
+        f.write(ints)
+
+class EntryReader:
+#Rebuilds the objects from an entry, numbers come out of the mapped sections without copying the rest of the file
+    def __init__(self, classes, floats, ints):
+        self.Classes = classes
+        self.FloatData = floats
+        self.IntData = ints
+        self.Objects = {}
+
+    def Floats(self, start, count):
+        return self.FloatData[start:start + count].tolist()
+
+    def Decode(self, v):
+        import mathutils
+
+        if type(v) is list:
+            return [self.Decode(i) for i in v]
+        if type(v) is not dict:
+            return v
+
+        if "F" in v:
+            return self.Floats(*v["F"])
+        if "I" in v:
+            start, count = v["I"]
+            return self.IntData[start:start + count].tolist()
+        if "T" in v:
+            return tuple(self.Decode(i) for i in v["T"])
+        if "D" in v:
+            return {self.Decode(k): self.Decode(i) for k, i in v["D"]}
+        if "B" in v:
+            return bytes.fromhex(v["B"])
+        if "M" in v:
+            start, rows, cols = v["M"]
+            values = self.Floats(start, rows * cols)
+            return mathutils.Matrix([values[r * cols:(r + 1) * cols] for r in range(rows)])
+        if "Q" in v:
+            return mathutils.Quaternion(self.Floats(v["Q"], 4))
+        if "E" in v:
+            start, order = v["E"]
+            return mathutils.Euler(self.Floats(start, 3), order)
+        if "V" in v:
+            return mathutils.Vector(self.Floats(*v["V"]))
+        if "R" in v:
+            return self.Objects[v["R"]]
+
+        cls = self.Classes.get(v["O"])
+        if cls is None:
+            raise TypeError("entry holds a " + str(v["O"]) + ", which isn't a cacheable class")
+        obj = cls.__new__(cls)
+        self.Objects[v["id"]] = obj
+        obj.__dict__.update({k: self.Decode(i) for k, i in v["a"].items()})
+        return obj
+
+def ReadEntry(m, classes):
+#Returns (path, object) from a mapped entry
+    magic, version, little, tree_length, float_length, int_length = HEADER.unpack_from(m, 0)
+    if magic != CACHE_MAGIC or version != CACHE_FORMAT or bool(little) != (sys.byteorder == "little"):
+        raise ValueError("not a current cache entry")
+    if HEADER.size + tree_length + float_length + int_length != len(m):
+        raise ValueError("truncated cache entry")
+
+    start = HEADER.size + tree_length
+    with memoryview(m) as view:
+        with view[start:start + float_length] as f, view[start + float_length:start + float_length + int_length] as i:
+            with f.cast('d') as floats, i.cast('q') as ints:
+                tree = json.loads(bytes(view[HEADER.size:start]))
+                obj = EntryReader(classes, floats, ints).Decode(tree["root"])
+    return tree["path"], obj
+
+def RenameSource(obj, old_path, new_path):
+#A hit may come from a copy of the file somewhere else, so point the name back at the file actually opened
+    if old_path == new_path or not hasattr(obj, "Name"):
+        return
+    if obj.Name == old_path:
+        obj.Name = new_path
+    elif obj.Name == os.path.basename(old_path):
+        obj.Name = os.path.basename(new_path)
+
+class ParseCache:
+    def __init__(self, directory, reader_version, classes, max_bytes = 512 * 1024 * 1024):
+        self.Directory = directory
+        self.ReaderVersion = reader_version
+        #Class name -> class, for every type an entry is allowed to contain
+        self.Classes = classes
+        self.MaxBytes = max_bytes
+        self.Hits = 0
+        self.Misses = 0
+
+    def Key(self, content_hash, kind):
+        h = hashlib.sha1()
+        h.update(("%s:%d:%s:%s" % (kind, CACHE_FORMAT, self.ReaderVersion, content_hash)).encode('ascii'))
+        return h.hexdigest()
+
+    def Path(self, key):
+        return os.path.join(self.Directory, key + CACHE_EXTENSION)
+
+    def Load(self, content_hash, kind, path, parse):
+    #Returns the parsed object for the file with this content hash, from the cache if we've seen it before, otherwise via parse()
+    #Callers only need the file bytes inside parse(), so a hit never has to produce them
+        key = self.Key(content_hash, kind)
+        entry = self.Path(key)
+
+        if os.path.isfile(entry) and os.path.getsize(entry) > 0:
+            try:
+                with open(entry, "rb") as f:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                        old_path, obj = ReadEntry(m, self.Classes)
+                os.utime(entry)
+                RenameSource(obj, old_path, path)
+                self.Hits += 1
+                return obj
+            except Exception as e:
+                print("Discarding unreadable cache entry " + entry + ": " + str(e))
+                self.Remove(entry)
+
+        self.Misses += 1
+        obj = parse()
+
+        temp = None
+        try:
+            os.makedirs(self.Directory, exist_ok=True)
+            #Several Blender processes (e.g. EMABatch workers) can share the cache, so each writes its own temp file
+            fd, temp = tempfile.mkstemp(dir=self.Directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                EntryWriter(self.Classes).Write(f, path, obj)
+            os.replace(temp, entry)
+            temp = None
+            self.Evict()
+        except Exception as e:
+            print("Couldn't cache " + path + ": " + str(e))
+        if temp is not None:
+            self.Remove(temp)
+
+        return obj
+
+    def Entries(self):
+        if not os.path.isdir(self.Directory):
+            return []
+        entries = []
+        for name in os.listdir(self.Directory):
+            if name.endswith(CACHE_EXTENSION):
+                p = os.path.join(self.Directory, name)
+                st = os.stat(p)
+                entries.append((st.st_mtime, st.st_size, p))
+        return entries
+
+    def Size(self):
+        return sum(e[1] for e in self.Entries())
+
+    def Evict(self):
+    #Drops least recently used entries until the cache fits in MaxBytes
+        entries = sorted(self.Entries())
+        total = sum(e[1] for e in entries)
+        for mtime, size, p in entries:
+            if total <= self.MaxBytes:
+                break
+            self.Remove(p)
+            total -= size
+
+    def Remove(self, p):
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+    def Clear(self):
+        count = 0
+        for mtime, size, p in self.Entries():
+            self.Remove(p)
+            count += 1
+        return count
@@ -0,0 +1,152 @@
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import zipfile
+import argparse
+import numpy as np
+
+try:
+    from . import EMAStandalone
+    from .EMASampler import TrackSampler
+    from .EMAPose import RestPose, TrackAbsoluteFlags, PoseTable, EvaluateFrames
+except ImportError:
+    import EMAStandalone
+    from EMASampler import TrackSampler
+    from EMAPose import RestPose, TrackAbsoluteFlags, PoseTable, EvaluateFrames
+
+#Samples every animation in an .ema at its native 60 fps and writes the composed poses out as arrays
+#One animation is sampled and written at a time, in chunks of frames, so memory use doesn't grow with the file
+#
+#Each animation gets <slot>_<name>.local.npy and .world.npy, float32 (frames, nodes, 4, 4), row-major DirectX space
+#matrices straight from the hierarchy pass, plus a manifest.json describing the skeleton and every array
+#
+#Command line:
+#   python EMAExport.py path/to/file.ema out_dir
+#   python EMAExport.py path/to/chara out_dir --npz
+
+EXPORT_FORMAT = 1
+FPS = 60
+
+#Frames composed per batch, bounds the working set to a few MB for typical skeletons
+CHUNK_FRAMES = 256
+
+def SafeName(name):
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+
+def ComposeChunks(ema, animation, chunk = CHUNK_FRAMES):
+#Yields (first frame, world matrices, local matrices) for consecutive chunks of the animation
+    sampler = TrackSampler(animation, ema.Skeleton)
+    flags = TrackAbsoluteFlags(animation, len(ema.Skeleton.Nodes))
+    table = PoseTable(ema, RestPose(ema.Skeleton), flags, sampler)
+
+    for start in range(0, animation.Duration, chunk):
+        frames = np.arange(start, min(start + chunk, animation.Duration), dtype=np.float64)
+        W, L = EvaluateFrames(table, sampler, frames)
+        yield start, W, L
+
+def ExportAnimationNpy(ema, animation, base, chunk = CHUNK_FRAMES):
+#Streams one animation straight into memory-mapped .npy files, returns their paths
+    shape = (animation.Duration, len(ema.Skeleton.Nodes), 4, 4)
+    paths = (base + ".world.npy", base + ".local.npy")
+
+    #Nothing to map for an empty animation, so just write the empty arrays
+    if animation.Duration <= 0:
+        empty = np.zeros((0,) + shape[1:], dtype=np.float32)
+        for p in paths:
+            np.save(p, empty)
+        return paths
+
+    world = np.lib.format.open_memmap(paths[0], mode="w+", dtype=np.float32, shape=shape)
+    local = np.lib.format.open_memmap(paths[1], mode="w+", dtype=np.float32, shape=shape)
+
+    for start, W, L in ComposeChunks(ema, animation, chunk):
+        world[start:start + len(W)] = W
+        local[start:start + len(L)] = L
+
+    world.flush()
+    local.flush()
+    del world, local
+    return paths
+
+def ExportAnimationNpz(ema, animation, base, chunk = CHUNK_FRAMES):
+#Same arrays in one uncompressed .npz, the members can still be memory-mapped once extracted
+#The animation is sampled once into the .npy files, which are then stored in the archive as they are
+    path = base + ".npz"
+    world, local = ExportAnimationNpy(ema, animation, base + ".tmp", chunk)
+
+    try:
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as z:
+            z.write(world, "world.npy")
+            z.write(local, "local.npy")
+    finally:
+        for p in (world, local):
+            os.remove(p)
+
+    return path
+
+def ExportEMA(path, out_dir, npz = False, chunk = CHUNK_FRAMES):
+#Exports every animation in the .ema at path, returns the manifest
+    ema, data = EMAStandalone.ReadEMA(path)
+    os.makedirs(out_dir, exist_ok=True)
+
+    nodes = ema.Skeleton.Nodes
+    manifest = {
+        "format": EXPORT_FORMAT,
+        "source": os.path.abspath(path),
+        "hash": hashlib.sha1(data).hexdigest(),
+        "fps": FPS,
+        "dtype": "float32",
+        "layout": "frames, nodes, 4, 4",
+        "nodes": [n.Name for n in nodes],
+        "parents": [n.Parent for n in nodes],
+        "animations": [],
+    }
+
+    for slot, a in enumerate(ema.Animations):
+        base = os.path.join(out_dir, "%03d_%s" % (slot, SafeName(a.Name)))
+        entry = {"slot": slot, "name": a.Name, "frames": a.Duration}
+
+        if npz:
+            entry["file"] = os.path.basename(ExportAnimationNpz(ema, a, base, chunk))
+        else:
+            world, local = ExportAnimationNpy(ema, a, base, chunk)
+            entry["world"] = os.path.basename(world)
+            entry["local"] = os.path.basename(local)
+
+        manifest["animations"].append(entry)
+
+    with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+
+    return manifest
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Export sampled EMA poses as NumPy arrays")
+    parser.add_argument("source", help=".ema file, or a directory to export every .ema under")
+    parser.add_argument("out_dir")
+    parser.add_argument("--npz", action="store_true", help="One .npz per animation rather than separate .npy files")
+    parser.add_argument("--chunk", type=int, default=CHUNK_FRAMES, help="Frames composed per batch")
+    args = parser.parse_args(argv)
+
+    if os.path.isdir(args.source):
+        paths = EMAStandalone.FindFiles(args.source)
+        root = args.source
+    else:
+        paths = [args.source]
+        root = os.path.dirname(args.source)
+
+    for p in paths:
+        started = time.perf_counter()
+        out_dir = os.path.join(args.out_dir, os.path.splitext(os.path.relpath(p, root))[0])
+        try:
+            manifest = ExportEMA(p, out_dir, args.npz, args.chunk)
+        except Exception as e:
+            print("Couldn't export " + p + ": " + str(e), file=sys.stderr)
+            continue
+        print("%s: %d animations, %.1f s" % (p, len(manifest["animations"]), time.perf_counter() - started))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from . import EMAStandalone
+except ImportError:
+    import EMAStandalone
+
+#SQLite index of every animation across a directory tree of .ema files
+#Files are parsed in a process pool, and only files whose size/mtime (then content hash) changed get parsed again
+#
+#Command line:
+#   python EMAIndex.py index library.db path/to/chara
+#   python EMAIndex.py query library.db --bone RArmEff --type rotation --absolute
+#   python EMAIndex.py query library.db --min-duration 120
+
+INDEX_FORMAT = 1
+
+TRANSFORM_NAMES = {"translation": 0, "rotation": 1, "scale": 2}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    hash TEXT NOT NULL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS animations (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    slot INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    duration INTEGER NOT NULL,
+    track_count INTEGER NOT NULL,
+    key_count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    animation_id INTEGER NOT NULL REFERENCES animations(id) ON DELETE CASCADE,
+    bone TEXT NOT NULL,
+    bone_id INTEGER NOT NULL,
+    transform_type INTEGER NOT NULL,
+    component INTEGER NOT NULL,
+    absolute INTEGER NOT NULL,
+    bit_flag INTEGER NOT NULL,
+    key_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS animations_file ON animations(file_id);
+CREATE INDEX IF NOT EXISTS animations_duration ON animations(duration);
+CREATE INDEX IF NOT EXISTS animations_name ON animations(name);
+CREATE INDEX IF NOT EXISTS tracks_animation ON tracks(animation_id);
+CREATE INDEX IF NOT EXISTS tracks_bone ON tracks(bone, transform_type, absolute);
+"""
+
+def ScanFile(path):
+#Runs in the worker processes: parses one .ema down to plain tuples
+#Returns (path, hash, animations, error), animations being (name, duration, [(bone, bone_id, type, component, absolute, bit_flag, keys)])
+    try:
+        ema, data = EMAStandalone.ReadEMA(path)
+    except Exception as e:
+        return path, None, [], str(e)
+    digest = hashlib.sha1(data).hexdigest()
+
+    nodes = ema.Skeleton.Nodes
+    animations = []
+    for a in ema.Animations:
+        tracks = []
+        for c in a.CMDTracks:
+            bone = nodes[c.BoneID].Name if c.BoneID < len(nodes) else ""
+            tracks.append((bone, c.BoneID, c.TransformType, c.BitFlag & 0x03, (c.BitFlag & 0x10) == 0x10, c.BitFlag, c.StepCount))
+        animations.append((a.Name, a.Duration, tracks))
+
+    return path, digest, animations, None
+
+class EMAIndex:
+    def __init__(self, db_path):
+        self.Path = db_path
+        self.Connection = sqlite3.connect(db_path)
+        self.Connection.execute("PRAGMA foreign_keys = ON")
+        self.Connection.execute("PRAGMA journal_mode = WAL")
+        self.Connection.executescript(SCHEMA)
+
+        row = self.Connection.execute("SELECT value FROM info WHERE key = 'format'").fetchone()
+        if row is not None and int(row[0]) != INDEX_FORMAT:
+            #Older layout, start again
+            self.Connection.executescript("DELETE FROM tracks; DELETE FROM animations; DELETE FROM files;")
+        self.Connection.execute("INSERT OR REPLACE INTO info VALUES ('format', ?)", (str(INDEX_FORMAT),))
+        self.Connection.commit()
+
+    def Close(self):
+        self.Connection.close()
+
+    def Stale(self, paths):
+    #Files that are new or whose size/mtime moved since they were indexed
+        known = {}
+        for path, size, mtime in self.Connection.execute("SELECT path, size, mtime FROM files"):
+            known[path] = (size, mtime)
+
+        stale = []
+        for p in paths:
+            st = os.stat(p)
+            if known.get(p) != (st.st_size, st.st_mtime):
+                stale.append(p)
+        return stale
+
+    def Store(self, path, digest, animations, error):
+        st = os.stat(path)
+        cur = self.Connection.cursor()
+
+        row = cur.execute("SELECT id, hash FROM files WHERE path = ?", (path,)).fetchone()
+        if row is not None and digest is not None and row[1] == digest:
+            #Touched but not changed
+            cur.execute("UPDATE files SET size = ?, mtime = ?, error = NULL WHERE id = ?", (st.st_size, st.st_mtime, row[0]))
+            return
+        if row is not None:
+            cur.execute("DELETE FROM files WHERE id = ?", (row[0],))
+
+        #Failures are kept for reporting, with a size/mtime no file has, so the next update tries them again
+        size, mtime = (st.st_size, st.st_mtime) if error is None else (-1, -1.0)
+        cur.execute("INSERT INTO files (path, size, mtime, hash, error) VALUES (?, ?, ?, ?, ?)",
+            (path, size, mtime, digest or "", error))
+        file_id = cur.lastrowid
+
+        for slot, (name, duration, tracks) in enumerate(animations):
+            cur.execute("INSERT INTO animations (file_id, slot, name, duration, track_count, key_count) VALUES (?, ?, ?, ?, ?, ?)",
+                (file_id, slot, name, duration, len(tracks), sum(t[6] for t in tracks)))
+            animation_id = cur.lastrowid
+            cur.executemany("INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(animation_id, bone, bone_id, ttype, component, int(absolute), bit_flag, keys) for bone, bone_id, ttype, component, absolute, bit_flag, keys in tracks])
+
+    def Update(self, root, workers = None):
+    #Brings the index in line with the .ema files under root, returns (indexed, removed, failed)
+    #workers=0 parses in this process, which is what to use inside Blender
+        root = os.path.abspath(root)
+        paths = EMAStandalone.FindFiles(root)
+
+        #Drop files that have gone, only looking inside root itself (so /x/chara doesn't reach into /x/chara2)
+        present = set(paths)
+        prefix = root if root.endswith(os.sep) else root + os.sep
+        removed = [p for (p,) in self.Connection.execute("SELECT path FROM files") if p.startswith(prefix) and p not in present]
+        self.Connection.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in removed])
+
+        stale = self.Stale(paths)
+        failed = 0
+
+        if workers == 0 or len(stale) < 2:
+            failed = self.StoreAll(map(ScanFile, stale))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                failed = self.StoreAll(pool.map(ScanFile, stale, chunksize=8))
+
+        self.Connection.commit()
+        return len(stale), len(removed), failed
+
+    def StoreAll(self, results):
+        failed = 0
+        for path, digest, animations, error in results:
+            if error is not None:
+                print("Couldn't index " + path + ": " + error)
+                failed += 1
+            self.Store(path, digest, animations, error)
+        return failed
+
+    def Query(self, sql, params = ()):
+        return self.Connection.execute(sql, params).fetchall()
+
+    def Animations(self, bone = None, transform_type = None, absolute = None, min_duration = None, max_duration = None, name = None):
+    #(path, animation name, duration) for every animation matching all of the given filters
+        sql = "SELECT DISTINCT f.path, a.name, a.duration FROM animations a JOIN files f ON f.id = a.file_id"
+        where = []
+        params = []
+
+        if bone is not None or transform_type is not None or absolute is not None:
+            sql += " JOIN tracks t ON t.animation_id = a.id"
+            if bone is not None:
+                where.append("t.bone = ?")
+                params.append(bone)
+            if transform_type is not None:
+                where.append("t.transform_type = ?")
+                params.append(transform_type)
+            if absolute is not None:
+                where.append("t.absolute = ?")
+                params.append(int(absolute))
+        if min_duration is not None:
+            where.append("a.duration > ?")
+            params.append(min_duration)
+        if max_duration is not None:
+            where.append("a.duration <= ?")
+            params.append(max_duration)
+        if name is not None:
+            where.append("a.name LIKE ?")
+            params.append(name)
+
+        if len(where) > 0:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY f.path, a.slot"
+        return self.Query(sql, params)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Index and query a library of .ema files")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("index", help="Index (or re-index changed) .ema files under a directory")
+    p.add_argument("db")
+    p.add_argument("root")
+    p.add_argument("--workers", type=int, default=None, help="Worker processes, 0 to parse in this process")
+
+    p = commands.add_parser("query", help="List animations matching every given filter")
+    p.add_argument("db")
+    p.add_argument("--bone")
+    p.add_argument("--type", choices=sorted(TRANSFORM_NAMES))
+    p.add_argument("--absolute", action="store_true", default=None)
+    p.add_argument("--relative", dest="absolute", action="store_false")
+    p.add_argument("--min-duration", type=int, help="Longer than this many frames")
+    p.add_argument("--max-duration", type=int)
+    p.add_argument("--name", help="SQL LIKE pattern on the animation name")
+
+    args = parser.parse_args(argv)
+    index = EMAIndex(args.db)
+
+    if args.command == "index":
+        started = time.perf_counter()
+        indexed, removed, failed = index.Update(args.root, args.workers)
+        print("Indexed %d files, removed %d, %d failed, %.1f s" % (indexed, removed, failed, time.perf_counter() - started))
+    else:
+        started = time.perf_counter()
+        rows = index.Animations(args.bone, TRANSFORM_NAMES.get(args.type), args.absolute, args.min_duration, args.max_duration, args.name)
+        for path, name, duration in rows:
+            print("%s\t%s\t%d" % (path, name, duration))
+        print("%d animations, %.1f ms" % (len(rows), (time.perf_counter() - started) * 1000), file=sys.stderr)
+
+    index.Close()
+
+if __name__ == "__main__":
+    main()
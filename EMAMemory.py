@@ -0,0 +1,58 @@
+import sys
+import types
+from collections import Counter
+
+#Rough memory accounting for the Python-side data the add-on keeps: parsed EMA/EMO objects, samplers, pose state
+#Objects are only counted the first time they're reached, so anything shared is charged to whoever asks first
+
+#Never walked into: code, and Blender's own data (which bpy already accounts for)
+OPAQUE_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+
+def IsBlenderData(obj):
+    module = type(obj).__module__ or ""
+    return module.startswith("bpy") or module == "idprop.types"
+
+class MemoryWalker:
+    def __init__(self):
+        self.Seen = set()
+        #Live mathutils objects reached, by type name
+        self.Mathutils = Counter()
+
+    def Size(self, obj):
+    #Bytes reachable from obj that haven't already been counted
+        total = 0
+        stack = [obj]
+        while len(stack) > 0:
+            o = stack.pop()
+            if o is None or id(o) in self.Seen or isinstance(o, OPAQUE_TYPES) or IsBlenderData(o):
+                continue
+            self.Seen.add(id(o))
+            total += sys.getsizeof(o)
+
+            if type(o).__module__ == "mathutils":
+                self.Mathutils[type(o).__name__] += 1
+                continue
+
+            if isinstance(o, dict):
+                for k, v in list(o.items()):
+                    stack.append(k)
+                    stack.append(v)
+            elif isinstance(o, (list, tuple, set, frozenset)):
+                stack.extend(list(o))
+            elif hasattr(o, "nbytes") and hasattr(o, "base"):
+                #NumPy arrays: views hold on to their base, which owns the data
+                stack.append(o.base)
+            else:
+                d = getattr(o, "__dict__", None)
+                if d is not None:
+                    stack.append(d)
+                for slot in getattr(type(o), "__slots__", ()):
+                    stack.append(getattr(o, slot, None))
+        return total
+
+def FormatBytes(n):
+    for unit in ("B", "KB", "MB"):
+        if abs(n) < 1024.0:
+            return "%.1f %s" % (n, unit) if unit != "B" else "%d B" % n
+        n /= 1024.0
+    return "%.1f GB" % n
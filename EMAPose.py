@@ -0,0 +1,241 @@
+import hashlib
+import numpy as np
+
+#Blender-independent version of the SetupFrame/UpdateFrame maths, over whole batches of frames
+#Everything in here works on plain NumPy arrays, so it's safe to run off the main thread
+
+def EulerToQuatArray(euler):
+#Same convention as EulerToQuat, (..., 3) radians -> (..., 4) wxyz
+    half = euler * 0.5
+    sr, sp, sy = np.sin(half[..., 0]), np.sin(half[..., 1]), np.sin(half[..., 2])
+    cr, cp, cy = np.cos(half[..., 0]), np.cos(half[..., 1]), np.cos(half[..., 2])
+
+    q = np.empty(euler.shape[:-1] + (4,), dtype=np.float64)
+    q[..., 0] = cr * cp * cy + sr * sp * sy
+    q[..., 1] = sr * cp * cy - cr * sp * sy
+    q[..., 2] = cr * sp * cy + sr * cp * sy
+    q[..., 3] = cr * cp * sy - sr * sp * cy
+    return q
+
+def QuatMultiplyArray(a, b):
+    aw, ax, ay, az = a[..., 0], a[..., 1], a[..., 2], a[..., 3]
+    bw, bx, by, bz = b[..., 0], b[..., 1], b[..., 2], b[..., 3]
+
+    q = np.empty(np.broadcast(aw, bw).shape + (4,), dtype=np.float64)
+    q[..., 0] = aw * bw - ax * bx - ay * by - az * bz
+    q[..., 1] = aw * bx + ax * bw + ay * bz - az * by
+    q[..., 2] = aw * by - ax * bz + ay * bw + az * bx
+    q[..., 3] = aw * bz + ax * by - ay * bx + az * bw
+    return q
+
+def QuatToMatrixArray(q):
+    w, x, y, z = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+
+    m = np.empty(q.shape[:-1] + (3, 3), dtype=np.float64)
+    m[..., 0, 0] = 1 - 2 * (y * y + z * z)
+    m[..., 0, 1] = 2 * (x * y - w * z)
+    m[..., 0, 2] = 2 * (x * z + w * y)
+    m[..., 1, 0] = 2 * (x * y + w * z)
+    m[..., 1, 1] = 1 - 2 * (x * x + z * z)
+    m[..., 1, 2] = 2 * (y * z - w * x)
+    m[..., 2, 0] = 2 * (x * z - w * y)
+    m[..., 2, 1] = 2 * (y * z + w * x)
+    m[..., 2, 2] = 1 - 2 * (x * x + y * y)
+    return m
+
+def MatrixToQuatArray(r):
+#(..., 3, 3) normalized rotation -> (..., 4) wxyz, branching on the largest diagonal term per matrix
+    r00, r11, r22 = r[..., 0, 0], r[..., 1, 1], r[..., 2, 2]
+    trace = r00 + r11 + r22
+    which = np.argmax(np.stack([trace, r00, r11, r22], axis=-1), axis=-1)
+
+    q = np.empty(r.shape[:-2] + (4,), dtype=np.float64)
+    candidates = (
+        (1.0 + trace, r[..., 2, 1] - r[..., 1, 2], r[..., 0, 2] - r[..., 2, 0], r[..., 1, 0] - r[..., 0, 1]),
+        (r[..., 2, 1] - r[..., 1, 2], 1.0 + r00 - r11 - r22, r[..., 0, 1] + r[..., 1, 0], r[..., 0, 2] + r[..., 2, 0]),
+        (r[..., 0, 2] - r[..., 2, 0], r[..., 0, 1] + r[..., 1, 0], 1.0 - r00 + r11 - r22, r[..., 1, 2] + r[..., 2, 1]),
+        (r[..., 1, 0] - r[..., 0, 1], r[..., 0, 2] + r[..., 2, 0], r[..., 1, 2] + r[..., 2, 1], 1.0 - r00 - r11 + r22),
+    )
+    for i, c in enumerate(candidates):
+        pick = which == i
+        if not pick.any():
+            continue
+        s = 0.5 / np.sqrt(np.maximum(c[i], 1e-12))
+        for j in range(4):
+            q[..., j] = np.where(pick, c[j] * s, q[..., j])
+    return q
+
+def QuatToEulerArray(q):
+#Same convention as euler_from_quaternion, (..., 4) wxyz -> (..., 3) radians
+    w, x, y, z = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+
+    e = np.empty(q.shape[:-1] + (3,), dtype=np.float64)
+    e[..., 0] = np.arctan2(2.0 * (w * x + y * z), 1.0 - 2.0 * (x * x + y * y))
+    e[..., 1] = np.arcsin(np.clip(2.0 * (w * y - z * x), -1.0, 1.0))
+    e[..., 2] = np.arctan2(2.0 * (w * z + x * y), 1.0 - 2.0 * (y * y + z * z))
+    return e
+
+def DecomposeArray(m):
+#Batch version of Matrix.decompose() followed by euler_from_quaternion, (..., 4, 4) -> translation, euler, scale
+    r = m[..., :3, :3]
+    scale = np.linalg.norm(r, axis=-2)
+    #Negative determinants put the flip into the scale, as mathutils does
+    scale = np.where((np.linalg.det(r) < 0)[..., None], -scale, scale)
+    r = r / np.where(scale == 0.0, 1.0, scale)[..., None, :]
+
+    return m[..., :3, 3].copy(), QuatToEulerArray(MatrixToQuatArray(r)), scale
+
+def MatrixArray(m):
+    return np.array([tuple(r) for r in m], dtype=np.float64)
+
+class RestPose:
+#Stand-in for the add-on's PoseState when there's no armature, every node starts at its skeleton rest transform
+    def __init__(self, skeleton):
+        self.Matrix = [n.Matrix for n in skeleton.Nodes]
+        self.LocalMatrix = [n.Matrix for n in skeleton.Nodes]
+        self.Rotation = [n.RotationQuaternion for n in skeleton.Nodes]
+        self.Scale = [n.Scale for n in skeleton.Nodes]
+
+def TrackAbsoluteFlags(animation, node_count):
+#Absolute flags per node as update_action would set them on the pose bones, flattened (node * 3 + transform type)
+    flags = [False] * (node_count * 3)
+    for c in animation.CMDTracks:
+        if (c.BitFlag & 0x10) == 0x10:
+            flags[c.BoneID * 3 + min(c.TransformType, 2)] = True
+    return flags
+
+class PoseTable:
+#Everything about one armature's skeleton and current flags that the batch maths needs, as arrays
+#Built on the main thread, read-only afterwards
+    def __init__(self, ema, pose, absolute, sampler, face = None):
+        nodes = ema.Skeleton.Nodes
+        count = len(nodes)
+
+        self.NodeCount = count
+        self.Parent = np.array([n.Parent for n in nodes], dtype=np.int64)
+        self.Active = np.array([n.BitFlag != 0 for n in nodes], dtype=bool)
+
+        #Absolute translation/rotation/scale flags, (NodeCount, 3)
+        self.Absolute = np.array(absolute, dtype=bool).reshape(count, 3)
+
+        self.RestQuat = np.array([tuple(n.RotationQuaternion) for n in nodes], dtype=np.float64)
+        #Without a sampler (curves evaluated by the caller), any non-zero euler counts as keyed, as in SetupFrame
+        if sampler is not None:
+            self.Keyed = sampler.RotationKeyed.copy()
+        else:
+            self.Keyed = np.ones(count, dtype=bool)
+
+        #Nodes the frame never touches keep whatever the armature's pose already holds
+        self.ConstMatrix = np.array([MatrixArray(m) for m in pose.Matrix], dtype=np.float64)
+        self.ConstLocal = np.array([MatrixArray(m) for m in pose.LocalMatrix], dtype=np.float64)
+        self.ConstQuat = np.array([tuple(q) for q in pose.Rotation], dtype=np.float64)
+        self.ConstScale = np.array([tuple(s) for s in pose.Scale], dtype=np.float64)
+
+        #Face layer overrides
+        self.FaceBody = np.zeros(0, dtype=np.int64)
+        self.FaceNodes = np.zeros(0, dtype=np.int64)
+        if face is not None and len(face.Nodes) > 0:
+            self.FaceBody = np.array([bi for bi, fi in face.Nodes], dtype=np.int64)
+            self.FaceNodes = np.array([fi for bi, fi in face.Nodes], dtype=np.int64)
+            face_nodes = face.FaceEMA.Skeleton.Nodes
+            self.RestQuat[self.FaceBody] = [tuple(face_nodes[fi].RotationQuaternion) for fi in self.FaceNodes]
+            self.Keyed[self.FaceBody] = face.Sampler.RotationKeyed[self.FaceNodes]
+            self.Active[self.FaceBody] = True
+            self.Absolute[self.FaceBody] = [face.Absolute[bi] for bi in self.FaceBody]
+        self.ActiveNodes = [int(i) for i in np.nonzero(self.Active)[0]]
+
+        #Fingerprint of the armature's own pose baked in above, only for the nodes the frame doesn't overwrite
+        inactive = ~self.Active
+        h = hashlib.sha1()
+        for a in (self.ConstMatrix, self.ConstLocal, self.ConstQuat, self.ConstScale):
+            h.update(np.ascontiguousarray(a[inactive]).tobytes())
+        self.ConstHash = h.hexdigest()
+
+        #Group the animated nodes by depth, so each level composes against already finished parents
+        depth = np.zeros(count, dtype=np.int64)
+        for i in range(count):
+            d = 0
+            p = self.Parent[i]
+            while p != -1 and d <= count:
+                d += 1
+                p = self.Parent[p]
+            depth[i] = d
+        self.Levels = []
+        for d in range(int(depth.max()) + 1 if count > 0 else 0):
+            level = np.nonzero(self.Active & (depth == d))[0]
+            if len(level) > 0:
+                self.Levels.append(level)
+
+def SampleFrames(table, sampler, frames, face_sampler = None):
+#Per-node translation, rotation quaternion and scale for each frame, (F, N, 3/4/3)
+#Body tracks on nodes the face layer provides are left out, LayerFrames fills those in
+    tracks = None
+    if face_sampler is not None and len(table.FaceBody) > 0:
+        override = np.zeros(table.NodeCount, dtype=bool)
+        override[table.FaceBody] = True
+        tracks = sampler.TracksExcept(override)
+    T, E, S = sampler.SampleNodesRange(frames, tracks)
+    return LayerFrames(table, T, E, S, frames, face_sampler)
+
+def LayerFrames(table, T, E, S, frames, face_sampler = None):
+#Lays the face tracks over sampled body channels and picks each node's rotation, euler where keyed, rest otherwise
+    if face_sampler is not None and len(table.FaceBody) > 0:
+        Tf, Ef, Sf = face_sampler.SampleNodesRange(frames)
+        T[:, table.FaceBody] = Tf[:, table.FaceNodes]
+        E[:, table.FaceBody] = Ef[:, table.FaceNodes]
+        S[:, table.FaceBody] = Sf[:, table.FaceNodes]
+
+    use_euler = table.Keyed[None, :] & np.any(E != 0.0, axis=-1)
+    Q = np.where(use_euler[..., None], EulerToQuatArray(E), table.RestQuat[None, :, :])
+    return T, Q, S
+
+def ComposeFrames(table, T, Q, S):
+#The UpdateFrame hierarchy pass, one depth level at a time
+#Returns armature-space and parent-local matrices, each (F, N, 4, 4)
+    frames = T.shape[0]
+
+    W = np.broadcast_to(table.ConstMatrix, (frames,) + table.ConstMatrix.shape).copy()
+    L = np.broadcast_to(table.ConstLocal, (frames,) + table.ConstLocal.shape).copy()
+    Qw = np.broadcast_to(table.ConstQuat, (frames,) + table.ConstQuat.shape).copy()
+    Sw = np.broadcast_to(table.ConstScale, (frames,) + table.ConstScale.shape).copy()
+
+    for level in table.Levels:
+        t = T[:, level]
+        q = Q[:, level]
+        s = S[:, level]
+
+        parents = table.Parent[level]
+        has_parent = parents != -1
+        if has_parent.any():
+            p = np.where(has_parent, parents, 0)
+            Wp = W[:, p]
+            absolute = table.Absolute[level]
+
+            inherit = (has_parent & ~absolute[:, 0])[None, :, None]
+            t = np.where(inherit, np.einsum('fnij,fnj->fni', Wp[..., :3, :3], t) + Wp[..., :3, 3], t)
+
+            inherit = (has_parent & ~absolute[:, 1])[None, :, None]
+            q = np.where(inherit, QuatMultiplyArray(Qw[:, p], q), q)
+
+            inherit = (has_parent & ~absolute[:, 2])[None, :, None]
+            s = np.where(inherit, s * np.round(Sw[:, p], 6), s)
+
+        M = np.zeros((frames, len(level), 4, 4), dtype=np.float64)
+        M[..., :3, :3] = QuatToMatrixArray(q) * s[..., None, :]
+        M[..., :3, 3] = t
+        M[..., 3, 3] = 1.0
+
+        local = M.copy()
+        if has_parent.any():
+            local[:, has_parent] = np.linalg.inv(Wp[:, has_parent]) @ M[:, has_parent]
+
+        W[:, level] = M
+        L[:, level] = local
+        Qw[:, level] = q
+        Sw[:, level] = s
+
+    return W, L
+
+def EvaluateFrames(table, sampler, frames, face_sampler = None):
+    T, Q, S = SampleFrames(table, sampler, frames, face_sampler)
+    return ComposeFrames(table, T, Q, S)
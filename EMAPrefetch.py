@@ -0,0 +1,125 @@
+import threading
+
+from .EMAPose import EvaluateFrames
+
+#Evaluates upcoming frames on a worker thread during playback, so the frame handler only has to write the pose back
+#Only plain arrays cross over to the worker, nothing in here touches bpy
+
+#How many frames ahead of the displayed one to keep ready
+PREFETCH_DEPTH = 8
+
+class PosePrefetcher:
+    def __init__(self, depth = PREFETCH_DEPTH):
+        self.Depth = depth
+        self.Condition = threading.Condition()
+        #frame -> (armature-space matrices, local matrices), never more than Depth entries
+        self.Frames = {}
+        #(key, table, sampler, face sampler, frame start, frame end) the frames belong to
+        self.Job = None
+        #First frame after the one last displayed
+        self.Next = None
+        self.Stopped = False
+        self.Thread = None
+        self.Hits = 0
+        self.Misses = 0
+
+    def Following(self, job, frame):
+    #Playback wraps from the end of the range back to the start
+        start, end = job[4], job[5]
+        if frame < start or frame >= end:
+            return start
+        return frame + 1
+
+    def Window(self, job):
+    #The frames the worker should have ready, in playback order
+        frames = []
+        f = self.Next
+        for i in range(min(self.Depth, job[5] - job[4] + 1)):
+            frames.append(f)
+            f = self.Following(job, f)
+        return frames
+
+    def Fetch(self, key, frame):
+    #Takes the prefetched frame if it's ready, None if the job has changed or the frame isn't there yet
+        with self.Condition:
+            job = self.Job
+            if job is None or job[0] != key:
+                return None
+
+            result = self.Frames.pop(frame, None)
+            if result is None:
+                #Seeked somewhere the worker wasn't looking
+                self.Misses += 1
+                self.Frames.clear()
+            else:
+                self.Hits += 1
+
+            self.Next = self.Following(job, frame)
+            window = set(self.Window(job))
+            for f in [f for f in self.Frames if f not in window]:
+                del self.Frames[f]
+
+            self.Condition.notify()
+            return result
+
+    def Schedule(self, key, table, sampler, face_sampler, frame_start, frame_end, frame):
+    #Points the worker at a new animation/flag set, dropping anything prefetched for the old one
+        with self.Condition:
+            self.Job = (key, table, sampler, face_sampler, frame_start, frame_end)
+            self.Frames.clear()
+            self.Next = self.Following(self.Job, frame)
+
+            if self.Thread is None:
+                self.Thread = threading.Thread(target=self.Run, name="USF4 pose prefetch", daemon=True)
+                self.Thread.start()
+            self.Condition.notify()
+
+    def Invalidate(self):
+        with self.Condition:
+            self.Job = None
+            self.Frames.clear()
+
+    def Stop(self):
+        with self.Condition:
+            self.Stopped = True
+            self.Job = None
+            self.Frames.clear()
+            self.Condition.notify()
+        if self.Thread is not None:
+            self.Thread.join(1.0)
+            self.Thread = None
+
+    def Pending(self):
+    #Frames in the window that still need evaluating, empty when there's nothing to do
+        if self.Job is None:
+            return []
+        return [f for f in self.Window(self.Job) if f not in self.Frames]
+
+    def Run(self):
+        while True:
+            with self.Condition:
+                while not self.Stopped and len(self.Pending()) == 0:
+                    self.Condition.wait()
+                if self.Stopped:
+                    return
+                job = self.Job
+                frames = self.Pending()
+
+            key, table, sampler, face_sampler = job[0:4]
+            try:
+                W, L = EvaluateFrames(table, sampler, frames, face_sampler)
+            except Exception as e:
+                print("Pose prefetch failed for " + str(key[0]) + ": " + str(e))
+                with self.Condition:
+                    if self.Job is job:
+                        self.Job = None
+                continue
+
+            with self.Condition:
+                #The main thread may have moved on (or switched job) while we were working
+                if self.Job is not job:
+                    continue
+                window = set(self.Window(job))
+                for k, f in enumerate(frames):
+                    if f in window:
+                        self.Frames[f] = (W[k], L[k])
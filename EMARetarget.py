@@ -0,0 +1,327 @@
+import sys
+import json
+import hashlib
+import argparse
+import numpy as np
+
+try:
+    from . import EMAStandalone
+    from .EMATracks import BuildValueList
+    from .EMAPose import MatrixArray, MatrixToQuatArray, EulerToQuatArray, QuatMultiplyArray, QuatToEulerArray
+    from .EMASampler import TrackSampler
+except ImportError:
+    import EMAStandalone
+    from EMATracks import BuildValueList
+    from EMAPose import MatrixArray, MatrixToQuatArray, EulerToQuatArray, QuatMultiplyArray, QuatToEulerArray
+    from EMASampler import TrackSampler
+
+#Retargets EMA animations from one character's skeleton onto another's
+#Bones are matched by name (plus optional aliases), and relative translation keys are scaled by the ratio of the
+#two skeletons' bind-pose bone lengths, taken from the SBP matrices. Rotations get a rest-pose correction from the
+#same bind poses, so each bone moves away from its target bind pose the way the source bone moved away from its own.
+#EMA rotations are per-component euler tracks, so a bone whose correction isn't the identity has its three
+#components resampled onto every frame of its keyed range and converted together; the rest carry over as they are.
+#Absolute translation keys are armature-space positions rather than offsets along the bone, so they aren't scaled
+#
+#Command line:
+#   python EMARetarget.py source.ema target.ema out.ema --source-emo source.emo --target-emo target.emo
+#   python EMARetarget.py source.ema target.ema out.ema --animation 5LP --animation 5MP --map bones.json
+
+#Bones shorter than this in the source keep their translation keys as they are
+MIN_BONE_LENGTH = 1e-6
+
+#Corrections closer to the identity than this (1 - |w|) leave a bone's rotation tracks alone
+MIN_CORRECTION = 1e-9
+
+IDENTITY_QUAT = np.array([1.0, 0.0, 0.0, 0.0])
+
+#(source skeleton key, target skeleton key, aliases) -> BoneMap
+bone_map_cache = {}
+
+def SkeletonKey(skeleton):
+    h = hashlib.sha1()
+    for n in skeleton.Nodes:
+        h.update(("%s:%d;" % (n.Name, n.Parent)).encode('utf-8'))
+        h.update(MatrixArray(n.SBPMatrix).tobytes())
+    return h.hexdigest()
+
+def BindMatrices(skeleton):
+#Each node's bind pose in armature space and relative to its parent, (N, 4, 4) each
+#SBP matrices are inverse bind matrices in the reader's column-vector layout, as AssignMatrices uses them:
+#a parent's SBPMatrix.inverted() is its bind matrix
+    sbp = np.array([MatrixArray(n.SBPMatrix) for n in skeleton.Nodes], dtype=np.float64).reshape(-1, 4, 4)
+    world = np.linalg.inv(sbp)
+    local = world.copy()
+    for i, n in enumerate(skeleton.Nodes):
+        if n.Parent != -1:
+            local[i] = sbp[n.Parent] @ world[i]
+    return world, local
+
+def RotationQuats(m):
+#Rotation part of (..., 4, 4) matrices that may carry scale, as wxyz quaternions
+    r = m[..., :3, :3]
+    length = np.linalg.norm(r, axis=-2)
+    return MatrixToQuatArray(r / np.where(length > 0.0, length, 1.0)[..., None, :])
+
+def QuatInverseArray(q):
+    return q * np.array([1.0, -1.0, -1.0, -1.0])
+
+def IsIdentityQuat(q):
+    return np.abs(q[..., 0]) >= 1.0 - MIN_CORRECTION
+
+class BoneMap:
+    def __init__(self, source, target, aliases = None):
+        aliases = aliases or {}
+        target_ids = {}
+        for i, n in enumerate(target.Nodes):
+            target_ids.setdefault(n.Name, i)
+
+        count = len(source.Nodes)
+        #Target node index for each source node, -1 where the target has no match
+        self.Target = np.array([target_ids.get(aliases.get(n.Name, n.Name), -1) for n in source.Nodes], dtype=np.int64)
+
+        source_world, source_local = BindMatrices(source)
+        target_world, target_local = BindMatrices(target)
+
+        self.TranslationScale = np.ones(count, dtype=np.float64)
+        #Rest-pose correction per source bone: target rotation = Pre * source rotation * Post, wxyz
+        #Relative rotations take RotationPre/RotationPost, absolute (armature-space) ones just AbsolutePost
+        self.RotationPre = np.broadcast_to(IDENTITY_QUAT, (count, 4)).copy()
+        self.RotationPost = np.broadcast_to(IDENTITY_QUAT, (count, 4)).copy()
+        self.AbsolutePost = np.broadcast_to(IDENTITY_QUAT, (count, 4)).copy()
+
+        mapped = np.nonzero(self.Target != -1)[0]
+        if len(mapped) > 0:
+            targets = self.Target[mapped]
+            src = source_local[mapped]
+            dst = target_local[targets]
+            src_length = np.linalg.norm(src[:, :3, 3], axis=1)
+            dst_length = np.linalg.norm(dst[:, :3, 3], axis=1)
+            usable = src_length > MIN_BONE_LENGTH
+            self.TranslationScale[mapped] = np.where(usable, dst_length / np.where(usable, src_length, 1.0), 1.0)
+
+            #Keeping each bone's armature-space rotation relative to its bind pose the same on both skeletons gives
+            #target local = C * source local * inverse(source bind local) * inverse(C) * target bind local,
+            #where C takes the source parent's bind rotation to the target parent's
+            world_s = RotationQuats(source_world)
+            world_t = RotationQuats(target_world)
+            local_s = RotationQuats(src)
+            local_t = RotationQuats(dst)
+
+            parent_s = np.array([source.Nodes[i].Parent for i in mapped], dtype=np.int64)
+            parent_t = np.array([target.Nodes[i].Parent for i in targets], dtype=np.int64)
+            bind_s = np.where((parent_s != -1)[:, None], world_s[np.maximum(parent_s, 0)], IDENTITY_QUAT)
+            bind_t = np.where((parent_t != -1)[:, None], world_t[np.maximum(parent_t, 0)], IDENTITY_QUAT)
+            C = QuatMultiplyArray(QuatInverseArray(bind_t), bind_s)
+
+            self.RotationPre[mapped] = C
+            self.RotationPost[mapped] = QuatMultiplyArray(QuatMultiplyArray(QuatInverseArray(local_s), QuatInverseArray(C)), local_t)
+            self.AbsolutePost[mapped] = QuatMultiplyArray(QuatInverseArray(world_s[mapped]), world_t[targets])
+
+        self.Corrected = ~(IsIdentityQuat(self.RotationPre) & IsIdentityQuat(self.RotationPost))
+        self.AbsoluteCorrected = ~IsIdentityQuat(self.AbsolutePost)
+
+        self.Mapped = len(mapped)
+        self.Unmapped = [source.Nodes[i].Name for i in np.nonzero(self.Target == -1)[0]]
+
+def GetBoneMap(source, target, aliases = None):
+    key = (SkeletonKey(source), SkeletonKey(target), tuple(sorted((aliases or {}).items())))
+    bone_map = bone_map_cache.get(key)
+    if bone_map is None:
+        bone_map = BoneMap(source, target, aliases)
+        bone_map_cache[key] = bone_map
+    return bone_map
+
+def CorrectedRotations(animation, bone_map):
+#Source nodes whose rotation tracks need the rest correction, node -> whether they're absolute
+    absolute = {}
+    for c in animation.CMDTracks:
+        if c.TransformType == 1 and c.StepCount > 0 and bone_map.Target[c.BoneID] != -1:
+            absolute[c.BoneID] = absolute.get(c.BoneID, False) or (c.BitFlag & 0x10) == 0x10
+    return {i: a for i, a in absolute.items() if (bone_map.AbsoluteCorrected if a else bone_map.Corrected)[i]}
+
+def ResampleRotations(animation, skeleton, bone_map, corrected):
+#Corrected rotations of the corrected nodes, sampled on every frame of each node's keyed range, all nodes in one batch
+#Returns node -> (steps, (len(steps), 3) euler degrees)
+    first = {}
+    last = {}
+    for c in animation.CMDTracks:
+        if c.TransformType == 1 and c.BoneID in corrected and c.StepCount > 0:
+            first[c.BoneID] = min(first.get(c.BoneID, c.StepsList[0]), min(c.StepsList[:c.StepCount]))
+            last[c.BoneID] = max(last.get(c.BoneID, c.StepsList[0]), max(c.StepsList[:c.StepCount]))
+
+    nodes = np.array(sorted(corrected), dtype=np.int64)
+    frames = np.arange(min(first.values()), max(last.values()) + 1)
+    T, E, S = TrackSampler(animation, skeleton).SampleNodesRange(frames)
+
+    #As LayerFrames picks it: the euler where any component is non-zero, the rest rotation otherwise
+    euler = E[:, nodes]
+    rest = np.array([tuple(skeleton.Nodes[i].RotationQuaternion) for i in nodes], dtype=np.float64)
+    q = np.where(np.any(euler != 0.0, axis=-1)[..., None], EulerToQuatArray(euler), rest[None])
+
+    absolute = np.array([corrected[i] for i in nodes], dtype=bool)[:, None]
+    pre = np.where(absolute, IDENTITY_QUAT, bone_map.RotationPre[nodes])
+    post = np.where(absolute, bone_map.AbsolutePost[nodes], bone_map.RotationPost[nodes])
+    q = QuatMultiplyArray(QuatMultiplyArray(pre[None], q), post[None])
+    #Unwrapped so the keys don't jump a full turn between frames
+    euler = np.degrees(np.unwrap(QuatToEulerArray(q), axis=0))
+
+    resampled = {}
+    for k, i in enumerate(nodes.tolist()):
+        keep = (frames >= first[i]) & (frames <= last[i])
+        resampled[i] = (frames[keep].tolist(), euler[keep, k])
+    return resampled
+
+def RetargetAnimation(animation, skeleton, bone_map, reader):
+#New Animation for the target skeleton, with every track's values converted in one pass
+#skeleton is the source skeleton the animation plays on
+    corrected = CorrectedRotations(animation, bone_map)
+    resampled = ResampleRotations(animation, skeleton, bone_map, corrected) if len(corrected) > 0 else {}
+
+    tracks = []
+    rotations = []
+    seen = set()
+    for c in animation.CMDTracks:
+        target_id = int(bone_map.Target[c.BoneID])
+        if target_id == -1:
+            continue
+        #Corrected rotations replace all of the bone's rotation tracks with three resampled ones
+        if c.TransformType == 1 and c.BoneID in resampled:
+            slots = [(target_id, 1, k) for k in range(3)]
+            if not any(slot in seen for slot in slots):
+                seen.update(slots)
+                rotations.append((c.BoneID, target_id))
+            continue
+        slot = (target_id, c.TransformType, c.BitFlag & 0x03)
+        #Two source bones aliased onto one target bone, the first one wins
+        if slot in seen:
+            continue
+        seen.add(slot)
+        tracks.append((c, target_id))
+
+    counts = np.array([c.StepCount for c, t in tracks], dtype=np.int64)
+    offsets = np.zeros(len(tracks) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    values = np.asarray(animation.ValueList, dtype=np.float64)
+    value_ids = np.array([i for c, t in tracks for i in c.ValueIndicesList[:c.StepCount]], dtype=np.int64)
+    tangent_ids = np.array([i for c, t in tracks for i in c.TangentIndicesList[:c.StepCount]], dtype=np.int64)
+
+    #Only relative translation tracks are offsets along the bone
+    scale = np.array([bone_map.TranslationScale[c.BoneID] if c.TransformType == 0 and (c.BitFlag & 0x10) == 0 else 1.0 for c, t in tracks], dtype=np.float64)
+    scale = np.repeat(scale, counts)
+
+    new_values = (values[value_ids] * scale).tolist() if len(value_ids) > 0 else []
+    has_tangent = tangent_ids != -1
+    new_tangents = np.where(has_tangent, values[np.where(has_tangent, tangent_ids, 0)] * scale, 0.0).tolist() if len(tangent_ids) > 0 else []
+    has_tangent = has_tangent.tolist()
+
+    cmds = []
+    for k, (c, target_id) in enumerate(tracks):
+        o, e = int(offsets[k]), int(offsets[k + 1])
+        t = reader.CMDTrack()
+        t.BoneID = target_id
+        t.TransformType = c.TransformType
+        #BuildValueList sets the index width again
+        t.BitFlag = c.BitFlag & ~0x40
+        t.StepCount = c.StepCount
+        t.StepsList = list(c.StepsList[:c.StepCount])
+        t.ValueStorage = new_values[o:e]
+        t.TangentStorage = [new_tangents[j] if has_tangent[j] else None for j in range(o, e)]
+        t.IndicesList = []
+        cmds.append(t)
+
+    for node, target_id in rotations:
+        steps, euler = resampled[node]
+        for k in range(3):
+            t = reader.CMDTrack()
+            t.BoneID = target_id
+            t.TransformType = 1
+            t.BitFlag = k | (0x10 if corrected[node] else 0x00)
+            t.StepCount = len(steps)
+            t.StepsList = list(steps)
+            t.ValueStorage = euler[:, k].tolist()
+            #A key on every frame, so the collapsed handles of keys without a tangent are all the shape needs
+            t.TangentStorage = [None] * len(steps)
+            t.IndicesList = []
+            cmds.append(t)
+
+    cmds.sort(key=lambda t: (t.TransformType, t.BoneID))
+    cmds, value_list = BuildValueList(cmds)
+
+    a = reader.Animation()
+    a.Name = animation.Name
+    a.Duration = animation.Duration
+    a.CMDTracks = cmds
+    a.CMDTrackCount = len(cmds)
+    a.ValueList = value_list
+    a.ValueCount = len(value_list)
+    a.CMDTrackPointerList = []
+    return a
+
+def RetargetEMA(source, target, names = None, aliases = None, reader = None):
+#Retargets source's animations (all, or just names) into target, replacing same-named ones, returns the names written
+    reader = reader or EMAStandalone.LoadModule("EMAReader")
+    bone_map = GetBoneMap(source.Skeleton, target.Skeleton, aliases)
+
+    written = []
+    for a in source.Animations:
+        if names is not None and a.Name not in names:
+            continue
+        converted = RetargetAnimation(a, source.Skeleton, bone_map, reader)
+
+        for i in range(len(target.Animations)):
+            if target.Animations[i].Name == a.Name:
+                target.Animations[i] = converted
+                break
+        else:
+            target.Animations.append(converted)
+            target.AnimationCount += 1
+            target.AnimationPointers.append(0)
+        written.append(a.Name)
+
+    return written
+
+def ApplySBP(ema, emo):
+#Same as the add-on's pass_isbp_data: bind matrices come from the .emo, matched by name
+    ids = {n.Name: i for i, n in enumerate(ema.Skeleton.Nodes)}
+    for n in emo.Skeleton.Nodes:
+        i = ids.get(n.Name)
+        if i is not None:
+            ema.Skeleton.Nodes[i].SBPMatrix = n.SBPMatrix.copy()
+
+def RetargetFile(source_path, target_path, out_path, source_emo = None, target_emo = None, names = None, aliases = None):
+    source, data = EMAStandalone.ReadEMA(source_path)
+    target, data = EMAStandalone.ReadEMA(target_path)
+    if source_emo is not None:
+        ApplySBP(source, EMAStandalone.ReadEMO(source_emo))
+    if target_emo is not None:
+        ApplySBP(target, EMAStandalone.ReadEMO(target_emo))
+
+    written = RetargetEMA(source, target, names, aliases)
+    target.Write(out_path)
+    return written, GetBoneMap(source.Skeleton, target.Skeleton, aliases)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Retarget EMA animations onto another character's skeleton")
+    parser.add_argument("source", help=".ema to take animations from")
+    parser.add_argument("target", help=".ema whose skeleton the animations are converted to")
+    parser.add_argument("out", help="Where to write the target .ema with the converted animations")
+    parser.add_argument("--source-emo", help=".emo with the source skeleton's bind matrices")
+    parser.add_argument("--target-emo", help=".emo with the target skeleton's bind matrices")
+    parser.add_argument("--animation", action="append", help="Only retarget this animation (repeatable)")
+    parser.add_argument("--map", help="JSON object of source bone name -> target bone name, for bones named differently")
+    args = parser.parse_args(argv)
+
+    aliases = None
+    if args.map is not None:
+        with open(args.map) as f:
+            aliases = json.load(f)
+
+    written, bone_map = RetargetFile(args.source, args.target, args.out, args.source_emo, args.target_emo, args.animation, aliases)
+    print("Retargeted %d animations, %d bones mapped" % (len(written), bone_map.Mapped))
+    if len(bone_map.Unmapped) > 0:
+        print("No target bone for: " + ", ".join(bone_map.Unmapped), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
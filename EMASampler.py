@@ -0,0 +1,225 @@
+import math
+import itertools
+import numpy as np
+
+#Native sampler for EMA CMD tracks, so animations can be evaluated without going through Blender fcurves
+#Each segment is a Bezier between two keys' handles. From the tracks alone, keys with a tangent get handles a third of
+#the way along the segment on either side and keys without one get handles collapsed onto the key, which is what
+#LoadAnimationData asks for. Blender re-aligns one of those ALIGNED handles whenever the two sides' slopes differ,
+#so inside Blender the handles are taken from the action's own curves instead
+
+#Channel layout of the per-node sample arrays: translation xyz, rotation xyz (euler, radians), scale xyz
+CHANNELS_PER_NODE = 9
+
+#Enough bisection steps to pin the curve parameter down past float32 precision
+BISECT_STEPS = 24
+
+class TrackSampler:
+    #Every sampler gets its own number, so caches can tell a new one apart from one it replaced
+    Generations = itertools.count()
+
+    def __init__(self, animation, skeleton, curves = None):
+    #curves optionally maps (BoneID, TransformType, component) to the flat co, handle_left and handle_right of that track's fcurve
+        tracks = [c for c in animation.CMDTracks if c.StepCount > 0]
+        values = animation.ValueList
+
+        self.Generation = next(TrackSampler.Generations)
+        self.Name = animation.Name
+        self.Duration = animation.Duration
+        self.NodeCount = len(skeleton.Nodes)
+        self.TrackCount = len(tracks)
+
+        self.TrackNode = np.array([c.BoneID for c in tracks], dtype=np.int64)
+        self.TrackChannel = np.array([c.TransformType * 3 + (c.BitFlag & 0x03) for c in tracks], dtype=np.int64)
+        self.TrackAbsolute = np.array([(c.BitFlag & 0x10) == 0x10 for c in tracks], dtype=bool)
+        self.TrackType = np.array([c.TransformType for c in tracks], dtype=np.int64)
+
+        counts = np.array([c.StepCount for c in tracks], dtype=np.int64)
+        self.Offsets = np.zeros(self.TrackCount + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.Offsets[1:])
+        self.Counts = counts
+
+        #Pack every track's keys into flat arrays
+        key_count = int(self.Offsets[-1])
+        self.Steps = np.zeros(key_count, dtype=np.float64)
+        self.Values = np.zeros(key_count, dtype=np.float64)
+        #Handles as (x, y) per key, left and right
+        self.Left = np.zeros((key_count, 2), dtype=np.float64)
+        self.Right = np.zeros((key_count, 2), dtype=np.float64)
+        self.KeyTrack = np.repeat(np.arange(self.TrackCount, dtype=np.int64), counts)
+
+        for t, c in enumerate(tracks):
+            o = int(self.Offsets[t])
+            n = c.StepCount
+            keys = slice(o, o + n)
+            curve = None
+            if curves is not None:
+                curve = curves.get((c.BoneID, c.TransformType, c.BitFlag & 0x03))
+            if curve is not None and len(curve[0]) == n * 2:
+                co, left, right = (np.asarray(a, dtype=np.float64).reshape(n, 2) for a in curve)
+                self.Steps[keys] = co[:, 0]
+                self.Values[keys] = co[:, 1]
+                self.Left[keys] = left
+                self.Right[keys] = right
+                continue
+
+            scale = math.pi / 180 if c.TransformType == 1 else 1.0
+            for j in range(n):
+                self.Steps[o + j] = c.StepsList[j]
+                self.Values[o + j] = values[c.ValueIndicesList[j]] * scale
+            self.Left[keys, 0] = self.Right[keys, 0] = self.Steps[keys]
+            self.Left[keys, 1] = self.Right[keys, 1] = self.Values[keys]
+            for j in range(n):
+                #The loader can only bake a tangent when there's a following key to measure it against
+                if c.TangentIndicesList[j] != -1 and j < n - 1:
+                    tangent = values[c.TangentIndicesList[j]] * scale
+                    self.Right[o + j] += ((self.Steps[o + j + 1] - self.Steps[o + j]) / 3.0, tangent / 3.0)
+                    if j > 0:
+                        self.Left[o + j] -= ((self.Steps[o + j] - self.Steps[o + j - 1]) / 3.0, tangent / 3.0)
+
+        #Offset each track's steps into its own band, so one searchsorted covers every track
+        if key_count > 0:
+            self.StepMin = self.Steps.min()
+            self.Band = self.Steps.max() - self.StepMin + 2.0
+        else:
+            self.StepMin = 0.0
+            self.Band = 2.0
+        self.BandedSteps = (self.Steps - self.StepMin) + self.KeyTrack * self.Band
+
+        #First and last usable segment start per track, single-key tracks just hold their value
+        self.SegFirst = self.Offsets[:-1].copy()
+        self.SegLast = np.maximum(self.Offsets[1:] - 2, self.SegFirst)
+        self.Single = counts < 2
+        self.NextKey = (~self.Single).astype(np.int64)
+
+        #Per-track segment cursor for sequential playback
+        self.Cursor = self.SegFirst.copy()
+
+        #Rest transform for everything the tracks don't touch
+        self.Rest = np.zeros((self.NodeCount, CHANNELS_PER_NODE), dtype=np.float64)
+        for i, n in enumerate(skeleton.Nodes):
+            self.Rest[i, 0:3] = tuple(n.Translation)
+            self.Rest[i, 6:9] = tuple(n.Scale)
+
+        self.NodeAnimated = np.zeros(self.NodeCount, dtype=bool)
+        self.NodeAnimated[self.TrackNode] = True
+        self.RotationKeyed = np.zeros(self.NodeCount, dtype=bool)
+        self.RotationKeyed[self.TrackNode[self.TrackType == 1]] = True
+        self.FlatIndex = self.TrackNode * CHANNELS_PER_NODE + self.TrackChannel
+
+    def Locate(self, frames, tracks):
+    #Binary search for the segment holding each (frame, track) pair
+        q = np.clip(frames - self.StepMin, 0.0, self.Band - 1.0) + tracks * self.Band
+        seg = np.searchsorted(self.BandedSteps, q, side='right') - 1
+        return np.clip(seg, self.SegFirst[tracks], self.SegLast[tracks])
+
+    def TracksExcept(self, skip):
+    #Indices of the tracks whose node isn't flagged in skip (NodeCount,), for nodes another layer provides
+        return np.nonzero(~np.asarray(skip, dtype=bool)[self.TrackNode])[0]
+
+    def Advance(self, frame, tracks = None):
+    #Moves the cursors of tracks (all of them by default) to frame, checking the current and next segment before falling back to a search
+        if tracks is None:
+            tracks = np.arange(self.TrackCount, dtype=np.int64)
+        seg = self.Cursor[tracks]
+        first = self.SegFirst[tracks]
+        last = self.SegLast[tracks]
+        for step in (0, 1):
+            cand = np.minimum(seg + step, last)
+            ok = ((self.Steps[cand] <= frame) | (cand == first)) & ((self.Steps[cand + self.NextKey[tracks]] > frame) | (cand == last))
+            if ok.all():
+                self.Cursor[tracks] = cand
+                return cand
+            if step == 0:
+                hit = ok
+                found = cand.copy()
+            else:
+                found = np.where(hit, found, cand)
+                hit = hit | ok
+        miss = ~hit
+        found[miss] = self.Locate(np.full(miss.sum(), float(frame)), tracks[miss])
+        self.Cursor[tracks] = found
+        return found
+
+    def Evaluate(self, frames, seg):
+    #Evaluates the Bezier segment starting at key seg for each frame, as Blender evaluates a Bezier fcurve
+        nxt = seg + self.NextKey[self.KeyTrack[seg]]
+        x0 = self.Steps[seg]
+        x1 = self.Steps[nxt]
+        y0 = self.Values[seg]
+        y1 = self.Values[nxt]
+        length = x1 - x0
+
+        #Handles reaching past the other key are scaled back to it, so the curve can't rewind (BKE_fcurve_correct_bezpart)
+        h1 = np.stack([x0, y0], axis=-1) - self.Right[seg]
+        h2 = np.stack([x1, y1], axis=-1) - self.Left[nxt]
+        reach1 = np.abs(h1[:, 0])
+        reach2 = np.abs(h2[:, 0])
+        fac1 = np.where(reach1 > length, length / np.where(reach1 > 0.0, reach1, 1.0), 1.0)
+        fac2 = np.where(reach2 > length, length / np.where(reach2 > 0.0, reach2, 1.0), 1.0)
+        x2 = x0 - fac1 * h1[:, 0]
+        y2 = y0 - fac1 * h1[:, 1]
+        x3 = x1 - fac2 * h2[:, 0]
+        y3 = y1 - fac2 * h2[:, 1]
+
+        q = np.clip(frames, x0, x1)
+        #Handles at thirds make x linear in the curve parameter, otherwise x(t) is inverted by bisection
+        t = (q - x0) / np.where(length > 0.0, length, 1.0)
+        third = length / 3.0
+        solve = (np.abs(x2 - x0 - third) > 1e-6 * length) | (np.abs(x1 - x3 - third) > 1e-6 * length)
+        if solve.any():
+            qs = q[solve]
+            a0, a1, a2, a3 = x0[solve], x2[solve], x3[solve], x1[solve]
+            lo = np.zeros_like(qs)
+            hi = np.ones_like(qs)
+            for i in range(BISECT_STEPS):
+                mid = (lo + hi) * 0.5
+                im = 1.0 - mid
+                x = im * im * im * a0 + 3.0 * im * im * mid * a1 + 3.0 * im * mid * mid * a2 + mid * mid * mid * a3
+                below = x < qs
+                lo = np.where(below, mid, lo)
+                hi = np.where(below, hi, mid)
+            t[solve] = (lo + hi) * 0.5
+
+        it = 1.0 - t
+        return it * it * it * y0 + 3.0 * it * it * t * y2 + 3.0 * it * t * t * y3 + t * t * t * y1
+
+    def SampleTracks(self, frame, tracks = None):
+    #Value of each of tracks (all of them by default) at frame
+        if tracks is None:
+            tracks = np.arange(self.TrackCount, dtype=np.int64)
+        if len(tracks) == 0:
+            return np.zeros(0, dtype=np.float64)
+        seg = self.Advance(frame, tracks)
+        return self.Evaluate(np.full(len(tracks), float(frame)), seg)
+
+    def SampleTracksRange(self, frames, tracks = None):
+    #Value of each of tracks at each of frames, (len(frames), len(tracks)), using binary search rather than the cursors
+        frames = np.asarray(frames, dtype=np.float64)
+        if tracks is None:
+            tracks = np.arange(self.TrackCount, dtype=np.int64)
+        if len(tracks) == 0:
+            return np.zeros((len(frames), 0), dtype=np.float64)
+        qf = np.repeat(frames, len(tracks))
+        qt = np.tile(tracks, len(frames))
+        seg = self.Locate(qf, qt)
+        return self.Evaluate(qf, seg).reshape(len(frames), len(tracks))
+
+    def Scatter(self, track_values, tracks = None):
+    #Writes track values over the rest channels, (..., NodeCount, 9)
+        lead = track_values.shape[:-1]
+        out = np.broadcast_to(self.Rest, lead + self.Rest.shape).copy()
+        flat = out.reshape(lead + (self.NodeCount * CHANNELS_PER_NODE,))
+        flat[..., self.FlatIndex if tracks is None else self.FlatIndex[tracks]] = track_values
+        return out
+
+    def SampleNodes(self, frame, tracks = None):
+    #Per-node translation, euler rotation and scale at frame, each (NodeCount, 3)
+    #Passing tracks only samples those, nodes with none of them keep their rest values
+        out = self.Scatter(self.SampleTracks(frame, tracks), tracks)
+        return out[:, 0:3], out[:, 3:6], out[:, 6:9]
+
+    def SampleNodesRange(self, frames, tracks = None):
+    #As SampleNodes, over a batch of frames, each (len(frames), NodeCount, 3)
+        out = self.Scatter(self.SampleTracksRange(frames, tracks), tracks)
+        return out[..., 0:3], out[..., 3:6], out[..., 6:9]
@@ -0,0 +1,52 @@
+import os
+import io
+import sys
+import importlib.util
+
+#Loads the reader modules that sit next to this file without going through the add-on package,
+#for tools that run outside Blender's UI (command line scripts, worker processes, blender -b)
+
+ADDON_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+def LoadModule(name):
+#Imports ADDON_DIRECTORY/<name>.py as a top-level module, once per process
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ADDON_DIRECTORY, name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except Exception:
+        del sys.modules[name]
+        raise
+    return module
+
+def ReadEMA(path):
+#Parses an .ema from disk, returns (EMA, file bytes)
+    EMAReader = LoadModule("EMAReader")
+    with open(path, "rb") as f:
+        data = f.read()
+    buf = io.BytesIO(data)
+    buf.name = path
+    return EMAReader.EMA(buf), data
+
+def ReadEMO(path):
+#Parses an .emo from disk
+    EMAReader = LoadModule("EMAReader")
+    with open(path, "rb") as f:
+        buf = io.BytesIO(f.read())
+    buf.name = path
+    return EMAReader.EMO(buf)
+
+def FindFiles(root, extension = ".ema"):
+#Every file under root with the given extension, sorted so runs are repeatable
+    found = []
+    for directory, subdirs, files in os.walk(root):
+        for name in files:
+            if name.lower().endswith(extension):
+                found.append(os.path.join(directory, name))
+    found.sort()
+    return found
@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import threading
+
+#Span recorder for the frame pipeline, written out in Chrome trace format (chrome://tracing, ui.perfetto.dev)
+#Nothing is recorded unless a capture is running; with none running, Span() just hands back a shared no-op
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+#The running capture, None when tracing is off
+active = None
+
+def Span(name, args = None):
+    if active is None:
+        return NULL_SPAN
+    return TraceSpan(active, name, args)
+
+class TraceSpan:
+    __slots__ = ("Recorder", "Name", "Args", "Start")
+
+    def __init__(self, recorder, name, args):
+        self.Recorder = recorder
+        self.Name = name
+        self.Args = args
+
+    def __enter__(self):
+        self.Start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        self.Recorder.Add(self.Name, self.Start, end, self.Args)
+        return False
+
+class TraceRecorder:
+    def __init__(self, path, frames, profile = False):
+        self.Path = path
+        self.Frames = frames
+        self.FrameCount = 0
+        self.Events = []
+        self.Lock = threading.Lock()
+        self.Origin = time.perf_counter_ns()
+        #Set by whoever started the capture, if it also started playback and should stop it again
+        self.StartedPlayback = False
+        self.Profiler = None
+        if profile:
+            import cProfile
+            self.Profiler = cProfile.Profile()
+
+    def Add(self, name, start, end, args):
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start - self.Origin) / 1000.0,
+            "dur": (end - start) / 1000.0,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+        }
+        if args:
+            event["args"] = args
+        with self.Lock:
+            self.Events.append(event)
+
+    def FrameDone(self):
+    #Returns True once the requested number of frames has been recorded
+        self.FrameCount += 1
+        return self.FrameCount >= self.Frames
+
+    def Write(self):
+    #Writes the trace (and .prof next to it, if profiling), returns the paths written
+        written = []
+        threads = {}
+        for e in self.Events:
+            threads.setdefault(e["tid"], len(threads))
+
+        metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+            "args": {"name": "main" if i == 0 else "worker %d" % i}} for tid, i in threads.items()]
+
+        with open(self.Path, "w") as f:
+            json.dump({"traceEvents": metadata + self.Events, "displayTimeUnit": "ms"}, f)
+        written.append(self.Path)
+
+        if self.Profiler is not None:
+            prof = os.path.splitext(self.Path)[0] + ".prof"
+            self.Profiler.dump_stats(prof)
+            written.append(prof)
+
+        return written
+
+def Start(path, frames, profile = False):
+    global active
+
+    recorder = TraceRecorder(path, frames, profile)
+    if recorder.Profiler is not None:
+        recorder.Profiler.enable()
+    active = recorder
+    return recorder
+
+def Stop():
+#Ends the running capture and writes it out, returns the paths written
+    global active
+
+    recorder = active
+    active = None
+    if recorder is None:
+        return []
+    if recorder.Profiler is not None:
+        recorder.Profiler.disable()
+    return recorder.Write()
@@ -0,0 +1,18 @@
+#CMD track helpers that don't need Blender, shared by the add-on and the standalone tools
+
+def BuildValueList(cmd_list):
+    #Just brute force the value table, inefficient but good enough for testing I hope
+    values = []
+    for c in cmd_list:
+        #Force long Indices
+        c.BitFlag = (c.BitFlag | 0x40)
+        for i in range(c.StepCount):
+            if i > 0 and i < c.StepCount -1 and c.TangentStorage[i] != None:
+                c.IndicesList.append(0x40000000 | len(values))
+                values.append(c.ValueStorage[i])
+                values.append(c.TangentStorage[i]) 
+            else:
+                c.IndicesList.append(len(values))
+                values.append(c.ValueStorage[i])                       
+    
+    return cmd_list, values
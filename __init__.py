@@ -6,6 +6,9 @@ bl_info = {
     "category": "Animation"
 }
 
+import time
+import_started = time.perf_counter()
+
 import struct
 import bpy, math, mathutils
 from bpy.props import StringProperty, BoolProperty, EnumProperty, IntProperty
@@ -15,7 +18,11 @@ from mathutils import Vector,Matrix,Euler,Quaternion
 from bpy.app.handlers import persistent
 import json
 from operator import itemgetter, attrgetter
-import time
+import io
+import zlib
+import base64
+import hashlib
+import re
 
 import sys
 import os
@@ -24,21 +31,74 @@ import os
 #    sys.path.append(dir )
 
 import importlib
+import copy
+
+from . import EMATrace
+from .EMATracks import BuildValueList
 
-from .EMAReader import *
-from .IKProcessing import *
+#On a script reload this module's globals survive, so the readers need reloading the next time they're pulled in
+readers_stale = "armature_list" in locals()
+readers_loaded = False
+#Names LoadReaders has pulled in from the reader modules, kept across script reloads so stale ones get replaced
+reader_names = globals().get("reader_names", set())
 
-importlib.reload(EMAReader)
-importlib.reload(IKProcessing)
+def LoadReaders():
+#The reader and IK modules are only imported once something actually needs them
+    global readers_loaded, readers_stale, EMAReader, IKProcessing
+    
+    if readers_loaded:
+        return
+    
+    from . import EMAReader, IKProcessing
+    if readers_stale:
+        importlib.reload(EMAReader)
+        importlib.reload(IKProcessing)
+        readers_stale = False
+    
+    #Equivalent of the old star imports, without clobbering anything defined here
+    #Anything that came from a reader last time is replaced, so a reload never leaves the old objects behind
+    g = globals()
+    for module in (EMAReader, IKProcessing):
+        names = getattr(module, "__all__", [k for k in vars(module) if not k.startswith("_")])
+        for k in names:
+            if k in g and k not in reader_names:
+                continue
+            if k in g and getattr(g[k], "__module__", None) == __name__:
+                continue
+            g[k] = getattr(module, k)
+            reader_names.add(k)
+    
+    readers_loaded = True
 
 armature_list = []
 
-#set up custom property
-bpy.types.PoseBone.absolute_scale = bpy.props.BoolProperty(name="Absolute Scale", default=False)
-bpy.types.PoseBone.absolute_rotation = bpy.props.BoolProperty(name="Absolute Rotation", default=False)
-bpy.types.PoseBone.absolute_translation = bpy.props.BoolProperty(name="Absolute Translation", default=False)
-bpy.types.PoseBone.animation_override = bpy.props.BoolProperty(name="Animation Override", default=False)
-bpy.types.PoseBone.animated = bpy.props.BoolProperty(name="Animated", default=False)
+#Control bones whose EMA matrices are armature-space rather than local
+IK_CONTROL_NODES = ("LLegEff", "RLegEff", "LLegUp", "RLegUp", "LArmEff", "LArmUp", "RArmEff", "RArmUp")
+
+def RegisterProperties():
+    #set up custom property
+    bpy.types.PoseBone.absolute_scale = bpy.props.BoolProperty(name="Absolute Scale", default=False, update=AbsoluteFlagsChanged)
+    bpy.types.PoseBone.absolute_rotation = bpy.props.BoolProperty(name="Absolute Rotation", default=False, update=AbsoluteFlagsChanged)
+    bpy.types.PoseBone.absolute_translation = bpy.props.BoolProperty(name="Absolute Translation", default=False, update=AbsoluteFlagsChanged)
+    bpy.types.PoseBone.animation_override = bpy.props.BoolProperty(name="Animation Override", default=False)
+    bpy.types.PoseBone.animated = bpy.props.BoolProperty(name="Animated", default=False)
+    
+    #Per-armature scheduling toggles
+    bpy.types.Object.usf4_enabled = bpy.props.BoolProperty(name="Evaluate EMA", description="Evaluate EMA animation for this armature on frame change", default=True)
+    bpy.types.Object.usf4_freeze = bpy.props.BoolProperty(name="Freeze Pose", description="Hold the last evaluated pose instead of evaluating new frames", default=False)
+    bpy.types.Object.usf4_proxy_rate = bpy.props.IntProperty(name="Proxy Rate", description="During playback, only evaluate this armature every Nth frame", default=1, min=1, max=60)
+    bpy.types.Object.usf4_live_ik = bpy.props.BoolProperty(name="Live IK", description="While posing, re-solve the IK chains whose effector or up bones are moved", default=False)
+    
+    #Face animation layered over the body action
+    #The name is what's stored, the enum only picks from the loaded face .ema (its items change, so it can't hold the value itself)
+    bpy.types.Object.usf4_face_animation = bpy.props.StringProperty(name="Face Animation", description="Animation from the face .ema to play alongside the body action", default="")
+    bpy.types.Object.usf4_face_animation_picker = bpy.props.EnumProperty(name="Face Animation", description="Animation from the face .ema to play alongside the body action", items=GetFaceAnimationItems, get=GetFaceAnimationPick, set=SetFaceAnimationPick)
+
+def UnregisterProperties():
+    for prop in ("absolute_scale", "absolute_rotation", "absolute_translation", "animation_override", "animated"):
+        delattr(bpy.types.PoseBone, prop)
+    for prop in ("usf4_enabled", "usf4_freeze", "usf4_proxy_rate", "usf4_live_ik", "usf4_face_animation", "usf4_face_animation_picker"):
+        delattr(bpy.types.Object, prop)
 
 def GetCurves(act, bone_name):
     fcurves_list = []
@@ -48,6 +108,211 @@ def GetCurves(act, bone_name):
     else:
         return group.channels
 
+def StoreBlob(obj, key, data, path):
+#Keeps the source file bytes on the object, so the parsed data can be rebuilt from the .blend alone
+    obj["_usf4_" + key] = base64.b64encode(zlib.compress(data)).decode('ascii')
+    obj["_usf4_" + key + "_hash"] = hashlib.sha1(data).hexdigest()
+    obj["_usf4_" + key + "_path"] = path
+
+def ClearBlob(obj, key):
+    for k in ("_usf4_" + key, "_usf4_" + key + "_hash", "_usf4_" + key + "_path"):
+        if k in obj:
+            del obj[k]
+
+def OpenBlob(data, path):
+#File-like view over in-memory bytes that the readers can treat as the original file
+    buf = io.BytesIO(data)
+    buf.name = path
+    return buf
+
+def LoadBlob(obj, key):
+    blob = obj.get("_usf4_" + key)
+    if blob is None:
+        return None, None
+    return zlib.decompress(base64.b64decode(blob)), obj.get("_usf4_" + key + "_path", "")
+
+def ParseStoredBlob(obj, key, parse):
+#Parses a stored blob by its recorded hash, so on a cache hit the blob is never decoded
+    if "_usf4_" + key not in obj:
+        return None, None
+    content_hash = obj.get("_usf4_" + key + "_hash")
+    parsed = parse(lambda: LoadBlob(obj, key)[0], obj.get("_usf4_" + key + "_path", ""), content_hash)
+    return parsed, content_hash
+
+parse_cache = None
+
+def GetParseCache():
+    global parse_cache
+    
+    if parse_cache is None:
+        LoadReaders()
+        from .EMACache import ParseCache
+        
+        #Anything that changes what the readers produce has to invalidate the cache
+        version = hashlib.sha1()
+        for module in (EMAReader, IKProcessing):
+            with open(module.__file__, "rb") as f:
+                version.update(f.read())
+        #The only classes a cache entry may rebuild: the readers' own, and the EMO skeleton view
+        classes = {c.__name__:c for c in (EMOSkeletonView, EMOSkeleton, EMOSkeletonNode)}
+        for module in (EMAReader, IKProcessing):
+            classes.update({k:v for k, v in vars(module).items() if isinstance(v, type) and v.__module__ == module.__name__})
+        parse_cache = ParseCache(bpy.utils.user_resource('DATAFILES', path="usf4_cache", create=True), version.hexdigest(), classes)
+    
+    return parse_cache
+
+def BlobReader(data, content_hash):
+#data is either the file bytes or a function returning them, e.g. decoding a stored blob
+#Returns the function and the content hash, which is only computed from the bytes when not already known
+    read = data if callable(data) else lambda: data
+    if content_hash is None:
+        content_hash = hashlib.sha1(read()).hexdigest()
+    return read, content_hash
+
+def ParseEMA(data, path, content_hash = None):
+    LoadReaders()
+    read, content_hash = BlobReader(data, content_hash)
+    return InternSkeleton(GetParseCache().Load(content_hash, "ema", path, lambda: PrepareEMA(EMA(OpenBlob(read(), path)))))
+
+#Loaded skeletons by content hash, so every EMA with the same skeleton shares one node table
+#Keys are the skeleton hash, plus the EMO skeleton hash once SBP matrices have been passed in
+skeleton_table = {}
+
+def MatrixBytes(m):
+#The exact values, so skeletons only share when they really are identical
+    values = [v for row in m for v in row]
+    return struct.pack("<%dd" % len(values), *values)
+
+def SkeletonHash(skeleton):
+    h = hashlib.sha1()
+    for n in skeleton.Nodes:
+        h.update(repr((n.Name, n.Parent, n.BitFlag, getattr(n, "PreMatrixFloat", None))).encode('utf-8'))
+        h.update(MatrixBytes(n.Matrix))
+    for ik in skeleton.IKData:
+        h.update(repr((ik.Method, ik.Flag0x00, ik.Flag0x01, list(ik.NodeIDs), list(getattr(ik, "Floats", [])))).encode('utf-8'))
+    return h.hexdigest()
+
+def EMOSkeletonHash(emo):
+    h = hashlib.sha1()
+    for n in emo.Skeleton.Nodes:
+        h.update(repr(n.Name).encode('utf-8'))
+        h.update(MatrixBytes(n.SBPMatrix))
+    return h.hexdigest()
+
+def InternSkeleton(ema):
+    key = SkeletonHash(ema.Skeleton)
+    
+    skeleton = skeleton_table.get(key)
+    if skeleton is None:
+        skeleton = ema.Skeleton
+        skeleton.InternKey = key
+        skeleton.BaseKey = key
+        skeleton_table[key] = skeleton
+    
+    ema.Skeleton = skeleton
+    return ema
+
+def PruneSkeletons():
+#Forgets interned skeletons no loaded armature uses any more
+    global armature_list
+    
+    used = set()
+    for ad in armature_list:
+        used.update(ad.SkeletonKeys())
+    
+    for key in list(skeleton_table.keys()):
+        if key not in used:
+            del skeleton_table[key]
+
+def ParseEMO(data, path, content_hash = None):
+#Only the skeleton view is kept (and cached), so repeat loads and rehydration never touch the geometry
+#A file the cache hasn't seen still goes through the full EMO() decode, meshes and materials included,
+#since EMAReader has no way to read just the skeleton section
+    LoadReaders()
+    read, content_hash = BlobReader(data, content_hash)
+    return GetParseCache().Load(content_hash, "emo-skeleton", path, lambda: EMOSkeletonView(EMO(OpenBlob(read(), path))))
+
+def PrepareEMA(ema):
+    for n in ema.Skeleton.Nodes:
+        #Load some extra data into the nodes to speed things up later
+        #Don't do this, apparently this is very bad practice and probably causing the Undo errors/crashes
+        #n.BlenderBone = armature.pose.bones.get(n.Name)
+        n.NodeChain = CalculateNodeChain(ema.Skeleton, n.ID)
+        
+        #Nope
+        #if n.BlenderBone == None and n.ID == 0:
+        #    n.BlenderBone = armature.pose.bones[0]
+    
+    ema.FlagMasks = BuildFlagMasks(ema)
+    
+    return ema
+
+def SyncArmatureList():
+#Rebuilds armature_list from the data stored on the objects, after a file load or undo/redo
+#Parsed data is only kept where the stored blob still matches, everything else rehydrates lazily on first use
+    global armature_list
+    
+    synced = []
+    for obj in bpy.data.objects:
+        if obj.type != 'ARMATURE' or "_usf4_ema" not in obj:
+            continue
+        
+        ad = None
+        for old in armature_list:
+            if old.ObjName == obj.name:
+                ad = old
+                break
+        
+        if ad is None:
+            ad = USF4ArmatureData(obj.name, obj.data.name)
+        else:
+            ad.DatName = obj.data.name
+            if ad.EMAHash != obj.get("_usf4_ema_hash") or ad.EMOHash != obj.get("_usf4_emo_hash") or ad.FaceHash != obj.get("_usf4_fceema_hash"):
+                ad.Dehydrate()
+        
+        #Flags on the pose bones are saved with the file, so only remember which action they belong to
+        if obj.animation_data is not None and obj.animation_data.action is not None:
+            ad.last_action = obj.animation_data.action.name
+        
+        synced.append(ad)
+    
+    for old in armature_list:
+        if old not in synced:
+            old.StopPrefetch()
+    armature_list[:] = synced
+    
+    #Undo and file loads put back whatever flags were saved
+    AbsoluteFlagsChanged()
+    PruneSkeletons()
+    SubscribeActions()
+    UpdateHandlers()
+
+def UpdateHandlers():
+#The per-frame and depsgraph handlers are only installed while at least one armature has EMA data
+    global armature_list
+    
+    wanted = len(armature_list) > 0
+    for handlers, h in ((bpy.app.handlers.frame_change_post, FramePipeline), (bpy.app.handlers.depsgraph_update_post, ActionEditWatcher), (bpy.app.handlers.depsgraph_update_post, LiveIKWatcher)):
+        installed = [x for x in handlers if x.__name__ == h.__name__]
+        if wanted and len(installed) == 0:
+            handlers.append(h)
+        elif not wanted:
+            for x in installed:
+                handlers.remove(x)
+
+@persistent
+def LoadPostHandler(dummy):
+    global armature_list
+    
+    for ad in armature_list:
+        ad.StopPrefetch()
+    armature_list.clear()
+    SyncArmatureList()
+
+@persistent
+def UndoPostHandler(dummy):
+    SyncArmatureList()
+
 def GetArmatureData(name):
     global armature_list
 
@@ -57,6 +322,39 @@ def GetArmatureData(name):
     else:
         return None
 
+def IsPlaying():
+    for w in bpy.context.window_manager.windows:
+        if w.screen is not None and w.screen.is_animation_playing:
+            return True
+    return False
+
+def ScheduleArmatures(scene):
+#Collects the armatures that actually need evaluating this frame
+#Skips armatures that aren't in the scene, are hidden/excluded from the view layer, disabled or frozen,
+#and background armatures with a proxy rate that aren't due an update this frame during playback
+    global armature_list
+    
+    scheduled = []
+    playing = IsPlaying()
+    
+    for ad in armature_list:
+        if ad.EMA is None:
+            continue
+        
+        arm = scene.objects.get(ad.ObjName)
+        if arm is None or arm.animation_data is None or arm.animation_data.action is None:
+            continue
+        if arm.usf4_enabled == False or arm.usf4_freeze == True:
+            continue
+        if not arm.visible_get():
+            continue
+        if playing and arm.usf4_proxy_rate > 1 and scene.frame_current % arm.usf4_proxy_rate != 0:
+            continue
+        
+        scheduled.append((ad, arm, arm.animation_data.action))
+    
+    return scheduled
+
 def EulerToQuat(euler):
     dpitch = euler.y
     dyaw = euler.z
@@ -80,27 +378,279 @@ def EulerToQuat(euler):
     
     return rot
 
-def SetupFrame(ema, action):
+#Actions whose curves are known to still match the EMA animation they were loaded from, by name
+action_pristine = {}
+
+def CurveKeys(f):
+#Flat co, handle_left and handle_right of every key on the curve, read in bulk
+    count = len(f.keyframe_points) * 2
+    keys = []
+    for attr in ("co", "handle_left", "handle_right"):
+        buf = array.array('f', [0.0]) * count
+        f.keyframe_points.foreach_get(attr, buf)
+        keys.append(buf)
+    return keys
+
+def FCurveFingerprint(action):
+    h = hashlib.sha1()
+    for f in action.fcurves:
+        h.update((f.data_path + str(f.array_index)).encode('utf-8'))
+        for buf in CurveKeys(f):
+            h.update(buf.tobytes())
+    return h.hexdigest()
+
+def ActionCurveKeys(action, skeleton):
+#CurveKeys of each of the action's transform curves, by (node ID, transform type, component) as the sampler wants them
+    node_ids = {n.Name:i for i, n in enumerate(skeleton.Nodes)}
+    curves = {}
+    for f in action.fcurves:
+        match = CURVE_PATH.match(f.data_path)
+        if match is None or match.group(1) not in node_ids:
+            continue
+        curves[(node_ids[match.group(1)], CURVE_TRANSFORM_TYPES[match.group(2)], f.array_index)] = CurveKeys(f)
+    return curves
+
+def IsPristine(action):
+#True if the action hasn't been edited since LoadAnimationData built it
+    pristine = action_pristine.get(action.name)
+    if pristine is None:
+        fingerprint = action.get("_usf4_fingerprint")
+        pristine = fingerprint is not None and fingerprint == FCurveFingerprint(action)
+        action_pristine[action.name] = pristine
+    return pristine
+
+def GetSampler(ad, action):
+#Native track sampler for an unedited action, None if the curves have to be evaluated instead
+    if not IsPristine(action):
+        return None
+    
+    sampler = ad.Samplers.get(action.name)
+    if sampler is None:
+        from .EMASampler import TrackSampler
+        for a in ad.EMA.Animations:
+            if a.Name == action.name:
+                #The curves are unedited, but their handles are what Blender actually plays back
+                sampler = TrackSampler(a, ad.EMA.Skeleton, ActionCurveKeys(action, ad.EMA.Skeleton))
+                ad.Samplers[action.name] = sampler
+                break
+    
+    return sampler
+
+@persistent
+def ActionEditWatcher(scene, depsgraph):
+#Any edit to an action means it can no longer be sampled straight from the EMA tracks
+    with EMATrace.Span("ActionEditWatcher"):
+        for u in depsgraph.updates:
+            if isinstance(u.id, bpy.types.Action):
+                action_pristine.pop(u.id.name, None)
+                #Frames already prefetched from the old curves are no good either
+                for ad in armature_list:
+                    if ad.Prefetch is not None and ad.Prefetch.Job is not None and ad.Prefetch.Job[0][0] == u.id.name:
+                        ad.Prefetch.Invalidate()
+
+#Seconds between live IK solves while posing, about one viewport redraw
+LIVE_IK_INTERVAL = 1.0 / 60.0
+
+#Armatures with live IK that have changed since the last solve
+live_ik_pending = set()
+
+@persistent
+def LiveIKWatcher(scene, depsgraph):
+#Queues armatures with live IK for a solve whenever they're updated outside playback, the timer does the actual work
+    if IsPlaying():
+        return
+    
+    for u in depsgraph.updates:
+        if isinstance(u.id, bpy.types.Object) and u.id.type == 'ARMATURE' and u.id.original.usf4_live_ik:
+            live_ik_pending.add(u.id.original.name)
+    
+    if len(live_ik_pending) > 0 and not bpy.app.timers.is_registered(LiveIKTimer):
+        bpy.app.timers.register(LiveIKTimer, first_interval=LIVE_IK_INTERVAL)
+
+def LiveIKChangedChains(ad, arm):
+#The IK chains whose driver bones have moved since last time, and records where they are now
+    bones = arm.pose.bones
+    moved = set()
+    for chain in GetIKChains(ad, arm):
+        if not chain.Supported:
+            continue
+        for name in chain.Drivers:
+            matrix = bones[name].matrix
+            old = ad.LiveIKMatrices.get(name)
+            if old is None or old != matrix:
+                moved.add(name)
+                ad.LiveIKMatrices[name] = matrix.copy()
+    
+    return [chain for chain in GetIKChains(ad, arm) if chain.Supported and any(name in moved for name in chain.Drivers)]
+
+def LiveIKTimer():
+#Re-solves only the chains that were posed since the last solve, everything else keeps its pose
+#Parent matrices come from the last evaluated frame, so only the chains themselves follow the drag
+    names = list(live_ik_pending)
+    live_ik_pending.clear()
+    
+    for name in names:
+        ad = GetArmatureData(name)
+        arm = bpy.data.objects.get(name)
+        if ad is None or arm is None or ad.Pose is None or not arm.usf4_live_ik:
+            continue
+        
+        chains = LiveIKChangedChains(ad, arm)
+        if len(chains) > 0:
+            with EMATrace.Span("LiveIK", {"armature": name, "chains": len(chains)} if EMATrace.active is not None else None):
+                ProcessIK(ad.EMA, ad.Pose, arm, chains)
+    
+    return None
+
+class FaceLayer:
+#A face animation layered over the body EMA
+#Nodes the face tracks animate are overridden wholesale, so each node is only ever sampled once per frame
+    def __init__(self, ema, face_ema, animation):
+        from .EMASampler import TrackSampler
+        
+        self.Name = animation.Name
+        self.FaceEMA = face_ema
+        self.Sampler = TrackSampler(animation, face_ema.Skeleton)
+        
+        body_ids = {}
+        for i, n in enumerate(ema.Skeleton.Nodes):
+            body_ids.setdefault(n.Name, i)
+        
+        #(body node index, face node index) for every face-animated node the body skeleton also has
+        self.Nodes = []
+        self.Override = [False] * len(ema.Skeleton.Nodes)
+        #Absolute translation/rotation/scale flags from the face tracks, by body node index
+        self.Absolute = [(False, False, False)] * len(ema.Skeleton.Nodes)
+        
+        for fi, n in enumerate(face_ema.Skeleton.Nodes):
+            bi = body_ids.get(n.Name)
+            if bi is None or not self.Sampler.NodeAnimated[fi]:
+                continue
+            self.Nodes.append((bi, fi))
+            self.Override[bi] = True
+            
+            flags = [False, False, False]
+            for t in range(self.Sampler.TrackCount):
+                if self.Sampler.TrackNode[t] == fi and self.Sampler.TrackAbsolute[t]:
+                    flags[min(int(self.Sampler.TrackType[t]), 2)] = True
+            self.Absolute[bi] = tuple(flags)
+    
+    def Apply(self, ema, pose, frame):
+        T, R, S = self.Sampler.SampleNodes(frame)
+        
+        for bi, fi in self.Nodes:
+            fn = self.FaceEMA.Skeleton.Nodes[fi]
+            pose.Matrix[bi] = ema.Skeleton.Nodes[bi].Matrix
+            pose.LocalMatrix[bi] = ema.Skeleton.Nodes[bi].Matrix
+            
+            rot = fn.RotationQuaternion
+            if self.Sampler.RotationKeyed[fi] and R[fi].any():
+                rot = EulerToQuat(mathutils.Euler(R[fi], 'XYZ'))
+            
+            pose.Translation[bi] = mathutils.Vector(T[fi])
+            pose.Rotation[bi] = rot
+            pose.Scale[bi] = mathutils.Vector(S[fi])
+
+def GetFaceLayer(ad, arm):
+    name = arm.usf4_face_animation
+    face_ema = ad.fceEMA
+    if face_ema is None or name == 'NONE' or name == '':
+        return None
+    
+    if ad.FaceLayer is None or ad.FaceLayer.Name != name:
+        ad.FaceLayer = None
+        for a in face_ema.Animations:
+            if a.Name == name:
+                ad.FaceLayer = FaceLayer(ad.EMA, face_ema, a)
+                break
+    
+    return ad.FaceLayer
+
+face_animation_items = []
+
+def GetFaceAnimationItems(self, context):
+    #Blender needs the item strings kept alive on the Python side
+    global face_animation_items
+    
+    items = [('NONE', 'None', 'No face animation')]
+    ad = GetArmatureData(self.name)
+    if ad is not None and ad.fceEMA is not None:
+        for a in ad.fceEMA.Animations:
+            items.append((a.Name, a.Name, a.Name))
+    
+    face_animation_items = items
+    return items
+
+def GetFaceAnimationPick(self):
+    name = self.usf4_face_animation
+    for i, item in enumerate(GetFaceAnimationItems(self, None)):
+        if item[0] == name:
+            return i
+    return 0
+
+def SetFaceAnimationPick(self, value):
+    items = GetFaceAnimationItems(self, None)
+    if 0 <= value < len(items):
+        self.usf4_face_animation = items[value][0] if value > 0 else ""
+
+class PoseState:
+#Per-armature animated transforms, one entry per EMA node
+#Kept apart from the skeleton, which may be shared between armatures
+    def __init__(self, skeleton):
+        nodes = skeleton.Nodes
+        self.Matrix = [getattr(n, "AnimatedMatrix", n.Matrix) for n in nodes]
+        self.LocalMatrix = [getattr(n, "AnimatedLocalMatrix", n.Matrix) for n in nodes]
+        self.Translation = [getattr(n, "AnimatedTranslation", n.Translation) for n in nodes]
+        self.Rotation = [getattr(n, "AnimatedRotationQuaternion", n.RotationQuaternion) for n in nodes]
+        self.Scale = [getattr(n, "AnimatedScale", n.Scale) for n in nodes]
+
+def SetupFrameFromSampler(ema, pose, sampler, override, tracks = None):
+#Same as SetupFrame, with every channel sampled from the EMA tracks in one go
+#tracks leaves out the ones on nodes the face layer provides, so those are never sampled twice
+    T, R, S = sampler.SampleNodes(bpy.context.scene.frame_current, tracks)
+    
+    for i, n in enumerate(ema.Skeleton.Nodes):
+        #Skip nodes tagged as un-animated, and nodes the face layer provides
+        if n.BitFlag == 0 or override[i]:
+            continue
+        pose.Matrix[i] = n.Matrix
+        pose.LocalMatrix[i] = n.Matrix
+        
+        rot = n.RotationQuaternion
+        if sampler.RotationKeyed[i] and R[i].any():
+            rot = EulerToQuat(mathutils.Euler(R[i], 'XYZ'))
+        
+        pose.Translation[i] = mathutils.Vector(T[i])
+        pose.Rotation[i] = rot
+        pose.Scale[i] = mathutils.Vector(S[i])
+
+def SetupFrame(ema, pose, action, sampler = None, face = None):
 #Loads default transform values for each bone, evaluates animation curves, and combines with the values as needed
+    override = face.Override if face is not None else [False] * len(ema.Skeleton.Nodes)
+    
+    if face is not None:
+        face.Apply(ema, pose, bpy.context.scene.frame_current)
+    
+    if sampler is not None:
+        SetupFrameFromSampler(ema, pose, sampler, override, sampler.TracksExcept(override) if face is not None else None)
+        return
 
-    for n in ema.Skeleton.Nodes:
-        #Skip nodes tagged as un-animated
-        if n.BitFlag == 0:
+    for i, n in enumerate(ema.Skeleton.Nodes):
+        #Skip nodes tagged as un-animated, and nodes the face layer provides
+        if n.BitFlag == 0 or override[i]:
             continue
         #Reset flags
-        n.AnimatedMatrix = n.Matrix
-        n.AnimatedLocalMatrix = n.Matrix
-        n.AnimatedRotationQuaternion = n.RotationQuaternion
-        n.AnimatedScale = n.Scale
-        n.AnimatedTranslation = n.Translation
+        pose.Matrix[i] = n.Matrix
+        pose.LocalMatrix[i] = n.Matrix
         
         #fetch curves
         b_curves = GetCurves(action, n.Name)
         
         #Set up default transform from the ema matrix
-        loc = n.Translation
+        #(copies, the skeleton's own values are shared and must stay untouched)
+        loc = n.Translation.copy()
         rot = n.RotationQuaternion
-        sca = n.Scale
+        sca = n.Scale.copy()
         
         #print(n.ID,n.Name)
         #print(loc)
@@ -126,32 +676,40 @@ def SetupFrame(ema, action):
             if temp_euler != mathutils.Euler():
                 rot = EulerToQuat(temp_euler)
                   
-        n.AnimatedTranslation = loc
-        n.AnimatedRotationQuaternion = rot
-        n.AnimatedScale = sca
+        pose.Translation[i] = loc
+        pose.Rotation[i] = rot
+        pose.Scale[i] = sca
 
-def UpdateFrame(ema, arm):
-    for n in ema.Skeleton.Nodes:
-        #Skip nodes tagged as un-animated
-        if n.BitFlag == 0:
+def UpdateFrame(ema, pose, arm, face = None):
+    for i, n in enumerate(ema.Skeleton.Nodes):
+        overridden = face is not None and face.Override[i]
+        
+        #Skip nodes tagged as un-animated, unless the face layer animates them
+        if n.BitFlag == 0 and not overridden:
             continue
             
-        translation = n.AnimatedTranslation
-        rotation = n.AnimatedRotationQuaternion
-        scale = n.AnimatedScale
+        translation = pose.Translation[i]
+        rotation = pose.Rotation[i]
+        scale = pose.Scale[i]
         
-        parent = None
+        #Face-driven nodes take their absolute flags from the face tracks
+        if overridden:
+            absolute_translation, absolute_rotation, absolute_scale = face.Absolute[i]
+        else:
+            b = arm.pose.bones.get(n.Name)
+            absolute_translation, absolute_rotation, absolute_scale = b.absolute_translation, b.absolute_rotation, b.absolute_scale
+        
+        p = n.Parent
         #Multiply by parent transform if necessary
-        if n.Parent != -1:
-            parent = ema.Skeleton.Nodes[n.Parent]
-            if arm.pose.bones.get(n.Name).absolute_translation == False:
-                translation = parent.AnimatedMatrix @ translation
-            if arm.pose.bones.get(n.Name).absolute_rotation == False:
-                rotation = parent.AnimatedRotationQuaternion @ rotation
-            if arm.pose.bones.get(n.Name).absolute_scale == False:
-                scale.x = scale.x * round(parent.AnimatedScale.x,6)
-                scale.y = scale.y * round(parent.AnimatedScale.y,6)
-                scale.z = scale.z * round(parent.AnimatedScale.z,6)
+        if p != -1:
+            if absolute_translation == False:
+                translation = pose.Matrix[p] @ translation
+            if absolute_rotation == False:
+                rotation = pose.Rotation[p] @ rotation
+            if absolute_scale == False:
+                scale.x = scale.x * round(pose.Scale[p].x,6)
+                scale.y = scale.y * round(pose.Scale[p].y,6)
+                scale.z = scale.z * round(pose.Scale[p].z,6)
         
         #Generate armature-space transform matrices
         loc_matrix = mathutils.Matrix.Translation(translation)
@@ -162,39 +720,25 @@ def UpdateFrame(ema, arm):
         matrix = loc_matrix @ rot_matrix @ sca_matrix
         
         #Assign armature-space matrix and individual transform components
-        n.AnimatedMatrix = matrix
-        n.AnimatedTranslation = translation
-        n.AnimatedRotationQuaternion = rotation
-        n.AnimatedScale = scale
+        pose.Translation[i] = translation
+        pose.Rotation[i] = rotation
+        pose.Scale[i] = scale
         
         #Calculate local matrix by multiplying armature-space transform with inverse parent matrix
-        if parent is not None:
-            n.AnimatedLocalMatrix = parent.AnimatedMatrix.inverted() @ matrix
+        if p != -1:
+            pose.LocalMatrix[i] = pose.Matrix[p].inverted() @ matrix
         else:
-            n.AnimatedLocalMatrix = matrix
+            pose.LocalMatrix[i] = matrix
+        pose.Matrix[i] = matrix
 
-def AssignMatrices(ema, arm):
+def AssignMatrices(ema, pose, arm):
     ##TODO fix this, or at least check that it's always valid...
-    for n in ema.Skeleton.Nodes:
+    for i, n in enumerate(ema.Skeleton.Nodes):
         #Skip "unmatched" bones (hopefully they don't matter...)
         if arm.pose.bones.get(n.Name) == None:
             continue
-        if n.Name == "LLegEff":
-            arm.pose.bones.get(n.Name).matrix = n.AnimatedMatrix
-        elif n.Name == "RLegEff":
-            arm.pose.bones.get(n.Name).matrix = n.AnimatedMatrix
-        elif n.Name == "LLegUp":
-            arm.pose.bones.get(n.Name).matrix = n.AnimatedMatrix
-        elif n.Name == "RLegUp":
-            arm.pose.bones.get(n.Name).matrix = n.AnimatedMatrix
-        elif n.Name == "LArmEff":
-            arm.pose.bones.get(n.Name).matrix = n.AnimatedMatrix
-        elif n.Name == "LArmUp":
-            arm.pose.bones.get(n.Name).matrix = n.AnimatedMatrix
-        elif n.Name == "RArmEff":
-            arm.pose.bones.get(n.Name).matrix = n.AnimatedMatrix
-        elif n.Name == "RArmUp":
-            arm.pose.bones.get(n.Name).matrix = n.AnimatedMatrix
+        if n.Name in IK_CONTROL_NODES:
+            arm.pose.bones.get(n.Name).matrix = pose.Matrix[i]
         else:
             irestdae = n.SBPMatrix
             par = mathutils.Matrix.Translation(([0,0,0]))
@@ -202,152 +746,334 @@ def AssignMatrices(ema, arm):
                 par = ema.Skeleton.Nodes[n.Parent].SBPMatrix.inverted()
             
             rest = arm.pose.bones.get(n.Name).bone.matrix_local
-            mat_final = MatrixDirectXToBlender(n.AnimatedLocalMatrix, rest, irestdae, par)
+            mat_final = MatrixDirectXToBlender(pose.LocalMatrix[i], rest, irestdae, par)
 
             arm.pose.bones.get(n.Name).matrix_basis = mat_final
 
-    bpy.context.view_layer.update()
+def UpdateViewLayer():
+#One update flushes the writeback of every armature, so it runs once per frame rather than once per armature
+    with EMATrace.Span("view_layer.update"):
+        bpy.context.view_layer.update()
+
+class IKChain:
+#One IK entry, with everything the solver needs that doesn't change from frame to frame worked out up front
+    def __init__(self, ema, armature, IKData):
+        nodes = ema.Skeleton.Nodes
+        
+        self.Method = IKData.Method
+        self.Flag0x00 = IKData.Flag0x00
+        self.Flag0x01 = IKData.Flag0x01
+        self.NodeIDs = list(IKData.NodeIDs)
+        self.Floats = list(IKData.Floats)
+        
+        if self.Method == 0x00 and self.Flag0x00 == 0x02:
+            self.Supported = len(self.NodeIDs) >= 5
+            chain = self.NodeIDs[0:5]
+            #node1 and node2 get solved
+            solved = self.NodeIDs[1:3]
+        elif self.Method == 0x01:
+            self.Supported = len(self.NodeIDs) >= 3 and len(self.Floats) >= 3
+            chain = self.NodeIDs[0:3]
+            #Only node1 gets solved
+            solved = self.NodeIDs[1:2]
+        else:
+            self.Supported = False
+            chain = []
+            solved = []
+        
+        self.Names = [nodes[i].Name for i in chain]
+        if self.Supported:
+            self.Supported = all(armature.pose.bones.get(name) is not None for name in self.Names)
+        
+        #Bones that move the chain when posed: its effector/up control bones, or failing that the bones past the solved ones
+        self.Drivers = [name for name in self.Names if name in IK_CONTROL_NODES]
+        if len(self.Drivers) == 0:
+            self.Drivers = self.Names[1 + len(solved):]
+        
+        #Per solved node: ID, parent ID, inverted parent SBP matrix, SBP matrix, Blender rest matrix
+        self.Solved = []
+        self.PreMatrixFloats = [getattr(nodes[i], "PreMatrixFloat", None) for i in solved]
+        if self.Supported:
+            for i in solved:
+                n = nodes[i]
+                par = mathutils.Matrix.Translation(([0,0,0]))
+                if n.Parent != -1:
+                    par = nodes[n.Parent].SBPMatrix.inverted()
+                rest = armature.pose.bones[n.Name].bone.matrix_local.copy()
+                self.Solved.append((i, n.Parent, par, n.SBPMatrix, rest))
+
+def GetIKChains(ad, armature):
+    if ad.IKChains is None:
+        ad.IKChains = [IKChain(ad.EMA, armature, IKData) for IKData in ad.EMA.Skeleton.IKData]
+    return ad.IKChains
+
+def ProcessIK(ema, pose, armature, chains):
+#Solves every IK entry of the armature against the freshly written pose, in skeleton order
+#The parent world matrices come straight from the composed frame, rather than being rebuilt from matrix_basis
+    tracing = EMATrace.active is not None
+    for chain in chains:
+        if not chain.Supported:
+            continue
+        tags = {"armature": armature.name, "method": chain.Method, "node": chain.Names[0]} if tracing else None
+        with EMATrace.Span("IK", tags):
+            if chain.Method == 0x00:
+                SolveIKChain0x00(pose, armature, chain)
+            else:
+                SolveIKChain0x01(pose, armature, chain)
 
-@persistent
-def EMAProcessing(scene):
-    global armature_list
+def SolveIKChain0x00(pose, armature, chain):
+    #def ProcessIKData0x00_02(arm, bone_names, ikflag0x01, node1_f, node2_f): 
+    node1_id, node1_parent, par1, irestdae1, rest1 = chain.Solved[0]
+    node2_id, node2_parent, par2, irestdae2, rest2 = chain.Solved[1]
+    result = ProcessIKData0x00_02(armature, chain.Names, chain.Flag0x01, chain.PreMatrixFloats[0], chain.PreMatrixFloats[1])
+    
+    ##World-space DAE matrix of node1's parent, as composed by UpdateFrame
+    matrix_world_dae = mathutils.Matrix.Translation(([0,0,0]))
+    if node1_parent != -1:
+        matrix_world_dae = pose.Matrix[node1_parent]
+
+    ##inverse DAE world matrix @ result to get local DAE result
+    #Not sure what is going on with all the transpositions, but it works!! Don't touch!
+    result0_local = (result[0].transposed() @ matrix_world_dae.inverted().transposed()).transposed()        
+    
+    ## ASSIGN FINAL MATRIX TO THE POSEBONE
+    armature.pose.bones[chain.Names[1]].matrix_basis = MatrixDirectXToBlender(result0_local, rest1, irestdae1, par1)
+    ## HOLY **** IT WORKED
+    
+    ##node2 is easy because the parent is node1, so we already have the parent world matrix
+    result1_local = result[0].inverted() @ result[1]
+    armature.pose.bones[chain.Names[2]].matrix_basis = MatrixDirectXToBlender(result1_local, rest2, irestdae2, par2)
+    
+    #Keep the in-memory frame in step with the solved chain, in case a later entry hangs off it
+    pose.Matrix[node1_id] = result[0]
+    pose.LocalMatrix[node1_id] = result0_local
+    pose.Matrix[node2_id] = result[1]
+    pose.LocalMatrix[node2_id] = result1_local
+
+def SolveIKChain0x01(pose, armature, chain):
+    #ProcessIKData0x01_00(arm, bone_names, ikfloats, ikflag0x01):
+    node1_id, node1_parent, par1, irestdae1, rest1 = chain.Solved[0]
+    result = ProcessIKData0x01_00(armature, chain.Names, chain.Floats[0:3], chain.Flag0x01)
+    
+    ## ASSIGN FINAL MATRIX TO THE POSEBONE
+    armature.pose.bones[chain.Names[1]].matrix_basis = MatrixDirectXToBlender(result, rest1, irestdae1, par1)
+    
+    #The solver hands back node1's local DAE matrix
+    pose.LocalMatrix[node1_id] = result
+    if node1_parent != -1:
+        pose.Matrix[node1_id] = pose.Matrix[node1_parent] @ result
+    else:
+        pose.Matrix[node1_id] = result
+
+#Bumped whenever any pose bone's absolute flags may have changed, so the cached copies know to re-read them
+absolute_flags_generation = 0
+
+def AbsoluteFlagsChanged(self = None, context = None):
+#Update callback for the absolute flag properties, also called after anything that sets them with foreach_set
+    global absolute_flags_generation
+    absolute_flags_generation += 1
+
+def GetAbsoluteFlags(ad, arm):
+#Absolute translation/rotation/scale flags for each EMA node, flattened, as UpdateFrame reads them off the pose bones
+#Only read back from the bones when they may have changed since last time
+    bone_nodes = GetBoneNodes(ad, arm)
+    if ad.AbsoluteFlags is not None and ad.AbsoluteFlags[0] == absolute_flags_generation and ad.AbsoluteFlags[1] is bone_nodes:
+        return ad.AbsoluteFlags[2]
+    
+    flags = [False] * (len(ad.EMA.Skeleton.Nodes) * 3)
+    buf = [False] * len(bone_nodes)
+    
+    for c, prop in enumerate(("absolute_translation", "absolute_rotation", "absolute_scale")):
+        arm.pose.bones.foreach_get(prop, buf)
+        for b, n in enumerate(bone_nodes):
+            if n != -1:
+                flags[n * 3 + c] = buf[b]
+    
+    ad.AbsoluteFlags = (absolute_flags_generation, bone_nodes, flags)
+    return flags
 
-    for ad in armature_list:
-        ema = ad.EMA
-        arm = bpy.data.objects.get(ad.ObjName)
-        
-        if arm.animation_data is not None:
-            action = arm.animation_data.action
-        
-        if ema is not None and action is not None:
-            SetupFrame(ema, action)
-            
-            UpdateFrame(ema, arm)
-            
-            AssignMatrices(ema, arm)
- 
-@persistent
-def IKProcessingHandler2(scene):
-    global ema
+def GetPoseTable(ad, arm, action, sampler, face):
+#Array form of the armature's skeleton and flags for the NumPy compose, rebuilt whenever any of its inputs change
+    from .EMAPose import PoseTable
     
-    if ema is not None and armature is not None:
-        
-        for IKData in ema.Skeleton.IKData:
-            if IKData.Method == 0x00 and IKData.Flag0x00 == 0x02:
-                nodes = ((ema.Skeleton.Nodes[IKData.NodeIDs[0]],ema.Skeleton.Nodes[IKData.NodeIDs[1]],ema.Skeleton.Nodes[IKData.NodeIDs[2]],ema.Skeleton.Nodes[IKData.NodeIDs[3]],ema.Skeleton.Nodes[IKData.NodeIDs[4]]))
-                
-                result = ProcessIKData0x00_02(nodes, IKData.Flag0x01)
-                
-                result0_local = result[0] @ ema.Skeleton.Nodes[nodes[1].Parent].AnimatedMatrix.inverted()
-                
-                ##node2 is easy because the parent is node1, so we already have the parent world matrix
-                result1_local = result[0].inverted() @ result[1]
-                
-                    
-@persistent
-def IKProcessingHandler(scene):
-    global armature_list
+    scene = bpy.context.scene
+    flags = GetAbsoluteFlags(ad, arm)
+    face_sampler = face.Sampler if face is not None else None
+    #Samplers are stamped with a generation rather than keyed by id(), which can come back for a new one
+    key = (action.name, getattr(sampler, "Generation", None), getattr(face_sampler, "Generation", None), bytes(flags), scene.frame_start, scene.frame_end)
     
-    for ad in armature_list:
-        if ad.EMA is not None:   
-            ema = ad.EMA
-            armature = bpy.data.objects[ad.ObjName]
-            if armature.animation_data is not None:
-                action = armature.animation_data.action
+    if ad.PoseTableKey != key:
+        ad.PoseTable = PoseTable(ad.EMA, ad.Pose, flags, sampler, face)
+        ad.PoseTableKey = key
+    
+    return key, ad.PoseTable
+
+def ApplyComposed(pose, table, W, L):
+#Copies one composed frame's matrices into the pose state
+    W = W.tolist()
+    L = L.tolist()
+    for i in table.ActiveNodes:
+        pose.Matrix[i] = mathutils.Matrix(W[i])
+        pose.LocalMatrix[i] = mathutils.Matrix(L[i])
+
+def PrefetchFrame(ad, key, table, sampler, face):
+#During playback, takes the composed frame from the prefetch worker instead of evaluating it here
+#key and table are the armature's current GetPoseTable result
+#Returns the frame's (world, local) arrays, or None when it isn't ready, after pointing the worker at whatever is playing now
+    from .EMAPrefetch import PosePrefetcher
+    
+    scene = bpy.context.scene
+    face_sampler = face.Sampler if face is not None else None
+    
+    if ad.Prefetch is None:
+        ad.Prefetch = PosePrefetcher()
+    
+    result = ad.Prefetch.Fetch(key, scene.frame_current)
+    if result is None:
+        job = ad.Prefetch.Job
+        if job is None or job[0] != key:
+            ad.Prefetch.Schedule(key, table, sampler, face_sampler, scene.frame_start, scene.frame_end, scene.frame_current)
+        return None
+    
+    return result
 
-            if action is None:
-                continue
+#Worker threads for composing several armatures' frames at once, started on first use
+compose_pool = None
 
-            for IKData in ema.Skeleton.IKData:
-                if IKData.Method == 0x00 and IKData.Flag0x00 == 0x02:
-                    node0 = ema.Skeleton.Nodes[IKData.NodeIDs[0]]
-                    node1 = ema.Skeleton.Nodes[IKData.NodeIDs[1]]
-                    node2 = ema.Skeleton.Nodes[IKData.NodeIDs[2]]
-                    node3 = ema.Skeleton.Nodes[IKData.NodeIDs[3]]
-                    node4 = ema.Skeleton.Nodes[IKData.NodeIDs[4]]
-                   
-                    #def ProcessIKData0x00_02(arm, bone_names, ikflag0x01, node1_f, node2_f): 
-                    result = ProcessIKData0x00_02(armature, [node0.Name,node1.Name,node2.Name,node3.Name,node4.Name], IKData.Flag0x01, node1.PreMatrixFloat, node2.PreMatrixFloat)
-                    
-                    ###start doing the hell maths
-                    ##function to get a parent node_chain?
-                    node1p_chain = CalculateNodeChain(ema.Skeleton, node1.Parent)
-                    
-                    ##Work through the chain and retrieve DAE-style local matrices, multiply as we go to retrieve world-space DAE matrix
-                    ##TODO pre-calculate the chain and as much of the maths as possible so it doesn't get calculated every frame
-                    ##(that should be part of the IK Chain class?)
-                    matrix_world_dae = mathutils.Matrix.Translation(([0,0,0]))
-                    j = len(node1p_chain)
-                    while j > 0:
-                        j -= 1
-                        #local blender matrix
-                        b = armature.pose.bones.get(node1p_chain[j].Name)
-                        if b == None:
-                            b = armature.pose.bones[0]
-                        mat = b.matrix_basis
-                        #parent
-                        par = mathutils.Matrix.Translation(([0,0,0]))
-                        if node1p_chain[j].Parent != -1:
-                            par = ema.Skeleton.Nodes[node1p_chain[j].Parent].SBPMatrix.inverted()
-                        #rest
-                        rest = b.bone.matrix_local
-                        #irestdae
-                        irestdae = node1p_chain[j].SBPMatrix
-                        
-                        out = MatrixBlenderToDirectX(mat, rest, irestdae, par)
-                        
-                        matrix_world_dae = matrix_world_dae @ out
+def GetComposePool():
+    global compose_pool
+    
+    if compose_pool is None:
+        from concurrent.futures import ThreadPoolExecutor
+        compose_pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix="USF4 compose")
+    return compose_pool
 
-                    ##inverse DAE world matrix @ result to get local DAE result
-                    #Not sure what is going on with all the transpositions, but it works!! Don't touch!
-                    result0_local = (result[0].transposed() @ matrix_world_dae.inverted().transposed()).transposed()        
-                    
-                    ##function to return DAE result to blender format
-                    mat = result0_local
-                    par = mathutils.Matrix.Translation(([0,0,0]))
-                    if node1.Parent != -1:
-                        par = ema.Skeleton.Nodes[node1.Parent].SBPMatrix.inverted()
-                    rest = armature.pose.bones[node1.Name].bone.matrix_local
-                    irestdae = node1.SBPMatrix
-                    
-                    result0_blender = MatrixDirectXToBlender(mat, rest, irestdae, par)
-                    
-                    ## ASSIGN FINAL MATRIX TO THE POSEBONE
-                    armature.pose.bones[node1.Name].matrix_basis = result0_blender
-                    ## HOLY **** IT WORKED
-                    
-                    ##node2 is easy because the parent is node1, so we already have the parent world matrix
-                    result1_local = result[0].inverted() @ result[1]
-                    mat = result1_local
-                    par = mathutils.Matrix.Translation(([0,0,0]))
-                    if node2.Parent != -1:
-                        par = ema.Skeleton.Nodes[node2.Parent].SBPMatrix.inverted()
-                    rest = armature.pose.bones[node2.Name].bone.matrix_local
-                    irestdae = node2.SBPMatrix
-                    
-                    result1_blender = MatrixDirectXToBlender(mat, rest, irestdae, par)
-                    armature.pose.bones[node2.Name].matrix_basis = result1_blender
-                    
-                #elif IKData.Method == 0x01:
-                    #node0 = ema.Skeleton.Nodes[IKData.NodeIDs[0]]
-                    #node1 = ema.Skeleton.Nodes[IKData.NodeIDs[1]]
-                    #node2 = ema.Skeleton.Nodes[IKData.NodeIDs[2]]
-                    
-                    #ProcessIKData0x01_00(arm, bone_names, ikfloats, ikflag0x01):
-                    #result = ProcessIKData0x01_00(armature, [node0.Name,node1.Name,node2.Name],[IKData.Floats[0],IKData.Floats[1],IKData.Floats[2]],IKData.Flag0x01)
-                    
-                    #mat = result
-                    #par = mathutils.Matrix.Translation(([0,0,0]))
-                    #if node1.Parent != -1:
-                    #    par = ema.Skeleton.Nodes[node1.Parent].SBPMatrix.inverted()
-                    #rest = armature.pose.bones[node1.Name].bone.matrix_local
-                    #irestdae = node1.SBPMatrix
-                    
-                    #result_blender = MatrixDirectXToBlender(mat, rest, irestdae, par)
-                    
-                    ## ASSIGN FINAL MATRIX TO THE POSEBONE
-                    #armature.pose.bones[node1.Name].matrix_basis = result_blender
-                    ## HOLY **** IT WORKED
+def ShutdownComposePool():
+    global compose_pool
+    
+    if compose_pool is not None:
+        compose_pool.shutdown(wait=True)
+        compose_pool = None
+
+def TraceTags(ad, arm):
+#Span arguments identifying the armature, only built while a trace is being captured
+    if EMATrace.active is None:
+        return None
+    return {"armature": arm.name, "nodes": len(ad.EMA.Skeleton.Nodes)}
+
+def SharedFrameKey(ad, table_key, table, face):
+#Identifies a composed frame by everything that goes into it, so armatures playing the same thing can share it
+#None for armatures whose .ema didn't come from a stored file, they're never shared
+    if ad.EMAHash is None:
+        return None
+    skeleton = getattr(ad.EMA.Skeleton, "InternKey", None)
+    face_key = (ad.FaceHash, face.Name) if face is not None else None
+    #table_key is (action, sampler, face sampler, absolute flags, frame range)
+    #The table also carries each armature's own pose for the nodes the frame leaves alone, which has to match too
+    return (skeleton, ad.EMAHash, table_key[0], face_key, table_key[3], table.ConstHash, bpy.context.scene.frame_current)
+
+def ComposeArmature(ad, arm, action, pool = None, shared = None):
+#Sampling and hierarchy composition for one armature's frame
+#With a pool, unedited actions are composed on a worker and this returns (table, future) to hand to WritebackArmature
+#Otherwise the pose is composed here and this returns None
+#shared maps SharedFrameKey -> future for the frame being evaluated; an armature identical to one already
+#composed this frame just reuses its future, so it only pays for its own writeback
+    ema = ad.EMA
+    if ad.Pose is None:
+        ad.Pose = PoseState(ema.Skeleton)
+    pose = ad.Pose
+    face = GetFaceLayer(ad, arm)
+    sampler = GetSampler(ad, action)
+    tags = TraceTags(ad, arm)
+    
+    prefetching = arm.usf4_proxy_rate == 1 and IsPlaying()
+    if sampler is not None and (prefetching or pool is not None):
+        key, table = GetPoseTable(ad, arm, action, sampler, face)
+        share = SharedFrameKey(ad, key, table, face) if shared is not None else None
+        if share is not None and share in shared:
+            with EMATrace.Span("SharedFrame", tags):
+                return table, shared[share]
+        
+        #Unedited actions playing back every frame are composed ahead of time on the prefetch worker
+        future = None
+        if prefetching:
+            with EMATrace.Span("PrefetchFrame", tags):
+                result = PrefetchFrame(ad, key, table, sampler, face)
+            if result is not None:
+                from concurrent.futures import Future
+                future = Future()
+                future.set_result((result[0][None], result[1][None]))
+        
+        if future is None and pool is not None:
+            from .EMAPose import EvaluateFrames
+            face_sampler = face.Sampler if face is not None else None
+            future = pool.submit(EvaluateFrames, table, sampler, [bpy.context.scene.frame_current], face_sampler)
+        
+        if future is not None:
+            if share is not None:
+                shared[share] = future
+            return table, future
+    
+    with EMATrace.Span("SetupFrame", tags):
+        SetupFrame(ema, pose, action, sampler, face)
+    
+    with EMATrace.Span("UpdateFrame", tags):
+        UpdateFrame(ema, pose, arm, face)
+    return None
+
+def WritebackArmature(ad, arm, composed = None):
+#The pose bone writeback after composition, without the view layer update that has to follow it
+    pose = ad.Pose
+    tags = TraceTags(ad, arm)
+    
+    if composed is not None:
+        table, future = composed
+        with EMATrace.Span("ComposeWait", tags):
+            W, L = future.result()
+        ApplyComposed(pose, table, W[0], L[0])
+    
+    with EMATrace.Span("AssignMatrices", tags):
+        AssignMatrices(ad.EMA, pose, arm)
+
+def SolveArmatureIK(ad, arm):
+#The IK solvers read the posed effectors from the armature, so this runs after the writeback and its view layer update
+    ProcessIK(ad.EMA, ad.Pose, arm, GetIKChains(ad, arm))
+    
+    #Live IK only needs to react to posing done after this frame
+    if arm.usf4_live_ik:
+        LiveIKChangedChains(ad, arm)
+
+def EvaluateArmature(ad, arm, action):
+#One armature's frame, in order: sample the curves, compose the hierarchy, write the pose back, then solve IK
+#Matrices are handed between stages in the armature's PoseState, so nothing is read back from the pose bones
+    WritebackArmature(ad, arm, ComposeArmature(ad, arm, action))
+    UpdateViewLayer()
+    SolveArmatureIK(ad, arm)
+
+@persistent
+def FramePipeline(scene):
+    with EMATrace.Span("FramePipeline", {"frame": scene.frame_current} if EMATrace.active is not None else None):
+        scheduled = ScheduleArmatures(scene)
+        
+        #With more than one armature, the sampled ones go out to the pool first, so their maths overlaps
+        #the curve-evaluated ones composed here. bpy isn't thread-safe, so writeback stays on this thread, in order
+        pool = GetComposePool() if len(scheduled) > 1 else None
+        #Identical armatures (same skeleton, .ema, action, flags) playing together compose their frame once
+        shared = {} if len(scheduled) > 1 else None
+        composed = [ComposeArmature(ad, arm, action, pool, shared) for ad, arm, action in scheduled]
+        
+        for (ad, arm, action), c in zip(scheduled, composed):
+            WritebackArmature(ad, arm, c)
+        
+        #Every armature is written back before the one view layer update, then IK runs on all of them
+        if len(scheduled) > 0:
+            UpdateViewLayer()
+        for ad, arm, action in scheduled:
+            SolveArmatureIK(ad, arm)
+    
+    if EMATrace.active is not None and EMATrace.active.FrameDone():
+        #Writing the file out can wait until the frame is on screen
+        bpy.app.timers.register(FinishTraceCapture, first_interval=0)
 
 def HermiteToBezier(p0, p1, t0, t1):
     b0 = p0
@@ -493,28 +1219,64 @@ class LoadAnimationData(bpy.types.Operator):
                         action.fcurves[-1].group = action.groups[bone_name]
                      
                     i += 1
+                
+                #Remember what the curves looked like straight out of the EMA, so playback can sample the tracks directly
+                action["_usf4_fingerprint"] = FCurveFingerprint(action)
+                action_pristine.pop(action.name, None)
+                ad = GetArmatureData(armature.name)
+                if ad is not None:
+                    ad.Samplers.pop(action.name, None)
                 break
             armature.animation_data.action = action
 
         return {'FINISHED'}
 
-def BuildValueList(cmd_list):
-    #Just brute force the value table, inefficient but good enough for testing I hope
-    values = []
-    for c in cmd_list:
-        #Force long Indices
-        c.BitFlag = (c.BitFlag | 0x40)
-        for i in range(c.StepCount):
-            if i > 0 and i < c.StepCount -1 and c.TangentStorage[i] != None:
-                c.IndicesList.append(0x40000000 | len(values))
-                values.append(c.ValueStorage[i])
-                values.append(c.TangentStorage[i]) 
-            else:
-                c.IndicesList.append(len(values))
-                values.append(c.ValueStorage[i])                       
-    
-    return cmd_list, values
+#Bone and transform of the curves LoadAnimationData creates
+CURVE_PATH = re.compile(r'^pose\.bones\["(.*)"\]\.(location|rotation_euler|scale)$')
+CURVE_TRANSFORM_TYPES = {"location": 0, "rotation_euler": 1, "scale": 2}
 
+def TrackFromFCurve(f, bone_id, transform_type, absolute):
+#Builds a CMD track from an fcurve's keys, reading them all in one go
+#Tangents come back out of the right handles, scaled to the segment; keys with collapsed handles (and the last key) have none
+    import numpy as np
+    
+    count = len(f.keyframe_points)
+    co = np.zeros(count * 2, dtype=np.float32)
+    hr = np.zeros(count * 2, dtype=np.float32)
+    f.keyframe_points.foreach_get("co", co)
+    f.keyframe_points.foreach_get("handle_right", hr)
+    co = co.reshape(count, 2).astype(np.float64)
+    hr = hr.reshape(count, 2).astype(np.float64)
+    
+    x = co[:, 0]
+    y = co[:, 1]
+    dx = hr[:, 0] - x
+    dy = hr[:, 1] - y
+    
+    length = np.zeros(count, dtype=np.float64)
+    length[:-1] = x[1:] - x[:-1]
+    has_tangent = dx > 0.0
+    has_tangent[-1:] = False
+    tangents = np.where(has_tangent, dy / np.where(has_tangent, dx, 1.0) * length, 0.0)
+    
+    #Rotation goes back to degrees
+    if transform_type == 1:
+        y = np.degrees(y)
+        tangents = np.degrees(tangents)
+    
+    c = CMDTrack()
+    c.BoneID = bone_id
+    c.TransformType = transform_type
+    c.BitFlag = f.array_index & 0x03
+    if absolute:
+        c.BitFlag = (c.BitFlag | 0x10)
+    c.StepCount = count
+    c.StepsList = np.rint(x).astype(np.int64).tolist()
+    c.ValueStorage = y.tolist()
+    c.TangentStorage = [t if h else None for t, h in zip(tangents.tolist(), has_tangent.tolist())]
+    c.IndicesList = []
+    
+    return c
 
 class SaveAnimationData(bpy.types.Operator, ExportHelper):
     """Save animation data to the current .ema"""
@@ -573,15 +1335,9 @@ class SaveAnimationData(bpy.types.Operator, ExportHelper):
     
     def execute(self, context):
         #Find the armature/ema *AGAIN* because of scope
-        global armature_list
-        
-        ema = None
         armature = bpy.context.object
-        
-        for ad in armature_list:
-            if armature.name == ad.ObjName:
-                ema = ad.EMA
-                break
+        ad = GetArmatureData(armature.name)
+        ema = ad.EMA if ad is not None else None
         
         #Again, cancel if we don't find it, just in case
         if ema is None:
@@ -610,6 +1366,7 @@ class SaveAnimationData(bpy.types.Operator, ExportHelper):
         
         #Clear existing curves ready for new data
         action = armature.animation_data.action
+        
             
         ema_animation.CMDTracks = []
         ema_animation.CMDTrackCount = 0
@@ -617,21 +1374,23 @@ class SaveAnimationData(bpy.types.Operator, ExportHelper):
         ema_animation.ValueCount = 0
         ema_animation.CMDTrackPointerList = []
         
+        #Node IDs by name, and every node's absolute flags, looked up once rather than per curve
+        node_ids = {}
+        for i, n in enumerate(ema.Skeleton.Nodes):
+            node_ids.setdefault(n.Name, i)
+        absolute = GetAbsoluteFlags(ad, armature)
+        
         #Divide fcurves by transform type
         temp_cmds = []
         for f in action.fcurves:
-            temp_cmd = CMDTrack().FromFCurve(f, ema.Skeleton)
-            
-            bone_name = f.data_path[f.data_path.find("pose.bones[\"")+len("pose.bones[\""):f.data_path.find("\"].")]
-            pbone = armature.pose.bones[bone_name]
-            if temp_cmd.TransformType == 0 and pbone.absolute_translation == True:
-                temp_cmd.BitFlag = (temp_cmd.BitFlag | 0x10)
-            elif temp_cmd.TransformType == 1 and pbone.absolute_rotation == True:
-                temp_cmd.BitFlag = (temp_cmd.BitFlag | 0x10)
-            elif temp_cmd.TransformType == 2 and pbone.absolute_scale == True:
-                temp_cmd.BitFlag = (temp_cmd.BitFlag | 0x10)
+            m = CURVE_PATH.match(f.data_path)
+            bone_id = node_ids.get(m.group(1)) if m is not None else None
+            if bone_id is None:
+                print("Skipping fcurve " + f.data_path + ", not an EMA bone transform")
+                continue
             
-            temp_cmds.append(temp_cmd)
+            transform_type = CURVE_TRANSFORM_TYPES[m.group(2)]
+            temp_cmds.append(TrackFromFCurve(f, bone_id, transform_type, absolute[bone_id * 3 + transform_type]))
         
         temp_cmds = sorted(temp_cmds, key=attrgetter('TransformType','BoneID'))
 
@@ -654,10 +1413,46 @@ class SaveAnimationData(bpy.types.Operator, ExportHelper):
             ema.AnimationPointers.append(0)
         
         ema.Write(ema_filepath)
+        ema.FlagMasks = BuildFlagMasks(ema)
+        
+        #Keep the stored copy in step with what we just wrote
+        with open(ema_filepath, "rb") as ema_file:
+            StoreBlob(armature, "ema", ema_file.read(), ema_filepath)
+        ad.EMAHash = armature["_usf4_ema_hash"]
+        ad.Samplers = {}
         
         return {'FINISHED'}
 
+class EMOSkeletonNode:
+    def __init__(self, name, sbp_matrix):
+        self.Name = name
+        self.SBPMatrix = sbp_matrix
+
+class EMOSkeleton:
+    def __init__(self, nodes):
+        self.Nodes = nodes
+
+class EMOSkeletonView:
+#The only parts of an .emo we use: its name, and each skeleton node's name and SBP matrix
+    def __init__(self, emo):
+        self.Name = emo.Name
+        self.Skeleton = EMOSkeleton([EMOSkeletonNode(n.Name, n.SBPMatrix.copy()) for n in emo.Skeleton.Nodes])
+
 def pass_isbp_data(ema, emo):
+    #Interned skeletons are shared, so the SBP matrices go into this skeleton/emo pairing's own copy
+    base_key = getattr(ema.Skeleton, "BaseKey", None)
+    if base_key is not None:
+        key = base_key + ":" + EMOSkeletonHash(emo)
+        skeleton = skeleton_table.get(key)
+        if skeleton is None:
+            skeleton = copy.deepcopy(skeleton_table.get(base_key, ema.Skeleton))
+            skeleton.InternKey = key
+            skeleton.BaseKey = base_key
+            skeleton_table[key] = skeleton
+        else:
+            ema.Skeleton = skeleton
+            return ema
+        ema.Skeleton = skeleton
 
     dict_EMAnodes = {}
     
@@ -674,7 +1469,7 @@ def pass_isbp_data(ema, emo):
             i += 1
             continue
         
-        ema.Skeleton.Nodes[ema_match_id].SBPMatrix = emo_node.SBPMatrix
+        ema.Skeleton.Nodes[ema_match_id].SBPMatrix = emo_node.SBPMatrix.copy()
      
     return ema   
 
@@ -696,7 +1491,8 @@ class ImportEMO(bpy.types.Operator, ImportHelper):
         ema = None
         
         with open(emo_filepath, "rb") as emo_file:
-            emo = EMO(emo_file)
+            emo_data = emo_file.read()
+        emo = ParseEMO(emo_data, emo_filepath)
         
         #TESTING MULTIPLE ARMATURES        
         b_found = False
@@ -705,6 +1501,8 @@ class ImportEMO(bpy.types.Operator, ImportHelper):
             if bpy.context.object.name == ad.ObjName:
                 ad.EMO = emo
                 ad.EMA = pass_isbp_data(ad.EMA, emo)
+                StoreBlob(bpy.context.object, "emo", emo_data, emo_filepath)
+                ad.EMOHash = bpy.context.object["_usf4_emo_hash"]
                 b_found = True
                 print(ad)
                 break
@@ -713,6 +1511,9 @@ class ImportEMO(bpy.types.Operator, ImportHelper):
             print("Load EMA data first.")
             return {'CANCELLED'}
         
+        #The skeleton this armature used before the emo was applied may not be needed any more
+        PruneSkeletons()
+        
         #ema = pass_isbp_data(ema, emo)
         
         return {'FINISHED'}
@@ -737,35 +1538,41 @@ class ImportEMA(bpy.types.Operator, ImportHelper):
         global armature_list
         
         with open(ema_filepath, "rb") as ema_file:
-            ema = EMA(ema_file)
+            ema_data = ema_file.read()
+        ema = ParseEMA(ema_data, ema_filepath)
         
-        for n in ema.Skeleton.Nodes:
-            #Load some extra data into the nodes to speed things up later
-            #Don't do this, apparently this is very bad practice and probably causing the Undo errors/crashes
-            #n.BlenderBone = armature.pose.bones.get(n.Name)
-            n.NodeChain = CalculateNodeChain(ema.Skeleton, n.ID)
-            
-            #Nope
-            #if n.BlenderBone == None and n.ID == 0:
-            #    n.BlenderBone = armature.pose.bones[0]        
+        #Persist the source with the .blend, the emo gets cleared along with the in-memory one
+        StoreBlob(armature, "ema", ema_data, ema_filepath)
+        ClearBlob(armature, "emo")
         
         ##TESTING MULTIPLE ARMATURES        
         b_found = False
         for ad in armature_list:
             if bpy.context.object.name == ad.ObjName:
-                ad.EMO = None
                 ad.EMA = ema
+                ad.EMO = None
                 b_found = True
                 break
         
         if b_found == False:
-            armature_list.append(USF4ArmatureData(bpy.context.object.name, bpy.context.object.data.name, ema))
+            ad = USF4ArmatureData(bpy.context.object.name, bpy.context.object.data.name, ema)
+            armature_list.append(ad)
+        
+        ad.EMAHash = armature["_usf4_ema_hash"]
+        ad.EMOHash = None
+        ad.last_action = None
+        PruneSkeletons()
         
         for ad in armature_list:
             print(ad.ObjName, ad.DatName)
         
         armature.animation_data_create()
         
+        #Apply the flags for whatever action is already assigned, then follow future changes
+        UpdateHandlers()
+        SubscribeActions()
+        ActionChanged(armature.name)
+        
         for a in ema.Animations:
             action = bpy.data.actions.get(a.Name)
             if action is None:
@@ -774,6 +1581,35 @@ class ImportEMA(bpy.types.Operator, ImportHelper):
 
         return {'FINISHED'}
 
+class ImportFaceEMA(bpy.types.Operator, ImportHelper):
+    """Import a face .ema to layer over the body animation"""
+    bl_idname = "usf4.import_face_ema"
+    bl_label = "Import Face EMA"
+    bl_options = {'REGISTER', 'UNDO'}
+    filter_glob: StringProperty(
+        default='*.ema',
+        options={'HIDDEN'}
+    )
+    
+    def execute(self, context):
+        ema_filepath = self.properties.filepath
+        armature = bpy.context.object
+        
+        ad = GetArmatureData(armature.name)
+        if ad is None or ad.EMA is None:
+            print("Load EMA data first.")
+            return {'CANCELLED'}
+        
+        with open(ema_filepath, "rb") as ema_file:
+            ema_data = ema_file.read()
+        
+        ad.fceEMA = ParseEMA(ema_data, ema_filepath)
+        StoreBlob(armature, "fceema", ema_data, ema_filepath)
+        ad.FaceHash = armature["_usf4_fceema_hash"]
+        PruneSkeletons()
+        
+        return {'FINISHED'}
+
 class EMAHandler(bpy.types.Panel):
     bl_label = 'EMA Handler'
     bl_idname = 'OBJECT_PT_main_panel'
@@ -834,6 +1670,23 @@ class EMAHandler(bpy.types.Panel):
         row = layout.row()
         row.operator("usf4.import_emo", text="Load EMO...")
         
+        fceema = None
+        if b_found:
+            fceema = ad.fceEMA
+        
+        row = layout.row()
+        if fceema is not None:
+            row.label(text="Loaded Face EMA: " + fceema.Name)
+        else:
+            row.label(text="Loaded Face EMA: None")
+        
+        row = layout.row()
+        row.operator("usf4.import_face_ema", text="Load Face EMA...")
+        
+        if fceema is not None:
+            row = layout.row()
+            row.prop(obj, "usf4_face_animation_picker")
+        
         if obj.animation_data is not None:    
             row = layout.row()
             row.prop_search(obj.animation_data, "action", bpy.data, "actions")
@@ -848,11 +1701,51 @@ class EMAHandler(bpy.types.Panel):
         row = layout.row()
         row.operator("usf4.save_animation_data", text="Save Animation Data")
         
+        row = layout.row()
+        row.prop(obj, "usf4_enabled")
+        row.prop(obj, "usf4_freeze")
+        
+        row = layout.row()
+        row.prop(obj, "usf4_proxy_rate")
+        row.prop(obj, "usf4_live_ik")
+        
+        row = layout.row()
+        row.operator("usf4.calculate_motion_paths", text="Motion Paths...")
+        row.operator("usf4.clear_motion_paths", text="Clear Paths")
+        
         row = layout.row()
         row.operator("usf4.hide_excess_bones", text="Hide Excess Bones")
 
         row = layout.row()
         row.operator("usf4.show_excess_bones", text="Show Excess Bones")
+        
+        row = layout.row()
+        row.operator("usf4.clear_parse_cache", text="Clear Parse Cache")
+
+        row = layout.row()
+        row.operator("usf4.measure_memory", text="Measure Memory")
+        if memory_report is not None:
+            from .EMAMemory import FormatBytes
+
+            box = layout.box()
+            box.label(text="All armatures: " + FormatBytes(memory_report["total"]) + ", " + str(memory_report["skeletons"]) + " skeletons")
+            for a in memory_report["armatures"]:
+                if a["name"] != obj.name:
+                    continue
+                box.label(text=a["name"] + ": " + FormatBytes(a["total"]) + " (+" + FormatBytes(a["blobs"]) + " stored files)")
+                for k, v in sorted(a["categories"].items(), key=itemgetter(1), reverse=True):
+                    if v > 0:
+                        box.label(text="    " + k + ": " + FormatBytes(v))
+                for name, v in sorted(a["animations"].items(), key=itemgetter(1), reverse=True)[:5]:
+                    box.label(text="    animation " + name + ": " + FormatBytes(v))
+                if len(a["mathutils"]) > 0:
+                    box.label(text="    mathutils: " + ", ".join(k + " " + str(v) for k, v in sorted(a["mathutils"].items())))
+
+        row = layout.row()
+        if EMATrace.active is None:
+            row.operator("usf4.capture_trace", text="Capture Trace...")
+        else:
+            row.label(text="Capturing trace, frame " + str(EMATrace.active.FrameCount) + "/" + str(EMATrace.active.Frames))
 
 def quaternion_from_euler(roll_x, pitch_y, yaw_z):
     #Custom quaternion generator, needs moving to its own function and ideally
@@ -897,10 +1790,133 @@ class USF4ArmatureData:
     def __init__ (self, objName, datName, load_ema = None, load_emo = None, load_fceema = None, last_action = None):
         self.ObjName = objName
         self.DatName = datName
-        self.EMA = load_ema
-        self.EMO = load_emo
-        self.fceEMA = load_fceema
+        self._EMA = load_ema
+        self._EMO = load_emo
+        self._fceEMA = load_fceema
         self.last_action = last_action
+        #Native track samplers by animation name, built on first use
+        self.Samplers = {}
+        #Pose bone -> EMA node lookup, built on first use
+        self.BoneNodes = None
+        #(generation, bone nodes, flags) from the last GetAbsoluteFlags
+        self.AbsoluteFlags = None
+        #Animated transforms for this armature, separate from the shared skeleton
+        self.Pose = None
+        #Hashes of the stored blobs the parsed data came from, None until parsed
+        self.EMAHash = None
+        self.EMOHash = None
+        self.FaceHash = None
+        #Face layer for the currently selected face animation
+        self.FaceLayer = None
+        #Playback prefetch worker and the arrays it's composing from, started on first playback
+        self.Prefetch = None
+        self.PoseTable = None
+        self.PoseTableKey = None
+        #Precomputed IK entries, built against the armature on first use
+        self.IKChains = None
+        #Armature-space matrices of the IK driver bones when live IK last looked at them
+        self.LiveIKMatrices = {}
+        self.Hydrated = load_ema is not None
+    
+    @property
+    def EMA(self):
+        if not self.Hydrated:
+            self.Rehydrate()
+        return self._EMA
+    
+    @EMA.setter
+    def EMA(self, ema):
+        self._EMA = ema
+        self.Samplers = {}
+        self.BoneNodes = None
+        self.Pose = None
+        self.FaceLayer = None
+        self.IKChains = None
+        self.LiveIKMatrices = {}
+        self.StopPrefetch()
+        self.Hydrated = True
+    
+    @property
+    def EMO(self):
+        if not self.Hydrated:
+            self.Rehydrate()
+        return self._EMO
+    
+    @EMO.setter
+    def EMO(self, emo):
+        #Load whatever is stored first, so a later read doesn't rehydrate over this one
+        if not self.Hydrated:
+            self.Rehydrate()
+        self._EMO = emo
+    
+    @property
+    def fceEMA(self):
+        if not self.Hydrated:
+            self.Rehydrate()
+        return self._fceEMA
+    
+    @fceEMA.setter
+    def fceEMA(self, ema):
+        if not self.Hydrated:
+            self.Rehydrate()
+        self._fceEMA = ema
+        self.FaceLayer = None
+        self.StopPrefetch()
+    
+    def Rehydrate(self):
+    #Parses the ema/emo stored on the object, the first time anything asks for them
+        self.Hydrated = True
+        
+        obj = bpy.data.objects.get(self.ObjName)
+        if obj is None:
+            return
+        
+        self._EMA, self.EMAHash = ParseStoredBlob(obj, "ema", ParseEMA)
+        if self._EMA is None:
+            return
+        
+        emo, emo_hash = ParseStoredBlob(obj, "emo", ParseEMO)
+        if emo is not None:
+            self._EMO = emo
+            self._EMA = pass_isbp_data(self._EMA, self._EMO)
+            self.EMOHash = emo_hash
+        
+        face, face_hash = ParseStoredBlob(obj, "fceema", ParseEMA)
+        if face is not None:
+            self._fceEMA = face
+            self.FaceHash = face_hash
+    
+    def SkeletonKeys(self):
+    #Interned skeletons this entry holds right now, without rehydrating anything
+        keys = set()
+        for ema in (self._EMA, self._fceEMA):
+            if ema is not None:
+                keys.add(getattr(ema.Skeleton, "InternKey", None))
+        return keys
+    
+    def StopPrefetch(self):
+        if self.Prefetch is not None:
+            self.Prefetch.Stop()
+        self.Prefetch = None
+        self.PoseTable = None
+        self.PoseTableKey = None
+    
+    def Dehydrate(self):
+        self.StopPrefetch()
+        self.IKChains = None
+        self.LiveIKMatrices = {}
+        self.Samplers = {}
+        self.BoneNodes = None
+        self.Pose = None
+        self.FaceLayer = None
+        self._EMA = None
+        self._EMO = None
+        self._fceEMA = None
+        self.EMAHash = None
+        self.EMOHash = None
+        self.FaceHash = None
+        self.last_action = None
+        self.Hydrated = False
 
 class InsertUSF4Keyframe(bpy.types.Operator):
     """Insert USF4-style keyframe"""
@@ -994,9 +2010,139 @@ class InsertUSF4Keyframe(bpy.types.Operator):
                     #f.keyframe_points[-1].handle_left_type = 'ALIGNED'
                     #f.keyframe_points[-1].handle_right_type = 'ALIGNED'
         
+        #Re-run the frame for this armature so the new keys are sampled and IK is solved against them
         #TODO see what the performance impact is if we "live" process IK while effectors are moving    
-        IKProcessingHandler(bpy.context.scene)
+        ad = GetArmatureData(armature.name)
+        if ad is not None and action is not None:
+            action_pristine.pop(action.name, None)
+            EvaluateArmature(ad, armature, action)
+            
+        return{'FINISHED'}
+
+def WriteKeyframesBulk(fcurve, frames, values):
+#Replaces any keys inside the sampled range with the new ones, using the bulk keyframe APIs rather than insert()
+    frame_min = min(frames)
+    frame_max = max(frames)
+    
+    points = fcurve.keyframe_points
+    for k in reversed(points[:]):
+        if frame_min <= k.co[0] <= frame_max:
+            points.remove(k, fast=True)
+    
+    old_count = len(points)
+    points.add(len(frames))
+    
+    co = array.array('f', [0.0]) * (len(points) * 2)
+    points.foreach_get("co", co)
+    for i in range(len(frames)):
+        co[(old_count + i) * 2] = frames[i]
+        co[(old_count + i) * 2 + 1] = values[i]
+    points.foreach_set("co", co)
+    points.foreach_set("handle_left", co)
+    points.foreach_set("handle_right", co)
+    
+    #Sort and generate handles, then lock them the same way InsertUSF4Keyframe does
+    fcurve.update()
+    for k in points:
+        if frame_min <= k.co[0] <= frame_max:
+            k.handle_left_type = 'ALIGNED'
+            k.handle_right_type = 'ALIGNED'
+
+class InsertUSF4KeyframeRange(bpy.types.Operator):
+    """Insert USF4-style keyframes for the selected bones across a frame range"""
+    bl_idname = "usf4.insert_usf4_keyframe_range"
+    bl_label = "Insert USF4 keyframes (range)"
+    bl_options = {'REGISTER', 'UNDO'}
+    
+    frame_start: IntProperty(name="Start Frame", default=0)
+    frame_end: IntProperty(name="End Frame", default=0)
+    frame_step: IntProperty(name="Step", default=1, min=1)
+    
+    def invoke(self, context, event):
+        self.frame_start = context.scene.frame_start
+        self.frame_end = context.scene.frame_end
+        return context.window_manager.invoke_props_dialog(self)
+    
+    def execute(self, context):
+        import numpy as np
+        from .EMAPose import DecomposeArray, MatrixArray
+        
+        armature = bpy.context.active_object
+        action = None
+        if armature.animation_data is not None:
+            action = armature.animation_data.action
+        
+        ad = GetArmatureData(armature.name)
+        if ad is None or ad.EMA is None or action is None:
+            print("Error - check ema is loaded and an action is assigned for this armature.")
+            return {'CANCELLED'}
+        ema = ad.EMA
+        
+        if self.frame_end < self.frame_start:
+            return {'CANCELLED'}
+        
+        #Resolve everything that doesn't change per frame up front
+        node_ids = {n.Name:i for i, n in enumerate(ema.Skeleton.Nodes)}
+        absolute = GetAbsoluteFlags(ad, armature)
+        bones = []
+        for b in bpy.context.selected_pose_bones:
+            i = node_ids.get(b.name)
+            if i == None:
+                print("Couldn't find selected bone in EMA skeleton.")
+                return{'CANCELLED'}
+            ema_bone = ema.Skeleton.Nodes[i]
             
+            par = mathutils.Matrix.Translation(([0,0,0]))
+            if ema_bone.Parent != -1:
+                par = ema.Skeleton.Nodes[ema_bone.Parent].SBPMatrix.inverted()
+            
+            fcurves = []
+            for f in GetCurves(action, b.name):
+                if f.data_path.find(".location") != -1:
+                    c = 0
+                elif f.data_path.find(".rotation_euler") != -1:
+                    c = 1
+                else:
+                    continue
+                #Absolute channels hold armature-space values, so a parent-local sample would corrupt them; IK control nodes are keyed from b.matrix anyway
+                if absolute[i * 3 + c] and b.name not in IK_CONTROL_NODES:
+                    print("Skipping absolute " + f.data_path + "[" + str(f.array_index) + "]")
+                    continue
+                fcurves.append((f, c))
+            if len(fcurves) > 0:
+                bones.append((b, par, ema_bone.SBPMatrix, b.bone.matrix_local.copy(), fcurves))
+        
+        if len(bones) == 0:
+            return {'CANCELLED'}
+        
+        frames = list(range(self.frame_start, self.frame_end + 1, self.frame_step))
+        matrices = np.empty((len(frames), len(bones), 4, 4), dtype=np.float64)
+        
+        scene = bpy.context.scene
+        frame_original = scene.frame_current
+        
+        #Each frame_set runs the frame pipeline, so the pose bones hold the frame as it's shown, IK solved
+        #The bones are read back through the same conversion InsertUSF4Keyframe uses, then decomposed in one batch
+        for k, frame in enumerate(frames):
+            scene.frame_set(frame)
+            for j, (b, par, irestdae, rest, fcurves) in enumerate(bones):
+                if b.name in IK_CONTROL_NODES:
+                    matrix_final = b.matrix
+                else:
+                    matrix_final = MatrixBlenderToDirectX(b.matrix_basis, rest, irestdae, par)
+                matrices[k, j] = MatrixArray(matrix_final)
+        scene.frame_set(frame_original)
+        
+        loc, euler, sca = DecomposeArray(matrices)
+        for j, (b, par, irestdae, rest, fcurves) in enumerate(bones):
+            for f, c in fcurves:
+                values = loc if c == 0 else euler
+                WriteKeyframesBulk(f, frames, values[:, j, f.array_index].tolist())
+        action_pristine.pop(action.name, None)
+        
+        #Re-run the current frame once over the new keys, which solves IK
+        EvaluateArmature(ad, armature, action)
+        
         return{'FINISHED'}
 
 #TODO Tidy this up, loads of duplicated code.
@@ -1085,7 +2231,7 @@ class InsertUSF4KeyframeRotation(bpy.types.Operator):
                     #f.keyframe_points[-1].handle_right_type = 'ALIGNED'
         
         #TODO see what the performance impact is if we "live" process IK while effectors are moving    
-        IKProcessingHandler(bpy.context.scene)
+        FramePipeline(bpy.context.scene)
             
         return{'FINISHED'}
     
@@ -1174,10 +2320,363 @@ class InsertUSF4KeyframeLocation(bpy.types.Operator):
                     #f.keyframe_points[-1].handle_right_type = 'ALIGNED'
         
         #TODO see what the performance impact is if we "live" process IK while effectors are moving    
-        IKProcessingHandler(bpy.context.scene)
+        FramePipeline(bpy.context.scene)
+        
+        return{'FINISHED'}
+
+class ClearParseCache(bpy.types.Operator):
+    """Delete all cached parsed .ema/.emo files"""
+    bl_idname = "usf4.clear_parse_cache"
+    bl_label = "Clear parse cache"
+    bl_options = {'REGISTER'}
+    
+    def execute(self, context):
+        count = GetParseCache().Clear()
+        self.report({'INFO'}, "Removed " + str(count) + " cached files")
         
         return{'FINISHED'}
 
+#Last MemoryReport(), shown in the panel until measured again
+memory_report = None
+
+ANIMATED_NODE_ATTRIBUTES = ("AnimatedMatrix", "AnimatedLocalMatrix", "AnimatedTranslation", "AnimatedRotationQuaternion", "AnimatedScale")
+
+def MeasureArmature(ad, walker):
+#Bytes per category and per animation for one armature, anything already counted for an earlier armature is skipped
+    categories = {}
+    animations = {}
+    mathutils_before = walker.Mathutils.copy()
+
+    ema = ad._EMA
+    if ema is not None:
+        nodes = ema.Skeleton.Nodes
+        #Smaller structures first, so they aren't swallowed by the skeleton or EMA they hang off
+        categories["node_chains"] = sum(walker.Size(getattr(n, "NodeChain", None)) for n in nodes)
+        categories["animated_nodes"] = sum(walker.Size(getattr(n, a, None)) for n in nodes for a in ANIMATED_NODE_ATTRIBUTES)
+        categories["flag_masks"] = walker.Size(getattr(ema, "FlagMasks", None))
+        for a in ema.Animations:
+            animations[a.Name] = animations.get(a.Name, 0) + walker.Size(a)
+        categories["animations"] = sum(animations.values())
+        categories["skeleton"] = walker.Size(ema.Skeleton)
+        categories["ema_other"] = walker.Size(ema)
+
+    categories["emo"] = walker.Size(ad._EMO)
+    categories["face_ema"] = walker.Size(ad._fceEMA)
+    categories["pose_state"] = walker.Size(ad.Pose) + walker.Size(ad.BoneNodes)
+    categories["samplers"] = walker.Size(ad.Samplers) + walker.Size(ad.FaceLayer)
+    categories["pose_table"] = walker.Size(ad.PoseTable)
+
+    prefetch = 0
+    if ad.Prefetch is not None:
+        with ad.Prefetch.Condition:
+            prefetch = walker.Size(ad.Prefetch.Frames)
+    categories["prefetch"] = prefetch
+    categories["ik_chains"] = walker.Size(ad.IKChains)
+
+    #The stored source files live in Blender's ID properties rather than Python, reported separately
+    blobs = 0
+    obj = bpy.data.objects.get(ad.ObjName)
+    if obj is not None:
+        for key in ("ema", "emo", "fceema"):
+            blobs += len(obj.get("_usf4_" + key, ""))
+
+    return {
+        "name": ad.ObjName,
+        "total": sum(categories.values()),
+        "categories": categories,
+        "animations": animations,
+        "mathutils": dict(walker.Mathutils - mathutils_before),
+        "blobs": blobs,
+    }
+
+def MemoryReport():
+#Python-side memory held for every loaded armature; shared data (interned skeletons, parse results) is counted once,
+#under the first armature that uses it
+    global armature_list
+    from .EMAMemory import MemoryWalker
+
+    walker = MemoryWalker()
+    armatures = [MeasureArmature(ad, walker) for ad in armature_list]
+    return {
+        "armatures": armatures,
+        "total": sum(a["total"] for a in armatures),
+        "mathutils": dict(walker.Mathutils),
+        "skeletons": len(skeleton_table),
+        "time": time.perf_counter(),
+    }
+
+class MeasureMemory(bpy.types.Operator):
+    """Report how much memory the loaded EMA/EMO data takes up"""
+    bl_idname = "usf4.measure_memory"
+    bl_label = "Measure memory"
+    bl_options = {'REGISTER'}
+
+    def execute(self, context):
+        global memory_report
+        from .EMAMemory import FormatBytes
+
+        memory_report = MemoryReport()
+        for a in memory_report["armatures"]:
+            top = sorted(a["categories"].items(), key=itemgetter(1), reverse=True)
+            print("USF4 memory: " + a["name"] + " " + FormatBytes(a["total"]) + " (" + ", ".join(k + " " + FormatBytes(v) for k, v in top if v > 0) + ")")
+        self.report({'INFO'}, "EMA data: " + FormatBytes(memory_report["total"]) + " across " + str(len(memory_report["armatures"])) + " armatures")
+
+        return{'FINISHED'}
+
+def FinishTraceCapture():
+#Timer callback once the capture has its frames, ends playback it started and writes the trace out
+    recorder = EMATrace.active
+    if recorder is None:
+        return None
+    
+    written = EMATrace.Stop()
+    if recorder.StartedPlayback and IsPlaying():
+        try:
+            bpy.ops.screen.animation_cancel(restore_frame=False)
+        except RuntimeError:
+            pass
+    print("USF4 trace: " + str(recorder.FrameCount) + " frames written to " + ", ".join(written))
+    return None
+
+class CaptureTrace(bpy.types.Operator, ExportHelper):
+    """Record the next frames of playback to a Chrome/Perfetto trace"""
+    bl_idname = "usf4.capture_trace"
+    bl_label = "Capture Trace"
+    bl_options = {'REGISTER'}
+    
+    filename_ext = ".json"
+    filter_glob: StringProperty(
+        default='*.json',
+        options={'HIDDEN'}
+    )
+    
+    frames: IntProperty(name="Frames", description="Number of frames of playback to record", default=120, min=1)
+    profile: BoolProperty(name="cProfile", description="Also write a cProfile .prof next to the trace", default=False)
+    
+    def execute(self, context):
+        if EMATrace.active is not None:
+            self.report({'WARNING'}, "A trace capture is already running")
+            return {'CANCELLED'}
+        #Frames are counted by the frame pipeline, which only runs with EMA armatures in the file
+        if len(armature_list) == 0:
+            self.report({'WARNING'}, "No armatures with EMA data to trace")
+            return {'CANCELLED'}
+        
+        recorder = EMATrace.Start(self.filepath, self.frames, self.profile)
+        recorder.StartedPlayback = not IsPlaying()
+        if recorder.StartedPlayback:
+            bpy.ops.screen.animation_play()
+        
+        self.report({'INFO'}, "Recording " + str(self.frames) + " frames to " + self.filepath)
+        return {'FINISHED'}
+
+def SampleCurvesRange(ema, action, frames):
+#SetupFrame's curve evaluation over a batch of frames, per-node translation, euler rotation and scale, each (F, N, 3)
+    import numpy as np
+    
+    nodes = ema.Skeleton.Nodes
+    T = np.broadcast_to(np.array([tuple(n.Translation) for n in nodes], dtype=np.float64), (len(frames), len(nodes), 3)).copy()
+    E = np.zeros((len(frames), len(nodes), 3), dtype=np.float64)
+    S = np.broadcast_to(np.array([tuple(n.Scale) for n in nodes], dtype=np.float64), (len(frames), len(nodes), 3)).copy()
+    
+    for i, n in enumerate(nodes):
+        if n.BitFlag == 0:
+            continue
+        for c in GetCurves(action, n.Name):
+            if c.data_path.find(".location") != -1:
+                target = T
+            elif c.data_path.find(".rotation_euler") != -1:
+                target = E
+            elif c.data_path.find(".scale") != -1:
+                target = S
+            else:
+                continue
+            target[:, i, c.array_index] = [c.evaluate(f) for f in frames]
+    
+    return T, E, S
+
+def ComposeActionRange(ad, arm, action, frames):
+#Armature-space and parent-local matrices for every node over a range of frames, each (F, N, 4, 4), without touching the scene frame
+#Unedited actions come straight from the EMA tracks, edited ones from their curves
+    from .EMAPose import PoseTable, EvaluateFrames, LayerFrames, ComposeFrames
+    
+    ema = ad.EMA
+    if ad.Pose is None:
+        ad.Pose = PoseState(ema.Skeleton)
+    face = GetFaceLayer(ad, arm)
+    face_sampler = face.Sampler if face is not None else None
+    sampler = GetSampler(ad, action)
+    table = PoseTable(ema, ad.Pose, GetAbsoluteFlags(ad, arm), sampler, face)
+    
+    if sampler is not None:
+        W, L = EvaluateFrames(table, sampler, frames, face_sampler)
+    else:
+        T, E, S = SampleCurvesRange(ema, action, frames)
+        W, L = ComposeFrames(table, *LayerFrames(table, T, E, S, frames, face_sampler))
+    
+    return W, L
+
+def SolveIKRange(ad, arm, action, frames):
+#As ComposeActionRange, with every IK entry of the armature solved on every frame
+#The range is composed in one batch, but the solvers read the posed armature, so each frame is written back and solved in turn
+#Leaves the armature posed at the current frame again afterwards
+    from .EMAPose import MatrixArray
+    
+    W, L = ComposeActionRange(ad, arm, action, frames)
+    chains = [c for c in GetIKChains(ad, arm) if c.Supported]
+    if len(chains) == 0:
+        return W, L
+    
+    ema = ad.EMA
+    pose = ad.Pose
+    nodes = ema.Skeleton.Nodes
+    solved = sorted({s[0] for c in chains for s in c.Solved})
+    
+    #Relative nodes hanging off a solved one follow it, parents first
+    absolute = GetAbsoluteFlags(ad, arm)
+    depth = [0] * len(nodes)
+    for i in range(len(nodes)):
+        p = nodes[i].Parent
+        while p != -1:
+            depth[i] += 1
+            p = nodes[p].Parent
+    moved = set(solved)
+    below = []
+    for i in sorted(range(len(nodes)), key=lambda i: depth[i]):
+        if nodes[i].Parent in moved and not any(absolute[i * 3:i * 3 + 3]):
+            moved.add(i)
+            below.append(i)
+    
+    for k in range(len(frames)):
+        Wk = W[k].tolist()
+        Lk = L[k].tolist()
+        for i in range(len(nodes)):
+            pose.Matrix[i] = mathutils.Matrix(Wk[i])
+            pose.LocalMatrix[i] = mathutils.Matrix(Lk[i])
+        AssignMatrices(ema, pose, arm)
+        UpdateViewLayer()
+        ProcessIK(ema, pose, arm, chains)
+        
+        for i in solved:
+            W[k, i] = MatrixArray(pose.Matrix[i])
+            L[k, i] = MatrixArray(pose.LocalMatrix[i])
+        for i in below:
+            W[k, i] = W[k, nodes[i].Parent] @ L[k, i]
+    
+    EvaluateArmature(ad, arm, action)
+    return W, L
+
+#Computed paths by object name: list of (node name, armature-space points, line batch, point batch), drawn until cleared
+motion_paths = {}
+motion_path_handle = None
+
+MOTION_PATH_COLORS = ((1.0, 0.35, 0.2, 1.0), (0.2, 0.7, 1.0, 1.0), (0.4, 1.0, 0.3, 1.0), (1.0, 0.9, 0.2, 1.0))
+
+def GetUniformColorShader():
+    import gpu
+    try:
+        return gpu.shader.from_builtin('UNIFORM_COLOR')
+    except ValueError:
+        return gpu.shader.from_builtin('3D_UNIFORM_COLOR')
+
+def DrawMotionPaths():
+    import gpu
+    
+    shader = GetUniformColorShader()
+    for obj_name, paths in motion_paths.items():
+        obj = bpy.data.objects.get(obj_name)
+        if obj is None or not obj.visible_get():
+            continue
+        
+        with gpu.matrix.push_pop():
+            gpu.matrix.multiply_matrix(obj.matrix_world)
+            shader.bind()
+            for k, (name, points, lines, dots) in enumerate(paths):
+                shader.uniform_float("color", MOTION_PATH_COLORS[k % len(MOTION_PATH_COLORS)])
+                lines.draw(shader)
+                dots.draw(shader)
+
+def UpdateMotionPathDrawing():
+#The draw callback only stays installed while there's something to draw
+    global motion_path_handle
+    
+    if len(motion_paths) > 0 and motion_path_handle is None:
+        motion_path_handle = bpy.types.SpaceView3D.draw_handler_add(DrawMotionPaths, (), 'WINDOW', 'POST_VIEW')
+    elif len(motion_paths) == 0 and motion_path_handle is not None:
+        bpy.types.SpaceView3D.draw_handler_remove(motion_path_handle, 'WINDOW')
+        motion_path_handle = None
+    
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type == 'VIEW_3D':
+                area.tag_redraw()
+
+class CalculateMotionPaths(bpy.types.Operator):
+    """Draw the paths of the selected bones (or the IK effectors) over a frame range, straight from the EMA data"""
+    bl_idname = "usf4.calculate_motion_paths"
+    bl_label = "Calculate EMA Motion Paths"
+    bl_options = {'REGISTER'}
+    
+    frame_start: IntProperty(name="Start", default=0)
+    frame_end: IntProperty(name="End", default=0)
+    
+    def invoke(self, context, event):
+        self.frame_start = context.scene.frame_start
+        self.frame_end = context.scene.frame_end
+        return context.window_manager.invoke_props_dialog(self)
+    
+    def execute(self, context):
+        from gpu_extras.batch import batch_for_shader
+        
+        arm = context.object
+        ad = GetArmatureData(arm.name) if arm is not None else None
+        if ad is None or ad.EMA is None or arm.animation_data is None or arm.animation_data.action is None:
+            self.report({'WARNING'}, "Active object needs an .ema and an action")
+            return {'CANCELLED'}
+        
+        nodes = ad.EMA.Skeleton.Nodes
+        node_ids = {}
+        for i, n in enumerate(nodes):
+            node_ids.setdefault(n.Name, i)
+        
+        names = [b.name for b in (context.selected_pose_bones or []) if b.id_data == arm]
+        if len(names) == 0:
+            names = list(IK_CONTROL_NODES)
+        ids = [(name, node_ids[name]) for name in names if name in node_ids]
+        if len(ids) == 0:
+            self.report({'WARNING'}, "None of the selected bones are EMA nodes")
+            return {'CANCELLED'}
+        
+        started = time.perf_counter()
+        frames = list(range(self.frame_start, max(self.frame_start, self.frame_end) + 1))
+        #IK-solved bones (and anything hanging off them) only end up where they're drawn once their chains are solved
+        W, _ = SolveIKRange(ad, arm, arm.animation_data.action, frames)
+        
+        shader = GetUniformColorShader()
+        paths = []
+        for name, i in ids:
+            points = [tuple(p) for p in W[:, i, :3, 3].tolist()]
+            lines = batch_for_shader(shader, 'LINE_STRIP', {"pos": points})
+            dots = batch_for_shader(shader, 'POINTS', {"pos": points})
+            paths.append((name, points, lines, dots))
+        motion_paths[arm.name] = paths
+        UpdateMotionPathDrawing()
+        
+        self.report({'INFO'}, "%d paths over %d frames in %.1f ms" % (len(paths), len(frames), (time.perf_counter() - started) * 1000))
+        return {'FINISHED'}
+
+class ClearMotionPaths(bpy.types.Operator):
+    """Stop drawing EMA motion paths for the active object"""
+    bl_idname = "usf4.clear_motion_paths"
+    bl_label = "Clear EMA Motion Paths"
+    bl_options = {'REGISTER'}
+    
+    def execute(self, context):
+        if context.object is not None:
+            motion_paths.pop(context.object.name, None)
+        UpdateMotionPathDrawing()
+        return {'FINISHED'}
+
 class HideExcessBones(bpy.types.Operator):
     """Hide excess bones"""
     bl_idname = "usf4.hide_excess_bones"
@@ -1219,6 +2718,7 @@ class VIEW3D_MT_insert_keyframe_usf4(bpy.types.Menu):
     def draw(self, context):
         layout = self.layout
         layout.operator("usf4.insert_usf4_keyframe")
+        layout.operator("usf4.insert_usf4_keyframe_range")
         #row = layout.row()
         #row.operator("usf4.insert_usf4_keyframe_rotation")
         #row = layout.row()
@@ -1226,69 +2726,109 @@ class VIEW3D_MT_insert_keyframe_usf4(bpy.types.Menu):
 
 addon_keymaps = []
 
-@persistent
-def ActionWatcher(self, context):
+#Owner for the per-armature action subscriptions
+msgbus_owner = object()
+
+def SubscribeActions():
+#Watches each EMA armature's animation_data.action, rather than polling every depsgraph update
     global armature_list
     
+    bpy.msgbus.clear_by_owner(msgbus_owner)
+    
     for ad in armature_list:
         armature = bpy.data.objects.get(ad.ObjName)
+        if armature is None or armature.animation_data is None:
+            continue
         
-        if armature is not None and armature.animation_data is not None:
-            action = armature.animation_data.action
-            
-            #Check to see if the armature hasn't had an action before
-            #or, if it has an action but it's changed since last check
-            if action is not None and ad.last_action is None:
-                ad.last_action = action.name
-                update_action(ad.EMA, armature)
-            elif action is not None and action.name != ad.last_action:
-                ad.last_action = action.name
-                update_action(ad.EMA, armature)
-
-def update_action(ema, armature):
-    action = armature.animation_data.action
+        bpy.msgbus.subscribe_rna(
+            key=armature.animation_data.path_resolve("action", False),
+            owner=msgbus_owner,
+            args=(ad.ObjName,),
+            notify=ActionChanged,
+            options={"PERSISTENT"})
+
+def ActionChanged(obj_name):
+    armature = bpy.data.objects.get(obj_name)
+    ad = GetArmatureData(obj_name)
+    if armature is None or ad is None or armature.animation_data is None:
+        return
     
-    #Clear flags
-    for b in armature.pose.bones:
-        b.absolute_translation = False
-        b.absolute_rotation = False
-        b.absolute_scale = False
-        b.animated = False
+    #Check to see if the armature hasn't had an action before
+    #or, if it has an action but it's changed since last check
+    action = armature.animation_data.action
+    if action is not None and action.name != ad.last_action:
+        with EMATrace.Span("ActionChanged", {"armature": obj_name, "action": action.name} if EMATrace.active is not None else None):
+            ad.last_action = action.name
+            update_action(ad, armature)
+
+def BuildFlagMasks(ema):
+#Per animation: duration, then animated/absolute translation/rotation/scale flags for every EMA node
+    masks = {}
     
-    #Find the animation so we can retrieve the CMDTracks
-    Animation = None
     for anim in ema.Animations:
-        if anim.Name == action.name:
-            Animation = anim
-            break
-       
-    #Set flags
-    if Animation is not None:
+        if anim.Name in masks:
+            continue
+        
+        animated = [False] * len(ema.Skeleton.Nodes)
+        absolute = [[False] * len(ema.Skeleton.Nodes) for i in range(3)]
+        for cmd in anim.CMDTracks:
+            animated[cmd.BoneID] = True
+            if (cmd.BitFlag & 0x10) == 0x10:
+                absolute[min(cmd.TransformType, 2)][cmd.BoneID] = True
+        
+        masks[anim.Name] = (anim.Duration, animated, absolute[0], absolute[1], absolute[2])
+    
+    return masks
+
+def GetBoneNodes(ad, armature):
+#EMA node ID for each pose bone, in pose bone order (-1 where the bone isn't in the EMA)
+    if ad.BoneNodes is None or len(ad.BoneNodes) != len(armature.pose.bones):
+        dict_EMAnodes = {n.Name:i for i, n in reversed(list(enumerate(ad.EMA.Skeleton.Nodes)))}
+        ad.BoneNodes = [dict_EMAnodes.get(b.name, -1) for b in armature.pose.bones]
+    
+    return ad.BoneNodes
+
+def update_action(ad, armature):
+    action = armature.animation_data.action
+    
+    masks = ad.EMA.FlagMasks.get(action.name)
+    bone_nodes = GetBoneNodes(ad, armature)
+    
+    #Clear and set all four flags with one write each
+    props = ("animated", "absolute_translation", "absolute_rotation", "absolute_scale")
+    for i in range(len(props)):
+        if masks is None:
+            flags = [False] * len(bone_nodes)
+        else:
+            mask = masks[i + 1]
+            flags = [n != -1 and mask[n] for n in bone_nodes]
+        armature.pose.bones.foreach_set(props[i], flags)
+    AbsoluteFlagsChanged()
+    
+    if masks is not None:
         bpy.context.scene.render.fps = 60
         bpy.context.scene.frame_start = 0
-        bpy.context.scene.frame_end = Animation.Duration - 1
-        for cmd in Animation.CMDTracks:
-            bone_name = ema.Skeleton.Nodes[cmd.BoneID].Name
-            b = armature.pose.bones.get(bone_name)
-            if b is not None:
-                b.animated = True
-                if (cmd.BitFlag & 0x10) == 0x10:
-                    if cmd.TransformType == 0:
-                        b.absolute_translation = True
-                    elif cmd.TransformType == 1:
-                        b.absolute_rotation = True
-                    else:
-                        b.absolute_scale = True   
+        bpy.context.scene.frame_end = masks[0] - 1
 
 def register():
+    register_started = time.perf_counter()
+    
+    RegisterProperties()
     bpy.utils.register_class(EMAHandler)
     bpy.utils.register_class(ImportEMA)
     bpy.utils.register_class(ImportEMO)
+    bpy.utils.register_class(ImportFaceEMA)
     bpy.utils.register_class(LoadAnimationData)
     bpy.utils.register_class(SaveAnimationData)
     bpy.utils.register_class(HideExcessBones)
     bpy.utils.register_class(ShowExcessBones)
+    bpy.utils.register_class(ClearParseCache)
+    bpy.utils.register_class(MeasureMemory)
+    bpy.utils.register_class(CaptureTrace)
+    bpy.utils.register_class(CalculateMotionPaths)
+    bpy.utils.register_class(ClearMotionPaths)
     bpy.utils.register_class(InsertUSF4Keyframe)
+    bpy.utils.register_class(InsertUSF4KeyframeRange)
     #bpy.utils.register_class(InsertUSF4KeyframeRotation)
     #bpy.utils.register_class(InsertUSF4KeyframeLocation)
     bpy.utils.register_class(VIEW3D_MT_insert_keyframe_usf4)
@@ -1302,19 +2842,35 @@ def register():
         kmi.properties.name =  VIEW3D_MT_insert_keyframe_usf4.bl_idname
         addon_keymaps.append((km, kmi))
     
-    bpy.app.handlers.depsgraph_update_pre.append(ActionWatcher)
-    bpy.app.handlers.frame_change_post.append(EMAProcessing)
-    bpy.app.handlers.frame_change_post.append(IKProcessingHandler)
+    #Frame and depsgraph handlers are added by UpdateHandlers once an armature has EMA data
+    bpy.app.handlers.load_post.append(LoadPostHandler)
+    bpy.app.handlers.undo_post.append(UndoPostHandler)
+    bpy.app.handlers.redo_post.append(UndoPostHandler)
+    
+    #Pick up any EMA data stored in the already-open file once registration is over
+    bpy.app.timers.register(SyncArmatureList, first_interval=0)
+    
+    print("USF4 Animation Handler: import %.1f ms, register %.1f ms" % (import_time * 1000, (time.perf_counter() - register_started) * 1000))
 
 def unregister():
     bpy.utils.unregister_class(EMAHandler)               
     bpy.utils.unregister_class(ImportEMA)     
     bpy.utils.unregister_class(ImportEMO)
+    bpy.utils.unregister_class(ImportFaceEMA)
     bpy.utils.unregister_class(LoadAnimationData)
     bpy.utils.unregister_class(SaveAnimationData)    
     bpy.utils.unregister_class(HideExcessBones)    
     bpy.utils.unregister_class(ShowExcessBones)    
+    bpy.utils.unregister_class(ClearParseCache)
+    bpy.utils.unregister_class(MeasureMemory)
+    bpy.utils.unregister_class(CaptureTrace)
+    EMATrace.Stop()
+    bpy.utils.unregister_class(CalculateMotionPaths)
+    bpy.utils.unregister_class(ClearMotionPaths)
+    motion_paths.clear()
+    UpdateMotionPathDrawing()
     bpy.utils.unregister_class(InsertUSF4Keyframe)   
+    bpy.utils.unregister_class(InsertUSF4KeyframeRange)
     #bpy.utils.unregister_class(InsertUSF4KeyframeRotation)    
     #bpy.utils.unregister_class(InsertUSF4KeyframeLocation)    
     bpy.utils.unregister_class(VIEW3D_MT_insert_keyframe_usf4)   
@@ -1322,18 +2878,36 @@ def unregister():
         km.keymap_items.remove(kmi)
     addon_keymaps.clear()
 
-    for h in bpy.app.handlers.depsgraph_update_pre:
-        if h.__name__ == 'ActionWatcher':
-            bpy.app.handlers.depsgraph_update_pre.remove(h)
+    bpy.msgbus.clear_by_owner(msgbus_owner)
+    
+    for ad in armature_list:
+        ad.StopPrefetch()
+    ShutdownComposePool()
    
-    for h in bpy.app.handlers.frame_change_post:
-        if h.__name__ == 'EMAProcessing':
-            bpy.app.handlers.frame_change_post.remove(h)
+    for h in list(bpy.app.handlers.depsgraph_update_post):
+        if h.__name__ in ('ActionEditWatcher', 'LiveIKWatcher'):
+            bpy.app.handlers.depsgraph_update_post.remove(h)
+    if bpy.app.timers.is_registered(LiveIKTimer):
+        bpy.app.timers.unregister(LiveIKTimer)
+    live_ik_pending.clear()
 
     for h in bpy.app.handlers.frame_change_post:
-        if h.__name__ == 'IKProcessingHandler':
+        if h.__name__ == 'FramePipeline':
             bpy.app.handlers.frame_change_post.remove(h)
 
+    for h in bpy.app.handlers.load_post:
+        if h.__name__ == 'LoadPostHandler':
+            bpy.app.handlers.load_post.remove(h)
+
+    for handlers in (bpy.app.handlers.undo_post, bpy.app.handlers.redo_post):
+        for h in handlers:
+            if h.__name__ == 'UndoPostHandler':
+                handlers.remove(h)
+    
+    UnregisterProperties()
+
+import_time = time.perf_counter() - import_started
+
 # This allows you to run the script directly from Blender's Text editor
 # to test the add-on without having to install it.
 if __name__ == "__main__":
@@ -0,0 +1,219 @@
+import os
+import sys
+import importlib.util
+from types import SimpleNamespace
+
+import pytest
+
+#Tests for the IK chain plumbing: how IKChain picks its nodes and rest data, and what the chain solvers and
+#SolveIKRange do with a solver's result (the local/world matrices written to the pose state and the pose bones)
+#The solvers themselves (ProcessIKData0x00_02/0x01_00) and the DirectX -> Blender conversion live in IKProcessing
+#and EMAReader, which aren't part of this tree, so they're replaced with stand-ins that record their inputs and
+#hand back fixed matrices. These aren't checks of solved poses against known-good ones
+#
+#pytest imports the add-on package these tests sit in, so they need Blender's Python modules, e.g. the bpy wheel
+
+bpy = pytest.importorskip("bpy")
+mathutils = pytest.importorskip("mathutils")
+np = pytest.importorskip("numpy")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+NAMES = ["Parent", "Upper", "Lower", "Effector", "Up"]
+
+@pytest.fixture(scope="module")
+def addon():
+    spec = importlib.util.spec_from_file_location("usf4_addon", os.path.join(ROOT, "__init__.py"), submodule_search_locations=[ROOT])
+    module = importlib.util.module_from_spec(spec)
+    #The add-on's relative imports need it registered as a package first
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def Rotation(angle, axis, translation = (0.0, 0.0, 0.0)):
+    m = mathutils.Matrix.Rotation(angle, 4, axis)
+    m.translation = translation
+    return m
+
+PARENT_WORLD = Rotation(0.5, 'Z', (0.0, 1.0, 2.0))
+RESULT0 = Rotation(0.3, 'X', (0.5, 1.2, 2.0))
+RESULT1 = Rotation(-0.7, 'Y', (0.4, 1.8, 1.1))
+RESULT_0x01 = Rotation(0.2, 'Z', (0.0, 0.3, 0.0)) @ Rotation(0.1, 'X')
+
+@pytest.fixture
+def calls(addon, monkeypatch):
+#Stand-ins for the IKProcessing functions the chain solvers call, recording what they're given
+    recorded = {"basis": [], "0x00": [], "0x01": []}
+
+    def solve_0x00(arm, bone_names, ikflag0x01, node1_f, node2_f):
+        recorded["0x00"].append((list(bone_names), ikflag0x01, node1_f, node2_f))
+        return RESULT0.copy(), RESULT1.copy()
+
+    def solve_0x01(arm, bone_names, ikfloats, ikflag0x01):
+        recorded["0x01"].append((list(bone_names), list(ikfloats), ikflag0x01))
+        return RESULT_0x01.copy()
+
+    def to_blender(matrix, rest, irestdae, par):
+        recorded["basis"].append((matrix.copy(), rest, irestdae, par))
+        return matrix.copy()
+
+    monkeypatch.setattr(addon, "ProcessIKData0x00_02", solve_0x00, raising=False)
+    monkeypatch.setattr(addon, "ProcessIKData0x01_00", solve_0x01, raising=False)
+    monkeypatch.setattr(addon, "MatrixDirectXToBlender", to_blender, raising=False)
+    return recorded
+
+def MakePose(count):
+    identity = mathutils.Matrix.Identity(4)
+    pose = SimpleNamespace(Matrix=[identity.copy() for i in range(count)], LocalMatrix=[identity.copy() for i in range(count)])
+    pose.Matrix[0] = PARENT_WORLD.copy()
+    return pose
+
+def MakeArmature(names = NAMES):
+    bones = {}
+    for i, name in enumerate(names):
+        rest = mathutils.Matrix.Translation((0.0, 0.0, float(i)))
+        bones[name] = SimpleNamespace(matrix=None, matrix_basis=None, bone=SimpleNamespace(matrix_local=rest))
+    return SimpleNamespace(name="Armature", pose=SimpleNamespace(bones=bones))
+
+def MakeEMA(method, node_ids, floats = (0.25, 0.5, 0.75)):
+    nodes = []
+    for i, name in enumerate(NAMES):
+        #Node 0 is the root, everything else a chain off it
+        sbp = Rotation(0.1 * i, 'Z', (0.0, 0.0, -float(i)))
+        nodes.append(SimpleNamespace(Name=name, Parent=i - 1, SBPMatrix=sbp, PreMatrixFloat=0.1 * i))
+    ik = SimpleNamespace(Method=method, Flag0x00=0x02, Flag0x01=0x01, NodeIDs=list(node_ids), Floats=list(floats))
+    return SimpleNamespace(Skeleton=SimpleNamespace(Nodes=nodes, IKData=[ik]))
+
+def MakeChain(addon, method, armature = None):
+    ema = MakeEMA(method, range(5) if method == 0x00 else range(3))
+    return addon.IKChain(ema, armature or MakeArmature(), ema.Skeleton.IKData[0])
+
+def AssertMatrix(actual, expected):
+    for row_a, row_e in zip(actual, expected):
+        for a, e in zip(row_a, row_e):
+            assert a == pytest.approx(e, abs=1e-5)
+
+def test_chain_0x00_solves_nodes_1_and_2(addon):
+    ema = MakeEMA(0x00, range(5))
+    chain = MakeChain(addon, 0x00)
+
+    assert chain.Supported
+    assert chain.Names == NAMES
+    assert [s[0] for s in chain.Solved] == [1, 2]
+    assert chain.PreMatrixFloats == [pytest.approx(0.1), pytest.approx(0.2)]
+    #Without control bones in the chain, the bones past the solved ones drive it
+    assert chain.Drivers == ["Effector", "Up"]
+
+    for i, parent, par, sbp, rest in chain.Solved:
+        assert parent == i - 1
+        AssertMatrix(par, ema.Skeleton.Nodes[parent].SBPMatrix.inverted())
+        AssertMatrix(sbp, ema.Skeleton.Nodes[i].SBPMatrix)
+        AssertMatrix(rest, mathutils.Matrix.Translation((0.0, 0.0, float(i))))
+
+def test_chain_unsupported(addon):
+    #0x00 only with Flag0x00 0x02, 0x01 needs three floats, and every chain bone has to be on the armature
+    ema = MakeEMA(0x00, range(5))
+    ema.Skeleton.IKData[0].Flag0x00 = 0x01
+    assert not addon.IKChain(ema, MakeArmature(), ema.Skeleton.IKData[0]).Supported
+
+    ema = MakeEMA(0x01, range(3), floats=(0.25, 0.5))
+    assert not addon.IKChain(ema, MakeArmature(), ema.Skeleton.IKData[0]).Supported
+
+    ema = MakeEMA(0x01, range(3))
+    assert not addon.IKChain(ema, MakeArmature(NAMES[:2]), ema.Skeleton.IKData[0]).Supported
+
+def test_solve_0x00_writes_back(addon, calls):
+    pose = MakePose(5)
+    armature = MakeArmature()
+    chain = MakeChain(addon, 0x00, armature)
+
+    addon.SolveIKChain0x00(pose, armature, chain)
+
+    assert calls["0x00"] == [(NAMES, 0x01, pytest.approx(0.1), pytest.approx(0.2))]
+    #The solver hands back world matrices; node1's local is against its parent's composed world matrix, node2's against node1
+    local0 = PARENT_WORLD.inverted() @ RESULT0
+    local1 = RESULT0.inverted() @ RESULT1
+    AssertMatrix(pose.Matrix[1], RESULT0)
+    AssertMatrix(pose.Matrix[2], RESULT1)
+    AssertMatrix(pose.LocalMatrix[1], local0)
+    AssertMatrix(pose.LocalMatrix[2], local1)
+
+    #Each solved bone is converted from its own local matrix with its own rest data
+    (m1, rest1, sbp1, par1), (m2, rest2, sbp2, par2) = calls["basis"]
+    AssertMatrix(m1, local0)
+    AssertMatrix(m2, local1)
+    _, _, par, sbp, rest = chain.Solved[0]
+    assert (rest1, sbp1, par1) == (rest, sbp, par)
+    _, _, par, sbp, rest = chain.Solved[1]
+    assert (rest2, sbp2, par2) == (rest, sbp, par)
+    AssertMatrix(armature.pose.bones["Upper"].matrix_basis, local0)
+    AssertMatrix(armature.pose.bones["Lower"].matrix_basis, local1)
+
+def test_solve_0x01_writes_back(addon, calls):
+    pose = MakePose(3)
+    armature = MakeArmature()
+    chain = MakeChain(addon, 0x01, armature)
+
+    addon.SolveIKChain0x01(pose, armature, chain)
+
+    assert calls["0x01"] == [(NAMES[:3], [0.25, 0.5, 0.75], 0x01)]
+    #0x01 hands back node1's local matrix directly
+    AssertMatrix(pose.LocalMatrix[1], RESULT_0x01)
+    AssertMatrix(pose.Matrix[1], PARENT_WORLD @ RESULT_0x01)
+    AssertMatrix(armature.pose.bones["Upper"].matrix_basis, RESULT_0x01)
+    assert armature.pose.bones["Lower"].matrix_basis is None
+
+def test_process_ik_skips_unsupported(addon, calls):
+    pose = MakePose(5)
+    armature = MakeArmature()
+    chain = MakeChain(addon, 0x00, armature)
+    chain.Supported = False
+
+    addon.ProcessIK(None, pose, armature, [chain])
+
+    assert calls["0x00"] == []
+    assert calls["basis"] == []
+
+def test_solve_ik_range(addon, calls, monkeypatch):
+    frames = [0, 1, 2]
+    armature = MakeArmature()
+    ema = MakeEMA(0x01, range(3))
+    chain = addon.IKChain(ema, armature, ema.Skeleton.IKData[0])
+    count = len(NAMES)
+
+    #A composed range where every node just sits on its parent, moved along by the frame
+    W = np.zeros((len(frames), count, 4, 4))
+    L = np.zeros((len(frames), count, 4, 4))
+    for k in frames:
+        for i in range(count):
+            L[k, i] = np.eye(4)
+            L[k, i, 2, 3] = 1.0 + k
+            W[k, i] = L[k, i] if i == 0 else W[k, i - 1] @ L[k, i]
+    composed = (W.copy(), L.copy())
+
+    ad = SimpleNamespace(EMA=ema, Pose=MakePose(count), IKChains=[chain])
+    evaluated = []
+    monkeypatch.setattr(addon, "ComposeActionRange", lambda ad, arm, action, frames: (composed[0].copy(), composed[1].copy()))
+    monkeypatch.setattr(addon, "GetAbsoluteFlags", lambda ad, arm: [False] * (count * 3))
+    monkeypatch.setattr(addon, "UpdateViewLayer", lambda: None)
+    monkeypatch.setattr(addon, "EvaluateArmature", lambda ad, arm, action: evaluated.append(action))
+
+    #Each frame's solve gets a different answer, so the frames can't get mixed up
+    results = [Rotation(0.2 * (k + 1), 'X') for k in frames]
+    solves = iter(results)
+    monkeypatch.setattr(addon, "ProcessIKData0x01_00", lambda arm, names, floats, flag: next(solves).copy())
+
+    Ws, Ls = addon.SolveIKRange(ad, armature, "action", frames)
+
+    for k in frames:
+        result = np.array([tuple(r) for r in results[k]])
+        #Node 1 is solved against its composed parent, node 2 onwards follow it, node 0 is untouched
+        assert Ls[k, 1] == pytest.approx(result)
+        assert Ws[k, 1] == pytest.approx(W[k, 0] @ result)
+        for i in range(2, count):
+            assert Ls[k, i] == pytest.approx(L[k, i])
+            assert Ws[k, i] == pytest.approx(Ws[k, i - 1] @ L[k, i])
+        assert Ws[k, 0] == pytest.approx(W[k, 0])
+
+    #The armature goes back to the current frame afterwards
+    assert evaluated == ["action"]
@@ -0,0 +1,115 @@
+import os
+import sys
+import importlib.util
+from types import SimpleNamespace
+
+import pytest
+
+#Checks the native track sampler against the curves it stands in for
+#The sampler itself only needs NumPy, but pytest imports the add-on package these tests sit in, so they need Blender's
+#Python modules (e.g. the bpy wheel) all the same. The fcurve comparison also needs the pre-5.0 action API (action.fcurves)
+
+np = pytest.importorskip("numpy")
+bpy = pytest.importorskip("bpy")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from EMASampler import TrackSampler
+
+#Unevenly spaced keys, so the slopes either side of a tangent key differ
+VALUES = [0.0, 2.0, -1.0, 3.0, 0.5, 4.0, -2.0, 10.0, 30.0, -45.0]
+NODES = ["Root", "Arm"]
+
+def MakeEMA():
+    nodes = [SimpleNamespace(Name=name, Parent=i - 1, Translation=(0.0, 0.0, 0.0), Scale=(1.0, 1.0, 1.0)) for i, name in enumerate(NODES)]
+    translation = SimpleNamespace(BoneID=1, TransformType=0, BitFlag=0x00, StepCount=5, StepsList=[0, 2, 9, 10, 30],
+        ValueIndicesList=[0, 1, 2, 3, 4], TangentIndicesList=[5, 6, 5, -1, -1])
+    rotation = SimpleNamespace(BoneID=1, TransformType=1, BitFlag=0x02, StepCount=4, StepsList=[0, 3, 4, 20],
+        ValueIndicesList=[7, 8, 9, 7], TangentIndicesList=[-1, 8, 9, -1])
+    animation = SimpleNamespace(Name="Walk", Duration=30, CMDTracks=[translation, rotation], ValueList=VALUES)
+    skeleton = SimpleNamespace(Nodes=nodes, NodeCount=len(nodes), IKData=[])
+    return SimpleNamespace(Skeleton=skeleton, Animations=[animation])
+
+def Hermite(x, x0, x1, y0, y1, t0, t1):
+#Cubic Hermite over one segment, with the tangents in value per segment as the tracks store them
+    u = (x - x0) / (x1 - x0)
+    return (2*u**3 - 3*u**2 + 1) * y0 + (u**3 - 2*u**2 + u) * t0 + (-2*u**3 + 3*u**2) * y1 + (u**3 - u**2) * t1
+
+def test_tracks_sample_as_hermite():
+    ema = MakeEMA()
+    sampler = TrackSampler(ema.Animations[0], ema.Skeleton)
+    frames = np.array([0.0, 0.5, 1.0, 2.0, 3.5, 6.0, 9.0])
+
+    expected = []
+    for x in frames:
+        if x <= 2.0:
+            expected.append(Hermite(x, 0.0, 2.0, 0.0, 2.0, 4.0, -2.0))
+        else:
+            expected.append(Hermite(x, 2.0, 9.0, 2.0, -1.0, -2.0, 4.0))
+
+    assert sampler.SampleTracksRange(frames)[:, 0] == pytest.approx(expected, abs=1e-5)
+
+def test_missing_tangents_run_straight():
+    ema = MakeEMA()
+    sampler = TrackSampler(ema.Animations[0], ema.Skeleton)
+
+    #Handles collapsed onto both keys ease x and y alike, so the value runs in a straight line, and holds past the end
+    frames = np.array([10.0, 12.5, 20.0, 29.0, 30.0, 45.0])
+    expected = np.interp(frames, [10.0, 30.0], [3.0, 0.5])
+    assert sampler.SampleTracksRange(frames)[:, 0] == pytest.approx(expected, abs=1e-5)
+
+def test_cursor_matches_search():
+    ema = MakeEMA()
+    sampler = TrackSampler(ema.Animations[0], ema.Skeleton)
+    frames = np.arange(-2.0, 32.0, 0.5)
+
+    stepped = np.array([sampler.SampleTracks(f) for f in frames])
+    assert stepped == pytest.approx(sampler.SampleTracksRange(frames), abs=1e-9)
+
+@pytest.fixture(scope="module")
+def addon():
+    if "fcurves" not in bpy.types.Action.bl_rna.properties:
+        pytest.skip("needs the pre-5.0 action API")
+
+    spec = importlib.util.spec_from_file_location("usf4_addon", os.path.join(ROOT, "__init__.py"), submodule_search_locations=[ROOT])
+    module = importlib.util.module_from_spec(spec)
+    #The add-on's relative imports need it registered as a package first
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    module.register()
+    yield module
+    module.unregister()
+
+def MakeArmature():
+    data = bpy.data.armatures.new("Body")
+    obj = bpy.data.objects.new("Body", data)
+    bpy.context.scene.collection.objects.link(obj)
+    bpy.context.view_layer.objects.active = obj
+    bpy.ops.object.mode_set(mode='EDIT')
+    for name in NODES:
+        data.edit_bones.new(name).tail = (0.0, 0.0, 1.0)
+    bpy.ops.object.mode_set(mode='OBJECT')
+    return obj
+
+def test_sampler_matches_fcurve_evaluate(addon):
+    ema = MakeEMA()
+    armature = MakeArmature()
+    #Only the skeleton view is needed, LoadAnimationData just checks it's there
+    ad = addon.USF4ArmatureData(armature.name, armature.data.name, ema, object())
+    addon.armature_list.append(ad)
+    try:
+        armature.animation_data_create()
+        action = bpy.data.actions.new("Walk")
+        armature.animation_data.action = action
+        assert bpy.ops.usf4.load_animation_data() == {'FINISHED'}
+
+        sampler = addon.GetSampler(ad, action)
+        assert sampler is not None
+
+        frames = np.arange(-2.0, 32.0, 0.25)
+        sampled = sampler.SampleTracksRange(frames)
+        for t, f in enumerate(action.fcurves):
+            expected = [f.evaluate(x) for x in frames]
+            assert sampled[:, t] == pytest.approx(expected, abs=1e-4), f.data_path
+    finally:
+        addon.armature_list.remove(ad)